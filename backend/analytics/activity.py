@@ -0,0 +1,181 @@
+"""
+Room activity time series.
+
+The room consumer counts activity into Redis as it happens, in one bucket
+per minute, hour and day (UTC) at once:
+- messages posted, with ZINCRBY on the bucket's messages sorted set;
+- users who posted or connected, in a HyperLogLog per room and bucket;
+- the most users online at once, with ZADD GT on the bucket's peak sorted
+  set whenever someone joins.
+Each event is one pipelined round trip. While Redis is down, activity simply
+goes uncounted.
+
+Each event also marks its (bucket, room) pairs in a dirty set. The
+flush_room_activity command writes the totals of just those pairs into
+RoomActivityBucket every few seconds, so quiet rooms cost nothing. It writes
+totals rather than deltas, so a flush can be repeated or cut short safely.
+Once a bucket has been closed for GRACE seconds it is written out in full
+one last time and its Redis keys are dropped.
+Dashboards only read the table: one indexed row per bucket with any activity,
+however long the history behind it. Old buckets are pruned per resolution
+(settings.ROOM_ACTIVITY_RETENTION_DAYS).
+"""
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from rooms.models import Room
+from utils.redis_client import aget_redis, get_redis
+from .models import RoomActivityBucket
+
+# Bucket width of each resolution, in seconds
+RESOLUTIONS = {'minute': 60, 'hour': 3600, 'day': 86400}
+# Open buckets, as "<resolution>:<start>" scored by when they close
+BUCKETS_KEY = 'activity:buckets'
+# "<resolution>:<start>:<room id>" of each room with activity since the last flush
+DIRTY_KEY = 'activity:dirty'
+# The dirty set taken by a flush, kept until its rows are written
+FLUSHING_KEY = 'activity:dirty:flushing'
+# Seconds a closed bucket stays in Redis for writes still in flight
+GRACE = 120
+# A bucket's keys expire this long after it closes even if never flushed
+KEEP_UNFLUSHED = 86400
+
+
+def bucket_key(resolution, start, kind):
+    return f"activity:{resolution}:{start}:{kind}"
+
+
+def users_key(resolution, start, room_id):
+    return f"activity:{resolution}:{start}:users:{room_id}"
+
+
+def _queue_event(pipe, room_id, user_id, messages=0, online=None):
+    now = time.time()
+    room_id = str(room_id)
+    for resolution, width in RESOLUTIONS.items():
+        start = int(now // width) * width
+        expires_at = start + width + KEEP_UNFLUSHED
+        if messages:
+            pipe.zincrby(bucket_key(resolution, start, 'messages'), messages, room_id)
+            pipe.expireat(bucket_key(resolution, start, 'messages'), expires_at)
+        if online is not None:
+            pipe.zadd(bucket_key(resolution, start, 'peak'), {room_id: online}, gt=True)
+            pipe.expireat(bucket_key(resolution, start, 'peak'), expires_at)
+        pipe.pfadd(users_key(resolution, start, room_id), user_id)
+        pipe.expireat(users_key(resolution, start, room_id), expires_at)
+        pipe.zadd(BUCKETS_KEY, {f"{resolution}:{start}": start + width})
+        pipe.sadd(DIRTY_KEY, f"{resolution}:{start}:{room_id}")
+    pipe.expire(DIRTY_KEY, KEEP_UNFLUSHED)
+
+
+async def arecord_message(room_id, user_id):
+    pipe = aget_redis().pipeline(transaction=False)
+    _queue_event(pipe, room_id, user_id, messages=1)
+    try:
+        await pipe.execute()
+    except redis.RedisError:
+        pass  # activity stats never get in the way of chat
+
+
+async def arecord_join(room_id, user_id, online):
+    """`online` is how many users the room has with the one who joined"""
+    pipe = aget_redis().pipeline(transaction=False)
+    _queue_event(pipe, room_id, user_id, online=online)
+    try:
+        await pipe.execute()
+    except redis.RedisError:
+        pass
+
+
+def flush_room_activity():
+    """
+    Write the totals of the (bucket, room) pairs with activity since the last
+    flush, and of every room in buckets closed for longer than GRACE, which
+    are then dropped; returns the rows written
+    """
+    client = get_redis()
+    now = time.time()
+
+    # Take the dirty set, merged with any a failed flush left behind; events
+    # from here on mark a new one
+    pipe = client.pipeline()
+    pipe.sunionstore(FLUSHING_KEY, [FLUSHING_KEY, DIRTY_KEY])
+    pipe.delete(DIRTY_KEY)
+    pipe.smembers(FLUSHING_KEY)
+    dirty = pipe.execute()[-1]
+
+    rooms_by_bucket = {}
+    for member in dirty:
+        resolution, start, room_id = member.split(':')
+        rooms_by_bucket.setdefault((resolution, start), set()).add(room_id)
+
+    closed = []
+    for bucket in client.zrangebyscore(BUCKETS_KEY, '-inf', now - GRACE):
+        resolution, start = bucket.split(':')
+        pipe = client.pipeline(transaction=False)
+        pipe.zrange(bucket_key(resolution, start, 'messages'), 0, -1)
+        pipe.zrange(bucket_key(resolution, start, 'peak'), 0, -1)
+        room_ids = set().union(*pipe.execute())
+        rooms_by_bucket.setdefault((resolution, start), set()).update(room_ids)
+        closed.append((bucket, resolution, start, room_ids))
+
+    pairs = [
+        (resolution, start, room_id)
+        for (resolution, start), room_ids in rooms_by_bucket.items() for room_id in room_ids
+    ]
+    pipe = client.pipeline(transaction=False)
+    for resolution, start, room_id in pairs:
+        pipe.zscore(bucket_key(resolution, start, 'messages'), room_id)
+        pipe.zscore(bucket_key(resolution, start, 'peak'), room_id)
+        pipe.pfcount(users_key(resolution, start, room_id))
+    results = pipe.execute()
+    rows = [
+        RoomActivityBucket(
+            room_id=room_id, resolution=resolution,
+            start=datetime.fromtimestamp(int(start), tz=dt_timezone.utc),
+            messages=int(messages or 0), active_users=users, peak_online=int(peak or 0),
+        )
+        for (resolution, start, room_id), messages, peak, users
+        in zip(pairs, results[0::3], results[1::3], results[2::3])
+        # Nothing left in Redis for a pair marked before its bucket was dropped
+        if messages or peak or users
+    ]
+
+    # Rooms deleted since keep no history
+    existing = {
+        str(room_id)
+        for room_id in Room.objects.filter(id__in={row.room_id for row in rows}).values_list('id', flat=True)
+    }
+    rows = [row for row in rows if row.room_id in existing]
+    with transaction.atomic():
+        RoomActivityBucket.objects.bulk_create(
+            rows, batch_size=1000, update_conflicts=True, unique_fields=['room', 'resolution', 'start'],
+            update_fields=['messages', 'active_users', 'peak_online'],
+        )
+
+    pipe = client.pipeline(transaction=False)
+    for bucket, resolution, start, room_ids in closed:
+        pipe.delete(
+            bucket_key(resolution, start, 'messages'), bucket_key(resolution, start, 'peak'),
+            *(users_key(resolution, start, room_id) for room_id in room_ids),
+        )
+        pipe.zrem(BUCKETS_KEY, bucket)
+    pipe.delete(FLUSHING_KEY)
+    pipe.execute()
+    return len(rows)
+
+
+def prune_room_activity():
+    """Delete buckets older than their resolution's retention; returns how many"""
+    deleted = 0
+    for resolution, days in settings.ROOM_ACTIVITY_RETENTION_DAYS.items():
+        if days is None:
+            continue
+        cutoff = timezone.now() - timedelta(days=days)
+        deleted += RoomActivityBucket.objects.filter(resolution=resolution, start__lt=cutoff).delete()[0]
+    return deleted
@@ -0,0 +1,27 @@
+from django.contrib import admin
+
+from .models import FocusEvent, RoomActivityBucket, RoomFocusRollup, UserFocusRollup
+
+
+@admin.register(FocusEvent)
+class FocusEventAdmin(admin.ModelAdmin):
+    list_display = ('user', 'room', 'ended_at', 'duration_seconds')
+    list_filter = ('ended_at',)
+
+
+@admin.register(UserFocusRollup)
+class UserFocusRollupAdmin(admin.ModelAdmin):
+    list_display = ('user', 'period', 'start', 'focus_seconds', 'sessions')
+    list_filter = ('period',)
+
+
+@admin.register(RoomFocusRollup)
+class RoomFocusRollupAdmin(admin.ModelAdmin):
+    list_display = ('room', 'period', 'start', 'focus_seconds', 'sessions', 'participants')
+    list_filter = ('period',)
+
+
+@admin.register(RoomActivityBucket)
+class RoomActivityBucketAdmin(admin.ModelAdmin):
+    list_display = ('room', 'resolution', 'start', 'messages', 'active_users', 'peak_online')
+    list_filter = ('resolution',)
@@ -0,0 +1,50 @@
+import time
+
+import redis
+from django.core.management.base import BaseCommand
+from django.db import InterfaceError, OperationalError, close_old_connections
+
+from analytics.activity import flush_room_activity, prune_room_activity
+
+# Longest wait between attempts while Redis or the database is unavailable
+MAX_BACKOFF = 300
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the room activity buckets counted in Redis to RoomActivityBucket "
+        "and prune buckets past their retention"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep running, flushing every N seconds (default: flush once)')
+        parser.add_argument('--prune-interval', type=float, default=3600,
+                            help='When running, prune expired buckets every N seconds')
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        next_prune = 0
+        delay = interval
+        while True:
+            try:
+                written = flush_room_activity()
+                if written or not interval:
+                    self.stdout.write(f"Wrote {written} room activity bucket(s)")
+                if time.time() >= next_prune:
+                    pruned = prune_room_activity()
+                    if pruned:
+                        self.stdout.write(f"Pruned {pruned} expired room activity bucket(s)")
+                    next_prune = time.time() + options['prune_interval']
+            except (redis.RedisError, InterfaceError, OperationalError) as exc:
+                if not interval:
+                    raise
+                # Counts stay in Redis, still marked dirty, until a flush gets through
+                delay = min(delay * 2, MAX_BACKOFF)
+                self.stderr.write(f"Flushing room activity failed, retrying in {delay:g}s: {exc}")
+                close_old_connections()
+            else:
+                delay = interval
+            if not interval:
+                break
+            time.sleep(delay)
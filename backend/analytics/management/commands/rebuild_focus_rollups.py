@@ -0,0 +1,30 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from analytics.pipeline import rebuild_rollups, rebuild_streaks
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the focus rollups from the FocusEvent log, e.g. after "
+        "changing how they are counted, and then every user's focus streak"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='First day to recompute, as YYYY-MM-DD (default: 30 days ago)')
+
+    def handle(self, *args, **options):
+        if options['since']:
+            try:
+                since = date.fromisoformat(options['since'])
+            except ValueError:
+                raise CommandError("--since must be a date such as 2024-01-31")
+        else:
+            since = timezone.localdate() - timedelta(days=30)
+
+        written = rebuild_rollups(since)
+        self.stdout.write(f"Wrote {written} rollup row(s) from {since}")
+        changed = rebuild_streaks()
+        self.stdout.write(self.style.SUCCESS(f"Updated the focus streak of {changed} user(s)"))
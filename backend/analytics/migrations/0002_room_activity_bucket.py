@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0001_initial'),
+        ('rooms', '0018_pomodoro_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomActivityBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('minute', 'Minute'), ('hour', 'Hour'), ('day', 'Day')], max_length=6)),
+                ('start', models.DateTimeField()),
+                ('messages', models.PositiveIntegerField(default=0)),
+                ('active_users', models.PositiveIntegerField(default=0)),
+                ('peak_online', models.PositiveIntegerField(default=0)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='activity_buckets', to='rooms.room')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['resolution', 'start'], name='analytics_r_resolut_8a47b2_idx')],
+                'unique_together': {('room', 'resolution', 'start')},
+            },
+        ),
+    ]
@@ -0,0 +1,89 @@
+from django.conf import settings
+from django.db import models
+
+
+class FocusEvent(models.Model):
+    """One user's completed focus phase; the log the rollups are built from"""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='focus_events')
+    # Kept when the room is deleted so the user's history doesn't change
+    room = models.ForeignKey('rooms.Room', on_delete=models.SET_NULL, null=True, related_name='focus_events')
+    started_at = models.DateTimeField()
+    ended_at = models.DateTimeField()
+    duration_seconds = models.PositiveIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ended_at']),
+            models.Index(fields=['user', 'ended_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} focused {self.duration_seconds}s until {self.ended_at}"
+
+
+PERIOD_CHOICES = (
+    ('day', 'Day'),
+    ('week', 'Week'),  # starting on Monday
+)
+
+
+class UserFocusRollup(models.Model):
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='focus_rollups')
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    start = models.DateField()
+    focus_seconds = models.PositiveBigIntegerField(default=0)
+    # Focus phases completed
+    sessions = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'period', 'start')
+
+    def __str__(self):
+        return f"{self.user_id} {self.period} of {self.start}: {self.focus_seconds}s"
+
+
+class RoomFocusRollup(models.Model):
+    room = models.ForeignKey('rooms.Room', on_delete=models.CASCADE, related_name='focus_rollups')
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    start = models.DateField()
+    # Summed over everyone in the room, so two people focusing for an hour is two hours
+    focus_seconds = models.PositiveBigIntegerField(default=0)
+    # Focus phases completed with anyone in the room
+    sessions = models.PositiveIntegerField(default=0)
+    # Users counted once per phase they were in
+    participants = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('room', 'period', 'start')
+
+    def __str__(self):
+        return f"{self.room_id} {self.period} of {self.start}: {self.focus_seconds}s"
+
+
+RESOLUTION_CHOICES = (
+    ('minute', 'Minute'),
+    ('hour', 'Hour'),
+    ('day', 'Day'),
+)
+
+
+class RoomActivityBucket(models.Model):
+    """A room's activity over one minute, hour or day (UTC); see analytics.activity"""
+    room = models.ForeignKey('rooms.Room', on_delete=models.CASCADE, related_name='activity_buckets')
+    resolution = models.CharField(max_length=6, choices=RESOLUTION_CHOICES)
+    start = models.DateTimeField()
+    messages = models.PositiveIntegerField(default=0)
+    # Distinct users who posted or connected, estimated to within about 1%
+    active_users = models.PositiveIntegerField(default=0)
+    # Most users online at once, as seen when someone joined
+    peak_online = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('room', 'resolution', 'start')
+        indexes = [
+            # For pruning each resolution's expired buckets
+            models.Index(fields=['resolution', 'start']),
+        ]
+
+    def __str__(self):
+        return f"{self.room_id} {self.resolution} of {self.start}: {self.messages} message(s)"
@@ -0,0 +1,164 @@
+"""
+Focus-time pipeline.
+
+The pomodoro scheduler calls `record_focus_phases` as focus phases end. Each
+phase becomes a FocusEvent for every user online in the room at the time.
+In the same transaction the events are added into the per-user and per-room
+day and week rollups with F() increments, and each user's focus streak is
+moved along with one conditional UPDATE per day. The analytics endpoints
+only read the rollups, and FocusEvent is the log they are rebuilt from (see
+the rebuild_focus_rollups command).
+
+Days are calendar days in TIME_ZONE; weeks start on Monday.
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
+
+from rooms.presence import online_user_ids
+from .models import FocusEvent, RoomFocusRollup, UserFocusRollup
+
+User = get_user_model()
+
+
+def period_starts(moment):
+    """{'day': date, 'week': date of its Monday} for a datetime"""
+    day = timezone.localdate(moment)
+    return {'day': day, 'week': day - timedelta(days=day.weekday())}
+
+
+def record_focus_phases(phases):
+    """
+    Record focus phases that just ended, given as (room_id, started_at,
+    ended_at) tuples; returns the number of FocusEvents created
+    """
+    online = online_user_ids({room_id for room_id, started_at, ended_at in phases})
+    events = [
+        FocusEvent(
+            user_id=user_id, room_id=room_id, started_at=started_at, ended_at=ended_at,
+            duration_seconds=int((ended_at - started_at).total_seconds()),
+        )
+        for room_id, started_at, ended_at in phases
+        for user_id in online.get(str(room_id), ())
+    ]
+    if not events:
+        return 0
+    with transaction.atomic():
+        FocusEvent.objects.bulk_create(events)
+        add_to_rollups(events)
+        advance_streaks(events)
+    return len(events)
+
+
+def sum_rollups(events):
+    """Rollup totals of `events`, keyed by (user or room id, period, start)"""
+    user_totals = defaultdict(lambda: {'focus_seconds': 0, 'sessions': 0})
+    room_totals = defaultdict(lambda: {'focus_seconds': 0, 'sessions': 0, 'participants': 0})
+    phases = set()
+    for event in events:
+        for period, start in period_starts(event.ended_at).items():
+            user = user_totals[(event.user_id, period, start)]
+            user['focus_seconds'] += event.duration_seconds
+            user['sessions'] += 1
+            if event.room_id is None:
+                continue  # the room has been deleted since
+            room = room_totals[(event.room_id, period, start)]
+            room['focus_seconds'] += event.duration_seconds
+            room['participants'] += 1
+            # Everyone in a phase shares its end time
+            if (event.room_id, event.ended_at, period) not in phases:
+                phases.add((event.room_id, event.ended_at, period))
+                room['sessions'] += 1
+    return user_totals, room_totals
+
+
+def add_to_rollups(events):
+    user_totals, room_totals = sum_rollups(events)
+    for (user_id, period, start), totals in user_totals.items():
+        increment(UserFocusRollup, {'user_id': user_id, 'period': period, 'start': start}, totals)
+    for (room_id, period, start), totals in room_totals.items():
+        increment(RoomFocusRollup, {'room_id': room_id, 'period': period, 'start': start}, totals)
+
+
+def increment(model, key, totals):
+    """Add `totals` to the rollup row at `key`, creating it if need be"""
+    changes = {field: F(field) + amount for field, amount in totals.items()}
+    if model.objects.filter(**key).update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**key, **totals)
+    except IntegrityError:
+        # Created concurrently since the update found nothing
+        model.objects.filter(**key).update(**changes)
+
+
+def advance_streaks(events):
+    """
+    Count each user's focus day into their streak in one UPDATE per day: a
+    day right after last_focus_date extends the streak, a later one starts
+    a new streak, and the same or an earlier day changes nothing
+    """
+    users_by_day = defaultdict(set)
+    for event in events:
+        users_by_day[timezone.localdate(event.ended_at)].add(event.user_id)
+    for day, user_ids in sorted(users_by_day.items()):
+        User.objects.filter(id__in=user_ids).filter(
+            Q(last_focus_date__isnull=True) | Q(last_focus_date__lt=day)
+        ).update(
+            focus_streak=Case(
+                When(last_focus_date=day - timedelta(days=1), then=F('focus_streak') + 1),
+                default=Value(1),
+            ),
+            last_focus_date=day,
+        )
+
+
+def rebuild_rollups(since):
+    """
+    Recompute the rollups of the days from `since` (and of the weeks those
+    fall in) from the FocusEvent log; returns the number of rows written
+    """
+    week = since - timedelta(days=since.weekday())
+    events = FocusEvent.objects.filter(
+        ended_at__gte=timezone.make_aware(datetime.combine(week, time.min))
+    ).only('user_id', 'room_id', 'ended_at', 'duration_seconds')
+    user_totals, room_totals = sum_rollups(events.iterator(chunk_size=2000))
+
+    with transaction.atomic():
+        for model in (UserFocusRollup, RoomFocusRollup):
+            model.objects.filter(Q(period='day', start__gte=since) | Q(period='week', start__gte=week)).delete()
+        written = UserFocusRollup.objects.bulk_create([
+            UserFocusRollup(user_id=user_id, period=period, start=start, **totals)
+            for (user_id, period, start), totals in user_totals.items() if period == 'week' or start >= since
+        ], batch_size=1000)
+        written += RoomFocusRollup.objects.bulk_create([
+            RoomFocusRollup(room_id=room_id, period=period, start=start, **totals)
+            for (room_id, period, start), totals in room_totals.items() if period == 'week' or start >= since
+        ], batch_size=1000)
+    return len(written)
+
+
+def rebuild_streaks():
+    """
+    Recompute every user's focus streak and last focus day from their day
+    rollups; returns the number of users whose streak changed
+    """
+    streaks = {}  # user id -> (streak, last day)
+    days = UserFocusRollup.objects.filter(period='day').order_by('user_id', 'start')
+    for user_id, day in days.values_list('user_id', 'start').iterator(chunk_size=5000):
+        streak, last = streaks.get(user_id, (0, None))
+        streaks[user_id] = (streak + 1 if last == day - timedelta(days=1) else 1, day)
+
+    changed = []
+    for user in User.objects.only('id', 'focus_streak', 'last_focus_date').iterator(chunk_size=2000):
+        streak, last = streaks.get(user.id, (0, None))
+        if (user.focus_streak, user.last_focus_date) != (streak, last):
+            user.focus_streak, user.last_focus_date = streak, last
+            changed.append(user)
+    User.objects.bulk_update(changed, ['focus_streak', 'last_focus_date'], batch_size=1000)
+    return len(changed)
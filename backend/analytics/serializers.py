@@ -0,0 +1,21 @@
+from rest_framework import serializers
+
+from .models import RoomActivityBucket, RoomFocusRollup, UserFocusRollup
+
+
+class UserFocusRollupSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UserFocusRollup
+        fields = ['start', 'focus_seconds', 'sessions']
+
+
+class RoomFocusRollupSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = RoomFocusRollup
+        fields = ['start', 'focus_seconds', 'sessions', 'participants']
+
+
+class RoomActivityBucketSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = RoomActivityBucket
+        fields = ['start', 'messages', 'active_users', 'peak_online']
@@ -0,0 +1,272 @@
+import time
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from unittest import mock, skipUnless
+
+import redis
+import redis.asyncio
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import OperationalError
+from django.test import TestCase, override_settings
+
+from rooms.models import Room
+from .activity import BUCKETS_KEY, GRACE, arecord_join, arecord_message, bucket_key, flush_room_activity
+from .models import FocusEvent, RoomActivityBucket, RoomFocusRollup, UserFocusRollup
+from .pipeline import add_to_rollups, advance_streaks, rebuild_rollups, sum_rollups
+
+User = get_user_model()
+
+# Sunday the 11th ends one week, Monday the 12th starts the next
+SUNDAY = date(2026, 10, 11)
+MONDAY = date(2026, 10, 12)
+PREVIOUS_MONDAY = date(2026, 10, 5)
+
+
+# A database of its own, emptied around every test
+TEST_REDIS_URL = settings.REDIS_URL.rsplit('/', 1)[0] + '/15'
+
+
+def redis_available():
+    try:
+        return redis.Redis.from_url(TEST_REDIS_URL, socket_connect_timeout=0.5).ping()
+    except redis.RedisError:
+        return False
+
+
+def at(day, hour=12, minute=0):
+    return datetime(day.year, day.month, day.day, hour, minute, tzinfo=dt_timezone.utc)
+
+
+def event(user, room, ended_at, minutes=25):
+    return FocusEvent(
+        user=user, room=room, started_at=ended_at - timedelta(minutes=minutes), ended_at=ended_at,
+        duration_seconds=minutes * 60,
+    )
+
+
+@override_settings(TIME_ZONE='UTC')
+class SumRollupsTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', email='alice@example.com')
+        self.bob = User.objects.create_user(username='bob', email='bob@example.com')
+        self.room = Room.objects.create(name='Focus', owner=self.alice)
+
+    def test_phase_shared_by_two_users(self):
+        ended = at(MONDAY)
+        users, rooms = sum_rollups([event(self.alice, self.room, ended), event(self.bob, self.room, ended)])
+
+        self.assertEqual(users[(self.alice.id, 'day', MONDAY)], {'focus_seconds': 1500, 'sessions': 1})
+        self.assertEqual(users[(self.bob.id, 'week', MONDAY)], {'focus_seconds': 1500, 'sessions': 1})
+        for period in ('day', 'week'):
+            self.assertEqual(
+                rooms[(self.room.id, period, MONDAY)], {'focus_seconds': 3000, 'sessions': 1, 'participants': 2}
+            )
+
+    def test_days_and_weeks(self):
+        events = [
+            event(self.alice, self.room, at(SUNDAY, 23, 30)),
+            event(self.alice, self.room, at(MONDAY, 9)),
+            event(self.alice, self.room, at(MONDAY, 10), minutes=50),
+        ]
+        users, rooms = sum_rollups(events)
+
+        self.assertEqual(users[(self.alice.id, 'day', SUNDAY)], {'focus_seconds': 1500, 'sessions': 1})
+        self.assertEqual(users[(self.alice.id, 'week', PREVIOUS_MONDAY)], {'focus_seconds': 1500, 'sessions': 1})
+        self.assertEqual(users[(self.alice.id, 'day', MONDAY)], {'focus_seconds': 4500, 'sessions': 2})
+        self.assertEqual(users[(self.alice.id, 'week', MONDAY)], {'focus_seconds': 4500, 'sessions': 2})
+        self.assertEqual(rooms[(self.room.id, 'week', MONDAY)]['sessions'], 2)
+
+    def test_deleted_room_only_counts_for_the_user(self):
+        users, rooms = sum_rollups([event(self.alice, None, at(MONDAY))])
+        self.assertEqual(users[(self.alice.id, 'day', MONDAY)]['sessions'], 1)
+        self.assertEqual(dict(rooms), {})
+
+    def test_add_to_rollups_increments_existing_rows(self):
+        add_to_rollups([event(self.alice, self.room, at(MONDAY, 9))])
+        add_to_rollups([event(self.alice, self.room, at(MONDAY, 10)), event(self.bob, self.room, at(MONDAY, 10))])
+
+        day = UserFocusRollup.objects.get(user=self.alice, period='day', start=MONDAY)
+        self.assertEqual((day.focus_seconds, day.sessions), (3000, 2))
+        room = RoomFocusRollup.objects.get(room=self.room, period='week', start=MONDAY)
+        self.assertEqual((room.focus_seconds, room.sessions, room.participants), (4500, 2, 3))
+
+
+@override_settings(TIME_ZONE='UTC')
+class AdvanceStreaksTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(
+            name='Focus', owner=User.objects.create_user(username='owner', email='owner@example.com')
+        )
+
+    def user_with_streak(self, name, streak, last_day):
+        return User.objects.create_user(
+            username=name, email=f'{name}@example.com', focus_streak=streak, last_focus_date=last_day
+        )
+
+    def streak(self, user):
+        user.refresh_from_db(fields=['focus_streak', 'last_focus_date'])
+        return user.focus_streak, user.last_focus_date
+
+    def test_next_day_continues_the_streak(self):
+        user = self.user_with_streak('alice', 3, SUNDAY)
+        advance_streaks([event(user, self.room, at(MONDAY))])
+        self.assertEqual(self.streak(user), (4, MONDAY))
+
+    def test_gap_starts_a_new_streak(self):
+        user = self.user_with_streak('alice', 3, SUNDAY - timedelta(days=2))
+        advance_streaks([event(user, self.room, at(MONDAY))])
+        self.assertEqual(self.streak(user), (1, MONDAY))
+
+    def test_first_focus_day(self):
+        user = self.user_with_streak('alice', 0, None)
+        advance_streaks([event(user, self.room, at(MONDAY))])
+        self.assertEqual(self.streak(user), (1, MONDAY))
+
+    def test_same_day_counts_once(self):
+        user = self.user_with_streak('alice', 3, MONDAY)
+        advance_streaks([event(user, self.room, at(MONDAY, 9)), event(user, self.room, at(MONDAY, 15))])
+        self.assertEqual(self.streak(user), (3, MONDAY))
+
+    def test_earlier_day_changes_nothing(self):
+        user = self.user_with_streak('alice', 3, MONDAY)
+        advance_streaks([event(user, self.room, at(SUNDAY))])
+        self.assertEqual(self.streak(user), (3, MONDAY))
+
+    def test_several_days_in_one_batch(self):
+        user = self.user_with_streak('alice', 1, SUNDAY - timedelta(days=1))
+        advance_streaks([event(user, self.room, at(MONDAY)), event(user, self.room, at(SUNDAY))])
+        self.assertEqual(self.streak(user), (3, MONDAY))
+
+
+@override_settings(TIME_ZONE='UTC')
+class RebuildRollupsTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', email='alice@example.com')
+        self.room = Room.objects.create(name='Focus', owner=self.alice)
+        FocusEvent.objects.bulk_create([
+            event(self.alice, self.room, at(SUNDAY)),
+            event(self.alice, self.room, at(MONDAY)),
+            event(self.alice, self.room, at(MONDAY + timedelta(days=1))),
+        ])
+
+    def user_rollups(self):
+        return {
+            (period, start): seconds for period, start, seconds in
+            UserFocusRollup.objects.filter(user=self.alice).values_list('period', 'start', 'focus_seconds')
+        }
+
+    def test_since_a_monday_leaves_the_previous_week_alone(self):
+        # Hand-edited, so a rebuild that touched them would show
+        UserFocusRollup.objects.create(user=self.alice, period='day', start=SUNDAY, focus_seconds=1)
+        UserFocusRollup.objects.create(user=self.alice, period='week', start=PREVIOUS_MONDAY, focus_seconds=1)
+        UserFocusRollup.objects.create(user=self.alice, period='week', start=MONDAY, focus_seconds=1)
+
+        rebuild_rollups(MONDAY)
+
+        self.assertEqual(self.user_rollups(), {
+            ('day', SUNDAY): 1,
+            ('week', PREVIOUS_MONDAY): 1,
+            ('day', MONDAY): 1500,
+            ('day', MONDAY + timedelta(days=1)): 1500,
+            ('week', MONDAY): 3000,
+        })
+        room_week = RoomFocusRollup.objects.get(room=self.room, period='week', start=MONDAY)
+        self.assertEqual((room_week.focus_seconds, room_week.sessions), (3000, 2))
+
+    def test_since_midweek_rebuilds_the_whole_week(self):
+        UserFocusRollup.objects.create(user=self.alice, period='day', start=MONDAY, focus_seconds=1)
+
+        rebuild_rollups(MONDAY + timedelta(days=1))
+
+        rollups = self.user_rollups()
+        # Monday's own row is before `since`, but the week it is in is recounted
+        self.assertEqual(rollups[('day', MONDAY)], 1)
+        self.assertEqual(rollups[('week', MONDAY)], 3000)
+        self.assertNotIn(('week', PREVIOUS_MONDAY), rollups)
+
+
+@skipUnless(redis_available(), "needs a Redis server")
+class FlushRoomActivityTests(TestCase):
+    def setUp(self):
+        self.redis = redis.Redis.from_url(TEST_REDIS_URL, decode_responses=True)
+        self.redis.flushdb()
+        self.addCleanup(self.redis.flushdb)
+        self.enterContext(mock.patch('analytics.activity.get_redis', lambda: self.redis))
+        self.enterContext(mock.patch(
+            'analytics.activity.aget_redis',
+            lambda: redis.asyncio.Redis.from_url(TEST_REDIS_URL, decode_responses=True),
+        ))
+        # Midnight today, so keys written at these times don't expire yet
+        self.midnight = int(time.time() // 86400) * 86400
+        self.clock = self.enterContext(mock.patch('analytics.activity.time'))
+        self.set_time(10)
+
+        owner = User.objects.create_user(username='owner', email='owner@example.com')
+        self.quiet = Room.objects.create(name='Quiet', owner=owner)
+        self.busy = Room.objects.create(name='Busy', owner=owner)
+
+    def set_time(self, seconds_after_midnight):
+        self.clock.time.return_value = self.midnight + seconds_after_midnight
+
+    def post(self, room, user_id=1):
+        async_to_sync(arecord_message)(room.id, user_id)
+
+    def bucket(self, room, resolution, seconds_after_midnight=0):
+        start = datetime.fromtimestamp(self.midnight + seconds_after_midnight, tz=dt_timezone.utc)
+        row = RoomActivityBucket.objects.get(room=room, resolution=resolution, start=start)
+        return row.messages, row.active_users, row.peak_online
+
+    def test_flush_writes_every_resolution(self):
+        self.post(self.busy, user_id=1)
+        self.post(self.busy, user_id=2)
+        async_to_sync(arecord_join)(self.busy.id, 3, 5)
+
+        self.assertEqual(flush_room_activity(), 3)
+        for resolution in ('minute', 'hour', 'day'):
+            self.assertEqual(self.bucket(self.busy, resolution), (2, 3, 5))
+
+    def test_only_rooms_with_new_activity_are_written(self):
+        self.post(self.quiet)
+        self.post(self.busy)
+        self.assertEqual(flush_room_activity(), 6)
+        self.assertEqual(flush_room_activity(), 0)
+
+        # Hand-edited, so a flush that rewrote it would show
+        RoomActivityBucket.objects.filter(room=self.quiet).update(messages=99)
+        self.post(self.busy)
+        self.assertEqual(flush_room_activity(), 3)
+        self.assertEqual(self.bucket(self.busy, 'minute'), (2, 1, 0))
+        self.assertEqual(self.bucket(self.quiet, 'minute'), (99, 1, 0))
+
+    def test_minute_rollover(self):
+        self.post(self.busy, user_id=1)
+        self.set_time(70)
+        self.post(self.busy, user_id=2)
+
+        flush_room_activity()
+
+        self.assertEqual(self.bucket(self.busy, 'minute', 0), (1, 1, 0))
+        self.assertEqual(self.bucket(self.busy, 'minute', 60), (1, 1, 0))
+        self.assertEqual(self.bucket(self.busy, 'hour'), (2, 2, 0))
+
+    def test_closed_bucket_is_written_in_full_and_dropped(self):
+        self.post(self.busy)
+        flush_room_activity()
+        RoomActivityBucket.objects.all().delete()
+
+        self.set_time(60 + GRACE)
+        self.assertEqual(flush_room_activity(), 1)
+
+        self.assertEqual(self.bucket(self.busy, 'minute'), (1, 1, 0))
+        self.assertFalse(self.redis.exists(bucket_key('minute', self.midnight, 'messages')))
+        self.assertEqual(self.redis.zrange(BUCKETS_KEY, 0, -1), [f'hour:{self.midnight}', f'day:{self.midnight}'])
+
+    def test_failed_flush_is_retried(self):
+        self.post(self.busy)
+        with mock.patch.object(RoomActivityBucket.objects, 'bulk_create', side_effect=OperationalError):
+            with self.assertRaises(OperationalError):
+                flush_room_activity()
+
+        self.assertEqual(flush_room_activity(), 3)
+        self.assertEqual(self.bucket(self.busy, 'day'), (1, 1, 0))
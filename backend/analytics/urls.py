@@ -0,0 +1,9 @@
+from django.urls import path
+
+from .views import MyFocusStatsView, RoomActivityView, RoomFocusStatsView
+
+urlpatterns = [
+    path('focus/', MyFocusStatsView.as_view(), name='focus-stats'),
+    path('rooms/<uuid:room_id>/focus/', RoomFocusStatsView.as_view(), name='room-focus-stats'),
+    path('rooms/<uuid:room_id>/activity/', RoomActivityView.as_view(), name='room-activity'),
+]
@@ -0,0 +1,145 @@
+from datetime import timedelta
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework import exceptions, status
+from rest_framework.response import Response
+
+from rooms.access import aresolve_access
+from rooms.permissions import IsRoomMember
+from utils.async_views import AsyncAPIView
+from .activity import RESOLUTIONS
+from .models import RoomActivityBucket, RoomFocusRollup, UserFocusRollup
+from .pipeline import period_starts
+from .serializers import RoomActivityBucketSerializer, RoomFocusRollupSerializer, UserFocusRollupSerializer
+
+
+class FocusStatsView(AsyncAPIView):
+    """
+    Recent daily and weekly focus totals, read from the rollups only. Periods
+    without any focus are left out. `?days=` and `?weeks=` pick how far back
+    to go.
+    """
+    model = None
+    serializer_class = None
+    DEFAULT_DAYS, MAX_DAYS = 14, 366
+    DEFAULT_WEEKS, MAX_WEEKS = 12, 104
+
+    def get_window(self, request, name, default, maximum):
+        value = request.GET.get(name, default)
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"'{name}' must be a whole number")
+        if not 1 <= value <= maximum:
+            raise ValueError(f"'{name}' must be between 1 and {maximum}")
+        return value
+
+    async def get_rollups(self, request, **owner):
+        try:
+            days = self.get_window(request, 'days', self.DEFAULT_DAYS, self.MAX_DAYS)
+            weeks = self.get_window(request, 'weeks', self.DEFAULT_WEEKS, self.MAX_WEEKS)
+        except ValueError as exc:
+            return None, Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        current = period_starts(timezone.now())
+        since = {
+            'day': current['day'] - timedelta(days=days - 1),
+            'week': current['week'] - timedelta(weeks=weeks - 1),
+        }
+        rows = self.model.objects.filter(**owner).filter(
+            period__in=since, start__gte=min(since.values())
+        ).order_by('start')
+        data = {'days': [], 'weeks': []}
+        async for row in rows:
+            if row.start >= since[row.period]:
+                data['days' if row.period == 'day' else 'weeks'].append(self.serializer_class(row).data)
+        return data, None
+
+
+class MyFocusStatsView(FocusStatsView):
+    model = UserFocusRollup
+    serializer_class = UserFocusRollupSerializer
+
+    async def get(self, request):
+        data, error = await self.get_rollups(request, user=request.user)
+        if error:
+            return error
+        return Response({
+            'focus_streak': request.user.current_focus_streak,
+            'last_focus_date': request.user.last_focus_date,
+            **data,
+        })
+
+
+class RoomFocusStatsView(FocusStatsView):
+    model = RoomFocusRollup
+    serializer_class = RoomFocusRollupSerializer
+    permission_classes = [IsRoomMember]
+
+    async def get(self, request, room_id):
+        data, error = await self.get_rollups(request, room_id=room_id)
+        return error or Response(data)
+
+
+class RoomActivityView(AsyncAPIView):
+    """
+    A room's activity buckets at one resolution between `?start=` and `?end=`
+    (ISO datetimes, default: the last DEFAULT_SPANS). Buckets without any
+    activity are left out, and the current ones lag by up to a flush interval.
+    """
+    permission_classes = [IsRoomMember]
+    DEFAULT_SPANS = {
+        'minute': timedelta(hours=1),
+        'hour': timedelta(days=1),
+        'day': timedelta(days=30),
+    }
+    MAX_BUCKETS = 1500
+
+    def get_datetime(self, request, name, default):
+        value = request.GET.get(name)
+        if not value:
+            return default
+        try:
+            parsed = parse_datetime(value)
+        except ValueError:
+            parsed = None
+        if parsed is None:
+            raise ValueError(f"'{name}' must be an ISO 8601 datetime")
+        return parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed)
+
+    async def get(self, request, room_id):
+        # Owners, admins and moderators see the room's activity
+        if not (await aresolve_access(request, room_id)).is_moderator:
+            raise exceptions.PermissionDenied("Only admins can view room activity.")
+
+        resolution = request.GET.get('resolution', 'hour')
+        if resolution not in RESOLUTIONS:
+            return Response(
+                {'error': f"'resolution' must be one of {', '.join(RESOLUTIONS)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            end = self.get_datetime(request, 'end', timezone.now())
+            start = self.get_datetime(request, 'start', end - self.DEFAULT_SPANS[resolution])
+        except ValueError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        if start >= end:
+            return Response({'error': "'start' must be before 'end'"}, status=status.HTTP_400_BAD_REQUEST)
+        if (end - start).total_seconds() > self.MAX_BUCKETS * RESOLUTIONS[resolution]:
+            return Response(
+                {'error': f"At most {self.MAX_BUCKETS} {resolution} buckets can be requested at once"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # The bucket `start` falls in counts too
+        first = start - timedelta(seconds=start.timestamp() % RESOLUTIONS[resolution])
+        buckets = RoomActivityBucket.objects.filter(
+            room_id=room_id, resolution=resolution, start__gte=first, start__lt=end
+        ).order_by('start')
+        return Response({
+            'resolution': resolution,
+            'start': start,
+            'end': end,
+            'buckets': [RoomActivityBucketSerializer(bucket).data async for bucket in buckets],
+        })
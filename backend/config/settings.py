@@ -37,6 +37,7 @@ INSTALLED_APPS = [
     # Your custom apps (will be added later)
     'users',
     'rooms',
+    'analytics',
     # 'chat',
 ]
 
@@ -109,6 +110,9 @@ CACHES = {
     }
 }
 
+# Application state kept directly in Redis (buffered counters, etc.)
+REDIS_URL = f"redis://{os.getenv('REDIS_HOST', 'redis')}:{os.getenv('REDIS_PORT', 6379)}/2"
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -197,4 +201,41 @@ ALLOWED_FILE_EXTENSIONS = [
     '.py', '.js', '.ts', '.html', '.css',  # Code files
 ]
 MAX_FILE_SIZE_MB = 10  # Maximum file size in MB
+THUMBNAIL_WORKERS = int(os.getenv('THUMBNAIL_WORKERS', 2))  # Processes rendering image thumbnails/previews
+
+# How download bytes are sent once access is checked (see rooms/downloads.py):
+# 'asgi' (async streaming), 'x-accel' (nginx), 'x-sendfile' (Apache/lighttpd) or 'django'
+FILE_DELIVERY_MODE = os.getenv('FILE_DELIVERY_MODE', 'asgi')
+FILE_DELIVERY_ACCEL_PREFIX = '/protected-media/'  # nginx internal location aliased to MEDIA_ROOT
+
+# Resumable (chunked) uploads
+MAX_CHUNKED_FILE_SIZE_MB = int(os.getenv('MAX_CHUNKED_FILE_SIZE_MB', 500))
+UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024  # Suggested chunk size returned to clients
+UPLOAD_SESSION_ROOT = MEDIA_ROOT / 'upload_sessions'  # Partial files live here until finalized
+UPLOAD_SESSION_TTL_HOURS = 24  # Idle sessions older than this are purged
+UPLOAD_DIGEST_CACHE_SIZE = 1000  # running upload digests kept per process
+
+# Per-room storage (sum of shared file sizes); Room.storage_quota overrides it
+ROOM_STORAGE_QUOTA_MB = int(os.getenv('ROOM_STORAGE_QUOTA_MB', 1024))
+
+
+# Room activity buckets kept per resolution, in days; None keeps them for good
+ROOM_ACTIVITY_RETENTION_DAYS = {
+    'minute': int(os.getenv('ROOM_ACTIVITY_MINUTE_RETENTION_DAYS', 2)),
+    'hour': int(os.getenv('ROOM_ACTIVITY_HOUR_RETENTION_DAYS', 90)),
+    'day': None,
+}
 
+# Cold archive of old messages (see rooms/archive.py); kept outside MEDIA_ROOT
+# so it is never served
+MESSAGE_ARCHIVE_ROOT = Path(os.getenv('MESSAGE_ARCHIVE_ROOT', BASE_DIR / 'message_archive'))
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.getenv('MESSAGE_ARCHIVE_AFTER_DAYS', 180))
+MESSAGE_ARCHIVE_MIN_HOT = 500  # newest messages of each room never archived
+
+# Master keys wrapping each room's message data key (see rooms/keyring.py), as
+# comma-separated id:key pairs, each key 32 url-safe base64 bytes. The first
+# wraps new keys; keep an old one listed until rewrap_room_keys is done with it.
+# Without any, a development key ('dev') derived from SECRET_KEY is used.
+MESSAGE_MASTER_KEYS = os.getenv('MESSAGE_MASTER_KEYS', '')
+ROOM_KEY_CACHE_SIZE = int(os.getenv('ROOM_KEY_CACHE_SIZE', 1024))  # unwrapped data keys kept per process
+ROOM_KEY_CACHE_TTL = 300  # seconds before a cached key is read and unwrapped again
@@ -8,6 +8,7 @@ urlpatterns = [
     # API endpoints will be prefixed with 'api/'
     path('api/auth/', include('users.urls')),
     path('api/rooms/', include('rooms.urls')),  # Include Rooms API
+    path('api/analytics/', include('analytics.urls')),
 ]
 
 # Serve media files in development
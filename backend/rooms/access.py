@@ -0,0 +1,116 @@
+"""
+What a user may do in a room.
+
+A room's owner and the user's membership (role and mute) are loaded in one
+query, kept in the shared cache for ACCESS_CACHE_TTL seconds, and memoized on
+the request so the permission class and the view resolving it again cost
+nothing. Anything that changes a membership calls `invalidate_access` for
+that user, after its transaction commits.
+"""
+from collections import namedtuple
+
+from django.core.cache import cache
+from django.db.models import OuterRef, Subquery
+from django.http import Http404
+from django.utils import timezone
+
+from .models import Room, RoomMembership
+
+ACCESS_CACHE_TTL = 30
+
+MODERATOR_ROLES = ('admin', 'moderator')
+
+
+class RoomAccess(namedtuple('RoomAccess', ['room_id', 'user_id', 'owner_id', 'role', 'muted_until'])):
+    """`role` and `muted_until` are None when the user isn't a member"""
+
+    @property
+    def is_owner(self):
+        return self.user_id is not None and self.owner_id == self.user_id
+
+    @property
+    def is_member(self):
+        return self.is_owner or self.role is not None
+
+    @property
+    def is_moderator(self):
+        return self.is_owner or self.role in MODERATOR_ROLES
+
+    @property
+    def is_muted(self):
+        return self.muted_until is not None and self.muted_until > timezone.now()
+
+    def has_role(self, *roles):
+        return self.role in roles
+
+
+def access_cache_key(room_id, user_id):
+    return f"room:{room_id}:access:{user_id}"
+
+
+def _access_query(room_id, user_id):
+    membership = RoomMembership.objects.filter(room_id=OuterRef('pk'), user_id=user_id)
+    return Room.objects.filter(pk=room_id).annotate(
+        role=Subquery(membership.values('role')[:1]),
+        muted_until=Subquery(membership.values('muted_until')[:1]),
+    ).values_list('owner_id', 'role', 'muted_until')
+
+
+def get_room_access(room_id, user):
+    """The user's RoomAccess, or None if the room doesn't exist"""
+    key = access_cache_key(room_id, user.id)
+    row = cache.get(key)
+    if row is None:
+        row = _access_query(room_id, user.id).first()
+        if row is None:
+            return None
+        cache.set(key, row, ACCESS_CACHE_TTL)
+    return RoomAccess(room_id, user.id, *row)
+
+
+async def aget_room_access(room_id, user):
+    key = access_cache_key(room_id, user.id)
+    row = await cache.aget(key)
+    if row is None:
+        row = await _access_query(room_id, user.id).afirst()
+        if row is None:
+            return None
+        await cache.aset(key, row, ACCESS_CACHE_TTL)
+    return RoomAccess(room_id, user.id, *row)
+
+
+def _memo(request):
+    # DRF wraps the Django request; memoize on the one both of them share
+    request = getattr(request, '_request', request)
+    if not hasattr(request, '_room_access'):
+        request._room_access = {}
+    return request._room_access
+
+
+def resolve_access(request, room_id):
+    """The requesting user's RoomAccess; raises Http404 if the room doesn't exist"""
+    memo = _memo(request)
+    key = str(room_id)
+    if key not in memo:
+        memo[key] = get_room_access(room_id, request.user)
+    if memo[key] is None:
+        raise Http404("No Room matches the given query.")
+    return memo[key]
+
+
+async def aresolve_access(request, room_id):
+    memo = _memo(request)
+    key = str(room_id)
+    if key not in memo:
+        memo[key] = await aget_room_access(room_id, request.user)
+    if memo[key] is None:
+        raise Http404("No Room matches the given query.")
+    return memo[key]
+
+
+def invalidate_access(room_id, user_id):
+    cache.delete(access_cache_key(room_id, user_id))
+
+
+async def ainvalidate_access(room_id, user_id):
+    await cache.adelete(access_cache_key(room_id, user_id))
@@ -1,11 +1,13 @@
 from django.contrib import admin
-from .models import Room, RoomMembership, Message, PomodoroSession, RoomFile
+from .models import Room, RoomMembership, Message, PomodoroSession, RoomFile, UploadSession, FileBlob, OutboxEvent, WaitlistEntry
 
 # Register your models here.
 admin.site.register(Room)
 admin.site.register(RoomMembership)
 admin.site.register(Message)
 admin.site.register(PomodoroSession)
+admin.site.register(UploadSession)
+admin.site.register(WaitlistEntry)
 
 
 @admin.register(RoomFile)
@@ -15,3 +17,17 @@ class RoomFileAdmin(admin.ModelAdmin):
     search_fields = ['original_filename', 'description', 'room__name', 'uploaded_by__username']
     readonly_fields = ['id', 'file_size', 'file_type', 'download_count', 'created_at']
     ordering = ['-created_at']
+
+
+@admin.register(FileBlob)
+class FileBlobAdmin(admin.ModelAdmin):
+    list_display = ['sha256', 'size', 'ref_count', 'created_at']
+    readonly_fields = ['sha256', 'file', 'size', 'ref_count', 'created_at']
+    ordering = ['-created_at']
+
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ['id', 'group', 'attempts', 'available_at', 'created_at']
+    readonly_fields = ['group', 'payload', 'attempts', 'created_at']
+    ordering = ['id']
@@ -0,0 +1,139 @@
+"""
+Room admission: joining, leaving and the waitlist.
+
+`Room.member_count` mirrors the number of memberships, so a join doesn't
+have to count them, and it doubles as the seat lock. A join takes a seat
+with an UPDATE that only matches while `member_count < capacity`, in the
+same transaction as the membership insert, so concurrent joins can't
+overfill a room. When a seat is given back the longest-waiting user on the
+room's waitlist, if any, is admitted in that same transaction.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+
+from utils.encryption_service import EncryptionService
+from .access import invalidate_access
+from .models import Message, Room, RoomMembership, WaitlistEntry
+from .outbox import enqueue_broadcast
+
+
+class RoomFull(Exception):
+    pass
+
+
+def take_seat(room_id):
+    """Count one more member if the room has space; True on success"""
+    return bool(
+        Room.objects.filter(pk=room_id, member_count__lt=F('capacity'))
+        .update(member_count=F('member_count') + 1)
+    )
+
+
+def release_seat(room_id):
+    Room.objects.filter(pk=room_id).update(member_count=Greatest(F('member_count') - 1, 0))
+
+
+def announce_membership(room_id, user, message_type):
+    """Record the 'joined' / 'left' system message and queue its broadcast"""
+    verb = 'joined' if message_type == 'join' else 'left'
+    content = f"{user.username} {verb} the room"
+    sys_msg = Message.objects.create(
+        room_id=room_id,
+        sender=None, # System Sender
+        ciphertext=EncryptionService.encrypt(content, room_id),
+        message_type=message_type
+    )
+    enqueue_broadcast(room_id, {
+        'type': 'chat_message',
+        'content': content,
+        'username': 'System',
+        'id': str(sys_msg.id),
+        'sender_id': None,
+        'message_type': message_type,
+        'created_at': sys_msg.created_at.isoformat()
+    })
+
+
+def _admit(room_id, user, role):
+    membership = RoomMembership.objects.create(room_id=room_id, user=user, role=role)
+    WaitlistEntry.objects.filter(room_id=room_id, user=user).delete()
+    announce_membership(room_id, user, 'join')
+    transaction.on_commit(lambda: invalidate_access(room_id, user.id))
+    return membership
+
+
+def join_room(room, user, role='member'):
+    """
+    Make `user` a member of `room`; returns (membership, created). Raises
+    RoomFull when there is no free seat.
+    """
+    try:
+        with transaction.atomic():
+            membership = RoomMembership.objects.filter(room=room, user=user).first()
+            if membership:
+                return membership, False
+            if not take_seat(room.id):
+                raise RoomFull()
+            return _admit(room.id, user, role), True
+    except IntegrityError:
+        # A concurrent join by the same user won; its seat is the one counted
+        return RoomMembership.objects.get(room=room, user=user), False
+
+
+def remove_member(room_id, user_id):
+    """
+    Delete a membership and hand its seat to the next user on the waitlist.
+    Returns False if there was no such membership.
+    """
+    with transaction.atomic():
+        deleted, _ = RoomMembership.objects.filter(room_id=room_id, user_id=user_id).delete()
+        if not deleted:
+            return False
+        release_seat(room_id)
+        transaction.on_commit(lambda: invalidate_access(room_id, user_id))
+        admit_waitlisted(room_id)
+    return True
+
+
+def admit_waitlisted(room_id):
+    """Admit waiting users, oldest first, while the room has free seats"""
+    admitted = 0
+    with transaction.atomic():
+        while True:
+            entry = (
+                WaitlistEntry.objects.select_for_update(skip_locked=True)
+                .select_related('user').filter(room_id=room_id)
+                .order_by('created_at', 'id').first()
+            )
+            if entry is None:
+                return admitted
+            if RoomMembership.objects.filter(room_id=room_id, user_id=entry.user_id).exists():
+                entry.delete()
+                continue
+            if not take_seat(room_id):
+                return admitted
+            _admit(room_id, entry.user, 'member')
+            admitted += 1
+
+
+def join_waitlist(room, user):
+    """
+    Queue `user` for a seat in `room`. Returns their position in the queue,
+    or None if a seat was free after all and they were admitted.
+    """
+    with transaction.atomic():
+        WaitlistEntry.objects.get_or_create(room=room, user=user)
+        # A seat may have been given back since the join attempt failed
+        admit_waitlisted(room.id)
+        entry = WaitlistEntry.objects.filter(room=room, user=user).first()
+        if entry is None:
+            return None
+        return WaitlistEntry.objects.filter(room=room).filter(
+            Q(created_at__lt=entry.created_at) | Q(created_at=entry.created_at, id__lte=entry.id)
+        ).count()
+
+
+def leave_waitlist(room_id, user):
+    deleted, _ = WaitlistEntry.objects.filter(room_id=room_id, user=user).delete()
+    return bool(deleted)
@@ -0,0 +1,397 @@
+"""
+Cold archive of old room history.
+
+The archive_messages command moves a room's messages out of the table into
+segment files under MESSAGE_ARCHIVE_ROOT/<room_id>/. It takes messages older
+than MESSAGE_ARCHIVE_AFTER_DAYS, but never the room's MESSAGE_ARCHIVE_MIN_HOT
+newest. Content stays encrypted as stored: a Fernet token as it is, binary
+ciphertext base64-encoded.
+
+A segment holds up to SEGMENT_SIZE messages, newest first, in zlib-compressed
+blocks of BLOCK_SIZE. A sparse index at the end of the file gives each
+block's offset, length, count, and newest and oldest created_at. A
+MessageSegment row catalogs every file with its count and time range.
+
+Messages are archived oldest first, so a room's archived messages are always
+older than the ones still in the table. Its history, newest first, is
+therefore the table's rows followed by its segments (see RoomHistory). A page
+that reaches into the archive:
+- finds its segment from the catalog counts;
+- finds its blocks from the sparse index;
+- decompresses only those blocks from a memory-mapped file.
+
+Archived messages are read-only: edits, deletions and reactions sent for them
+find nothing to change. Their reactions and read receipts stay in the table
+and apply again once restore_archived_messages puts the messages back.
+"""
+import base64
+import json
+import mmap
+import os
+import shutil
+import struct
+import uuid
+import zlib
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone as dt_timezone
+from functools import lru_cache
+from itertools import accumulate
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+
+from .models import Message, MessageSegment, Room, RoomFile
+from .partitions import ensure_partitions_between
+
+# Messages per segment file, and per compressed block within one
+SEGMENT_SIZE = 20000
+BLOCK_SIZE = 200
+
+MAGIC = b'STMSG1'
+# At the very end of a segment: the sparse index's length, then MAGIC
+TRAILER = struct.Struct('<Q6s')
+
+# What a segment keeps of each message, in order
+FIELDS = (
+    'id', 'created_at', 'updated_at', 'sender_id', 'message_type', 'is_edited',
+    'replied_to_id', 'file_id', 'content', 'ciphertext',
+)
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def to_micros(moment):
+    return (moment - _EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(micros):
+    return _EPOCH + timedelta(microseconds=micros)
+
+
+def segment_path(path):
+    return settings.MESSAGE_ARCHIVE_ROOT / path
+
+
+def encode_row(row):
+    """A Message values_list(*FIELDS) row, as stored in a segment"""
+    (msg_id, created_at, updated_at, sender_id, message_type, is_edited,
+     replied_to_id, file_id, content, ciphertext) = row
+    return [
+        str(msg_id), to_micros(created_at), to_micros(updated_at), sender_id, message_type, is_edited,
+        str(replied_to_id) if replied_to_id else None, str(file_id) if file_id else None, content,
+        base64.b64encode(ciphertext).decode() if ciphertext is not None else None,
+    ]
+
+
+def decode_row(room_id, row):
+    """An unsaved Message from a segment row"""
+    if len(row) < len(FIELDS):
+        row = [*row, None]  # written before the binary ciphertext format
+    (msg_id, created_at, updated_at, sender_id, message_type, is_edited,
+     replied_to_id, file_id, content, ciphertext) = row
+    message = Message(
+        id=uuid.UUID(msg_id), room_id=room_id, created_at=from_micros(created_at),
+        updated_at=from_micros(updated_at), sender_id=sender_id, message_type=message_type,
+        is_edited=is_edited, replied_to_id=replied_to_id and uuid.UUID(replied_to_id),
+        file_id=file_id and uuid.UUID(file_id), content=content,
+        ciphertext=base64.b64decode(ciphertext) if ciphertext is not None else None,
+    )
+    message._state.adding = False
+    return message
+
+
+def write_segment(path, rows):
+    """Write encoded rows, newest first, to a new segment file"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_suffix('.partial')
+    blocks = []
+    with open(partial, 'wb') as f:
+        for start in range(0, len(rows), BLOCK_SIZE):
+            block = rows[start:start + BLOCK_SIZE]
+            data = zlib.compress(json.dumps(block, separators=(',', ':')).encode())
+            blocks.append([f.tell(), len(data), len(block), block[0][1], block[-1][1]])
+            f.write(data)
+        index = json.dumps({'count': len(rows), 'blocks': blocks}).encode()
+        f.write(index)
+        f.write(TRAILER.pack(len(index), MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial, path)
+    return path.stat().st_size
+
+
+class SegmentReader:
+    """A memory-mapped segment file; blocks are decompressed as they are read"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        index_length, magic = TRAILER.unpack(self.map[-TRAILER.size:])
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a message segment")
+        index = json.loads(self.map[-TRAILER.size - index_length:-TRAILER.size])
+        self.count = index['count']
+        self.blocks = index['blocks']
+        # Position of each block's first row
+        self.starts = list(accumulate((block[2] for block in self.blocks), initial=0))
+
+    def block(self, number):
+        offset, length = self.blocks[number][:2]
+        return json.loads(zlib.decompress(self.map[offset:offset + length]))
+
+    def rows(self, start, stop):
+        """Rows start to stop, newest first"""
+        rows = []
+        for number in range(max(bisect_right(self.starts, start) - 1, 0), len(self.blocks)):
+            first = self.starts[number]
+            if first >= stop:
+                break
+            rows += self.block(number)[max(start - first, 0):stop - first]
+        return rows
+
+    def position_before(self, micros):
+        """Position of the newest row created before `micros`"""
+        for number, (offset, length, count, newest, oldest) in enumerate(self.blocks):
+            if oldest >= micros:
+                continue
+            if newest < micros:
+                return self.starts[number]
+            for position, row in enumerate(self.block(number)):
+                if row[1] < micros:
+                    return self.starts[number] + position
+        return self.count
+
+
+@lru_cache(maxsize=128)
+def open_segment(path):
+    """Segments never change once written, so their mappings are kept around"""
+    return SegmentReader(segment_path(path))
+
+
+class RoomHistory:
+    """
+    A room's messages newest first: the table's rows (`queryset`, ordered by
+    -created_at), then the archived ones. Countable and sliceable, as
+    Django's Paginator expects. `before` and `after` bound created_at as
+    the view's filters do.
+    """
+
+    def __init__(self, queryset, room_id, before=None, after=None):
+        self.queryset = queryset
+        self.room_id = room_id
+        self._hot_count = None
+        segments = MessageSegment.objects.filter(room_id=room_id).order_by('-newest_at')
+        if before:
+            segments = segments.filter(oldest_at__lt=before)
+        if after:
+            segments = segments.filter(newest_at__gte=after)
+        # (segment, first, stop) of the rows inside the range
+        self.segments = []
+        for segment in segments:
+            first, stop = 0, segment.message_count
+            if before and segment.newest_at >= before:
+                first = open_segment(segment.path).position_before(to_micros(before))
+            if after and segment.oldest_at < after:
+                stop = open_segment(segment.path).position_before(to_micros(after))
+            if stop > first:
+                self.segments.append((segment, first, stop))
+        self.archived_count = sum(stop - first for segment, first, stop in self.segments)
+
+    def hot_count(self):
+        if self._hot_count is None:
+            self._hot_count = self.queryset.count()
+        return self._hot_count
+
+    def count(self):
+        return self.hot_count() + self.archived_count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            raise TypeError("RoomHistory only supports slicing")
+        start, stop, step = index.indices(self.count())
+        hot = self.hot_count()
+        messages = list(self.queryset[start:min(stop, hot)]) if start < hot else []
+        if stop > hot:
+            messages += self.archived(max(start - hot, 0), stop - hot)
+        return messages
+
+    def archived(self, start, stop):
+        """Archived messages start to stop, with their senders, files and replies loaded"""
+        rows = []
+        position = 0
+        for segment, first, last in self.segments:
+            count = last - first
+            if position + count > start and position < stop:
+                reader = open_segment(segment.path)
+                rows += reader.rows(first + max(start - position, 0), first + min(stop - position, count))
+            position += count
+            if position >= stop:
+                break
+        return attach_related([decode_row(self.room_id, row) for row in rows])
+
+
+def attach_related(messages, replies=True):
+    """Load what MessageSerializer reads of unsaved messages, a query per relation"""
+    senders = get_user_model().objects.in_bulk({m.sender_id for m in messages if m.sender_id})
+    files = RoomFile.objects.in_bulk({m.file_id for m in messages if m.file_id})
+    replied_to = {}
+    if replies:
+        replied_to = {message.id: message for message in messages}
+        replied_to.update(Message.objects.in_bulk({m.replied_to_id for m in messages if m.replied_to_id} - set(replied_to)))
+    for message in messages:
+        # Senders and files deleted since read as missing rather than raising
+        message.sender = senders.get(message.sender_id)
+        message.file = files.get(message.file_id)
+        if message.replied_to_id in replied_to:
+            message.replied_to = replied_to[message.replied_to_id]
+    return messages
+
+
+def iter_archived(room_id):
+    """The room's archived messages oldest first, one block of unsaved Messages at a time"""
+    for segment in MessageSegment.objects.filter(room_id=room_id).order_by('oldest_at'):
+        reader = open_segment(segment.path)
+        for number in reversed(range(len(reader.blocks))):
+            yield [decode_row(room_id, row) for row in reversed(reader.block(number))]
+
+
+def _delete_messages(message_ids, oldest, newest, batch_size=500):
+    """
+    Plain DELETEs: going through the ORM would cascade to the reactions and
+    read receipts and unlink replies, which the archive keeps. The time
+    bounds let PostgreSQL skip partitions of other months.
+    """
+    table = connection.ops.quote_name(Message._meta.db_table)
+    created_at = Message._meta.get_field('created_at')
+    bounds = [created_at.get_db_prep_value(moment, connection) for moment in (oldest, newest)]
+    for start in range(0, len(message_ids), batch_size):
+        batch = message_ids[start:start + batch_size]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {table} WHERE created_at >= %s AND created_at <= %s "
+                f"AND id IN ({', '.join(['%s'] * len(batch))})",
+                bounds + [Message._meta.pk.get_db_prep_value(message_id, connection) for message_id in batch],
+            )
+
+
+def archive_room(room_id, cutoff, min_hot=None):
+    """
+    Move the room's messages created before `cutoff` into new segments,
+    leaving its `min_hot` newest in the table; returns how many moved
+    """
+    min_hot = settings.MESSAGE_ARCHIVE_MIN_HOT if min_hot is None else min_hot
+    threshold = cutoff
+    if min_hot:
+        newest = Message.objects.filter(room_id=room_id).order_by('-created_at').values_list('created_at', flat=True)
+        oldest_kept = newest[min_hot - 1:min_hot].first()
+        if oldest_kept is None:
+            return 0  # not that many messages yet
+        threshold = min(cutoff, oldest_kept)
+
+    archived = 0
+    while True:
+        with transaction.atomic():
+            # Oldest first, so a run cut short still leaves every archived
+            # message older than every message left in the table
+            rows = list(
+                Message.objects.select_for_update()
+                .filter(room_id=room_id, created_at__lt=threshold)
+                .order_by('created_at', 'id')
+                .values_list(*FIELDS)[:SEGMENT_SIZE]
+            )
+            if not rows:
+                return archived
+            encoded = [encode_row(row) for row in reversed(rows)]
+            relative = f"{room_id}/{uuid.uuid4()}.seg"
+            path = segment_path(relative)
+            try:
+                size = write_segment(path, encoded)
+                MessageSegment.objects.create(
+                    room_id=room_id, path=relative, message_count=len(rows), size=size,
+                    newest_at=rows[-1][1], oldest_at=rows[0][1],
+                )
+                _delete_messages([row[0] for row in rows], rows[0][1], rows[-1][1])
+            except BaseException:
+                path.unlink(missing_ok=True)
+                raise
+        archived += len(rows)
+
+
+def restore_segment(segment):
+    """Put a segment's messages back in the table and drop the segment"""
+    reader = open_segment(segment.path)
+    messages = [decode_row(segment.room_id, row) for row in reader.rows(0, reader.count)]
+    # Inserted as they are: the ORM would stamp created_at and updated_at afresh
+    fields = Message._meta.concrete_fields
+    table = connection.ops.quote_name(Message._meta.db_table)
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+    sql = f"INSERT INTO {table} ({columns}) VALUES ({', '.join(['%s'] * len(fields))})"
+    ensure_partitions_between(segment.oldest_at, segment.newest_at)
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, [
+                [field.get_db_prep_save(getattr(message, field.attname), connection) for field in fields]
+                for message in messages
+            ])
+        segment.delete()
+        transaction.on_commit(lambda: segment_path(segment.path).unlink(missing_ok=True))
+    return len(messages)
+
+
+def restore_room(room_id, since=None):
+    """
+    Restore the room's segments holding messages from `since` on (all of them
+    by default), newest first so the archive stays older than the table;
+    returns how many messages came back
+    """
+    segments = MessageSegment.objects.filter(room_id=room_id).order_by('-newest_at')
+    if since:
+        segments = segments.filter(newest_at__gte=since)
+    return sum(restore_segment(segment) for segment in segments)
+
+
+def remove_room_archive(room_id):
+    """Delete a deleted room's segment files (see rooms/purge.py)"""
+    shutil.rmtree(settings.MESSAGE_ARCHIVE_ROOT / str(room_id), ignore_errors=True)
+
+
+def rebuild_segment_catalog(dry_run=False):
+    """
+    Catalog segment files that have no MessageSegment row, e.g. after the
+    database was restored from a backup older than the archive. Files whose
+    messages are still in the table, left over from an interrupted archive
+    run, and files of deleted rooms are removed. Returns (cataloged, removed, missing), where
+    `missing` lists catalog rows whose file is gone.
+    """
+    root = settings.MESSAGE_ARCHIVE_ROOT
+    known = set(MessageSegment.objects.values_list('path', flat=True))
+    cataloged = removed = 0
+    for path in sorted(root.glob('*/*.seg')) if root.exists() else []:
+        relative = f"{path.parent.name}/{path.name}"
+        if relative in known:
+            continue
+        # Rooms awaiting their purge still count: it reads their segments
+        if not Room.all_objects.filter(id=path.parent.name).exists():
+            # Left behind by a deleted room
+            if not dry_run:
+                path.unlink()
+            removed += 1
+            continue
+        reader = SegmentReader(path)
+        newest, oldest = reader.rows(0, 1)[0], reader.rows(reader.count - 1, reader.count)[0]
+        if Message.objects.filter(id=newest[0]).exists():
+            if not dry_run:
+                path.unlink()
+            removed += 1
+            continue
+        if not dry_run:
+            MessageSegment.objects.create(
+                room_id=path.parent.name, path=relative, message_count=reader.count,
+                newest_at=from_micros(newest[1]), oldest_at=from_micros(oldest[1]), size=path.stat().st_size,
+            )
+        cataloged += 1
+    missing = [path for path in known if not segment_path(path).exists()]
+    return cataloged, removed, missing
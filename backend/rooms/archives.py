@@ -0,0 +1,101 @@
+"""
+Zip archives of room files, streamed as they are built.
+
+zipfile can write to a stream that doesn't support seeking: each entry's
+sizes and CRC then follow its data in a trailing data descriptor instead of
+being patched into the header afterwards. That lets us push every entry
+through a small in-memory sink and hand the bytes to the response as soon as
+they're produced, so memory stays at roughly one read block no matter how
+large the room's files are, and nothing touches a temp file.
+"""
+import logging
+import os
+import zipfile
+
+from django.utils import timezone
+
+from .downloads import STREAM_BLOCK_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Deflating these again costs CPU for next to no gain, so they're stored as-is
+COMPRESSED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp',
+    '.mp3', '.mp4', '.ogg', '.m4a',
+    '.zip', '.rar', '.7z', '.gz', '.bz2', '.xz',
+    '.docx', '.xlsx', '.pptx', '.odt',
+}
+
+
+class _StreamSink:
+    """Write-only, non-seekable target that zipfile writes into and we drain"""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def archive_entry_name(filename, taken):
+    """A safe, unique path inside the archive for `filename`"""
+    name = os.path.basename(filename.replace('\\', '/')) or 'file'
+    stem, ext = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate.lower() in taken:
+        n += 1
+        candidate = f"{stem} ({n}){ext}"
+    taken.add(candidate.lower())
+    return candidate
+
+
+def _zip_info(room_file, arcname):
+    created = timezone.localtime(room_file.created_at)
+    info = zipfile.ZipInfo(arcname, date_time=created.timetuple()[:6])
+    if room_file.file_extension in COMPRESSED_EXTENSIONS:
+        info.compress_type = zipfile.ZIP_STORED
+    else:
+        info.compress_type = zipfile.ZIP_DEFLATED
+    # Lets zipfile decide up front whether the entry needs ZIP64 fields
+    info.file_size = room_file.file_size
+    return info
+
+
+def iter_zip_archive(room_files, block_size=STREAM_BLOCK_SIZE):
+    """
+    Yield the bytes of a zip containing `room_files`.
+
+    Files missing from storage are skipped rather than failing the download,
+    since by the time one is reached the response has already started.
+    """
+    sink = _StreamSink()
+    taken = set()
+    with zipfile.ZipFile(sink, mode='w', allowZip64=True) as archive:
+        for room_file in room_files:
+            try:
+                source = room_file.file.storage.open(room_file.file.name, 'rb')
+            except OSError:
+                logger.warning("Skipping %s in archive: not found in storage", room_file.file.name)
+                continue
+
+            info = _zip_info(room_file, archive_entry_name(room_file.original_filename, taken))
+            with source, archive.open(info, mode='w') as entry:
+                for data in iter(lambda: source.read(block_size), b''):
+                    entry.write(data)
+                    chunk = sink.drain()
+                    if chunk:
+                        yield chunk
+            # Compressor tail and data descriptor
+            yield sink.drain()
+
+    # Central directory, written when the archive closes
+    yield sink.drain()
@@ -0,0 +1,118 @@
+"""
+Content-addressed blob store for room files.
+
+Every distinct file body is stored once, keyed by its SHA-256, and shared by
+all RoomFile rows that uploaded the same bytes. `ref_count` tracks those rows;
+the stored file is only removed once the last reference is released.
+
+Take a reference and create the RoomFile holding it in one transaction, so
+`reconcile_blob_refs` never sees a reference without its row.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+
+from .models import FileBlob, RoomFile
+from .quotas import credit_storage
+from .thumbnails import delete_derivatives
+
+
+def acquire_blob(sha256):
+    """Take a reference on an existing blob, or return None if it isn't stored"""
+    with transaction.atomic():
+        if not FileBlob.objects.filter(sha256=sha256).update(ref_count=F('ref_count') + 1):
+            return None
+        return FileBlob.objects.get(sha256=sha256)
+
+
+def store_blob(content, sha256, size):
+    """
+    Return a referenced blob for `content`, writing it to storage only if
+    no blob with this digest exists yet.
+    """
+    blob = acquire_blob(sha256)
+    if blob:
+        return blob
+
+    blob = FileBlob(sha256=sha256, size=size, ref_count=1)
+    blob.file.save(sha256, content, save=False)
+    try:
+        with transaction.atomic():
+            blob.save(force_insert=True)
+    except IntegrityError:
+        # A concurrent upload of the same bytes won the race. Storage gave our
+        # copy a distinct name, so it's safe to drop it and share theirs.
+        blob.file.delete(save=False)
+        blob = acquire_blob(sha256)
+    return blob
+
+
+def release_blob(blob):
+    """Drop one reference; delete the row and stored file when none remain"""
+    with transaction.atomic():
+        blob = FileBlob.objects.select_for_update().get(pk=blob.pk)
+        if blob.ref_count > 1:
+            FileBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') - 1)
+            return False
+
+        name = blob.file.name
+        storage = blob.file.storage
+        blob.delete()
+        # Only touch the disk once the row is really gone
+        transaction.on_commit(lambda: _delete_stored(storage, name))
+        return True
+
+
+def _delete_stored(storage, name):
+    storage.delete(name)
+    delete_derivatives(storage, name)
+
+
+def release_room_file(room_file):
+    """Delete a RoomFile row and its stored bytes (or its blob reference)"""
+    with transaction.atomic():
+        blob = room_file.blob
+        credit_storage(room_file.room_id, room_file.file_size)
+        room_file.delete()
+        if blob:
+            release_blob(blob)
+        elif room_file.file:
+            # Files uploaded before deduplication own their storage outright
+            storage, name = room_file.file.storage, room_file.file.name
+            transaction.on_commit(lambda: _delete_stored(storage, name))
+
+
+def reconcile_blob_refs(batch_size=500):
+    """
+    Reset ref_counts to the number of RoomFile rows actually using each blob,
+    releasing blobs nothing uses any more (e.g. after a room was deleted and
+    its files cascaded away). Returns (corrected, released).
+    """
+    corrected = released = 0
+    last_pk = None
+    while True:
+        blobs = FileBlob.objects.order_by('pk')
+        if last_pk:
+            blobs = blobs.filter(pk__gt=last_pk)
+        batch = list(blobs.annotate(refs=Count('room_files')).values_list('pk', 'ref_count', 'refs')[:batch_size])
+        if not batch:
+            return corrected, released
+        last_pk = batch[-1][0]
+
+        for sha256, ref_count, refs in batch:
+            if ref_count == refs:
+                continue
+            with transaction.atomic():
+                blob = FileBlob.objects.select_for_update().filter(pk=sha256).first()
+                if blob is None:
+                    continue
+                # Recount under the lock; uploads hold it until their row commits
+                refs = RoomFile.objects.filter(blob_id=sha256).count()
+                if refs:
+                    if refs != blob.ref_count:
+                        FileBlob.objects.filter(pk=sha256).update(ref_count=refs)
+                        corrected += 1
+                    continue
+                name, storage = blob.file.name, blob.file.storage
+                blob.delete()
+                transaction.on_commit(lambda: _delete_stored(storage, name))
+                released += 1
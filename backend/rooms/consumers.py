@@ -1,11 +1,49 @@
 import json
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.core.cache import cache
-
-from .models import Room, Message
+from django.db import InterfaceError, OperationalError, close_old_connections
+from django.db.models import Count, Exists, OuterRef, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from analytics.activity import arecord_join, arecord_message
+from .access import RoomAccess, aget_room_access, ainvalidate_access, get_room_access
+from .admission import admit_waitlisted, remove_member
+from .latency import REPORT_INTERVAL, aforget_latency, arecord_latency
+from .presence import presence_key
+from .models import Room, Message, MessageSeen, Reaction, RoomMembership
 from utils.encryption_service import EncryptionService
 
+# Events that change something in the room; refused once it is deleted
+WRITE_EVENTS = {
+    'chat_message', 'edit_message', 'delete_message', 'mark_seen', 'add_reaction', 'remove_reaction',
+    'kick_user', 'promote_user', 'update_room_settings', 'mute_user',
+}
+# Clients may pass created_at with less precision than it is stored with
+CREATED_AT_SLACK = timedelta(seconds=1)
+
+
+def message_lookup(message_id, created_at=None):
+    """
+    Filter for one message by id and, when the client sends the created_at it
+    has for it, by time too, so PostgreSQL only searches that month's
+    partition (see rooms/partitions.py) instead of every partition's index
+    """
+    lookup = Q(id=message_id)
+    try:
+        when = parse_datetime(created_at) if isinstance(created_at, str) else None
+    except ValueError:
+        when = None
+    if when is not None and when.tzinfo is not None:
+        lookup &= Q(created_at__range=(when - CREATED_AT_SLACK, when + CREATED_AT_SLACK))
+    return lookup
+
+
 class RoomConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_id = self.scope['url_route']['kwargs']['room_id']
@@ -16,6 +54,12 @@ class RoomConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
 
+        # Also None for a deleted room, which Room.objects no longer finds
+        self.access = await aget_room_access(self.room_id, self.user)
+        if self.access is None:
+            await self.close()
+            return
+
         # Join room group
         await self.channel_layer.group_add(
             self.room_group_name,
@@ -32,32 +76,57 @@ class RoomConsumer(AsyncWebsocketConsumer):
         await self.accept()
 
         # Handle Presence
-        await self.add_user_to_room(self.room_id, self.user)
-        await self.broadcast_presence()
+        users = await self.add_user_to_room(self.room_id, self.user)
+        await self.broadcast_presence(users)
+        await arecord_join(self.room_id, self.user.id, len(users))
 
     async def disconnect(self, close_code):
+        if not hasattr(self, 'user_group_name'):
+            return  # refused in connect, before joining anything
         if self.user.is_authenticated:
-            await self.remove_user_from_room(self.room_id, self.user)
-            await self.broadcast_presence()
+            users = await self.remove_user_from_room(self.room_id, self.user)
+            await self.broadcast_presence(users)
 
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        if getattr(self, 'latency_reported_at', None) is not None:
+            await aforget_latency(self.channel_name)
         if self.user.is_authenticated:
             await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
 
     async def receive(self, text_data):
-        data = json.loads(text_data)
+        # Taken first thing, as the receive time of a clock_ping
+        received_at = time.time() * 1000
+        # As database_sync_to_async did: the async ORM won't notice a dropped
+        # or expired connection by itself, so check before every event
+        await sync_to_async(close_old_connections)()
+        try:
+            await self.dispatch_event(json.loads(text_data), received_at)
+        except (InterfaceError, OperationalError):
+            await sync_to_async(close_old_connections)()
+            raise
+
+    async def dispatch_event(self, data, received_at=None):
         message_type = data.get('type', 'chat_message') # Default to chat for backward compat
+        self.access = None  # looked up again, at most once per event
+
+        if message_type in WRITE_EVENTS and (await self.get_access()).owner_id is None:
+            # Deleted while this socket was open; room_deleted closes it too
+            await self.send_error('This room has been deleted')
+            await self.close()
+            return
 
-        if message_type == 'chat_message':
+        if message_type == 'clock_ping':
+            await self.handle_clock_ping(data, received_at)
+        elif message_type == 'chat_message':
             # Support 'message' key for backward compatibility
             content = data.get('content') or data.get('message')
             replied_to_id = data.get('replied_to_id')  # Optional: ID of message being replied to
             if content:
-                await self.handle_chat_message(content, replied_to_id)
+                await self.handle_chat_message(content, replied_to_id, data.get('replied_to_created_at'))
         elif message_type == 'edit_message':
-            await self.handle_edit_message(data.get('message_id'), data.get('content'))
+            await self.handle_edit_message(data.get('message_id'), data.get('content'), data.get('created_at'))
         elif message_type == 'delete_message':
-            await self.handle_delete_message(data.get('message_id'))
+            await self.handle_delete_message(data.get('message_id'), data.get('created_at'))
         elif message_type == 'typing':
             await self.handle_typing(data.get('is_typing', False))
         elif message_type == 'mark_seen':
@@ -79,23 +148,54 @@ class RoomConsumer(AsyncWebsocketConsumer):
         elif message_type == 'mute_user':
             await self.handle_mute_user(data.get('user_id'), data.get('duration'))
 
-    async def handle_chat_message(self, content, replied_to_id=None):
+    async def handle_clock_ping(self, data, received_at):
+        """
+        NTP-style clock sync. The client sends its clock as t0 and gets back
+        the server's receive (t1) and send (t2) times, all in epoch
+        milliseconds. Taking t3 on arrival it estimates
+            round trip = (t3 - t0) - (t2 - t1)
+            offset     = ((t1 - t0) + (t2 - t3)) / 2
+        and reports the last estimates with its next ping as `rtt` and
+        `offset`, which are kept as latency telemetry.
+        """
+        t0 = data.get('t0')
+        if not isinstance(t0, (int, float)):
+            await self.send_error('clock_ping needs the client time as t0')
+            return
+        await self.send(text_data=json.dumps({
+            'type': 'clock_pong',
+            't0': t0,
+            't1': received_at if received_at is not None else time.time() * 1000,
+            't2': time.time() * 1000,
+        }))
+
+        rtt, offset = data.get('rtt'), data.get('offset')
+        if not isinstance(rtt, (int, float)) or not isinstance(offset, (int, float)) or not 0 <= rtt < 60000:
+            return
+        now = time.monotonic()
+        last_reported = getattr(self, 'latency_reported_at', None)
+        if last_reported is None or now - last_reported >= REPORT_INTERVAL:
+            self.latency_reported_at = now
+            await arecord_latency(self.channel_name, self.room_id, self.user.id, rtt, offset)
+
+    async def handle_chat_message(self, content, replied_to_id=None, replied_to_created_at=None):
         # Check if user is muted
-        is_muted = await self.is_user_muted()
-        if is_muted:
+        access = await self.get_access()
+        if access.is_muted:
             await self.send_error('You are currently muted and cannot send messages')
             return
         
         # 1. Encrypt
-        encrypted_content = EncryptionService.encrypt(content)
+        encrypted_content = await EncryptionService.aencrypt(content, self.room_id)
         
         # 2. Save (with optional reply reference)
         message = await self.save_message(self.room_id, self.user, encrypted_content, replied_to_id)
+        await arecord_message(self.room_id, self.user.id)
 
         # 3. Get replied_to_message info if exists
         replied_to_message = None
         if replied_to_id:
-            replied_to_message = await self.get_replied_to_info(replied_to_id)
+            replied_to_message = await self.get_replied_to_info(replied_to_id, replied_to_created_at)
 
         # 4. Broadcast
         payload = {
@@ -115,14 +215,12 @@ class RoomConsumer(AsyncWebsocketConsumer):
         # But if we need to update "sidebar list" for users NOT in the room (e.g. unread count), we'd push to user_group_name.
         # For now, we stay simple.
 
-    async def handle_edit_message(self, message_id, new_content):
+    async def handle_edit_message(self, message_id, new_content, created_at=None):
         # 1. Verify Ownership & Update
-        message = await self.get_message(message_id)
-        if not message or message.sender_id != self.user.id:
+        encrypted_content = await EncryptionService.aencrypt(new_content, self.room_id)
+        updated = await self.update_message_content(message_id, encrypted_content, created_at)
+        if not updated:
             return # Permission denied or not found
-            
-        encrypted_content = EncryptionService.encrypt(new_content)
-        await self.update_message_content(message, encrypted_content)
 
         # 2. Broadcast Update
         await self.channel_layer.group_send(
@@ -135,14 +233,12 @@ class RoomConsumer(AsyncWebsocketConsumer):
             }
         )
 
-    async def handle_delete_message(self, message_id):
+    async def handle_delete_message(self, message_id, created_at=None):
         # 1. Verify Ownership & Delete
-        message = await self.get_message(message_id)
-        if not message or message.sender_id != self.user.id:
+        deleted = await self.delete_message(message_id, created_at)
+        if not deleted:
             return
 
-        await self.delete_message(message)
-
         # 2. Broadcast Delete
         await self.channel_layer.group_send(
             self.room_group_name,
@@ -236,14 +332,13 @@ class RoomConsumer(AsyncWebsocketConsumer):
             return
         
         # Check if current user has permission
-        has_permission = await self.check_permission(['admin', 'moderator'])
-        if not has_permission:
+        access = await self.get_access()
+        if not access.has_role('admin', 'moderator'):
             await self.send_error('You do not have permission to kick users')
             return
         
         # Check if target is room owner
-        is_owner = await self.is_room_owner(user_id)
-        if is_owner:
+        if str(access.owner_id) == str(user_id):
             await self.send_error('Cannot kick room owner')
             return
         
@@ -279,10 +374,8 @@ class RoomConsumer(AsyncWebsocketConsumer):
             return
         
         # Only admins and room owner can change roles
-        is_admin = await self.check_permission(['admin'])
-        is_owner = await self.is_current_user_owner()
-        
-        if not (is_admin or is_owner):
+        access = await self.get_access()
+        if not (access.has_role('admin') or access.is_owner):
             await self.send_error('You do not have permission to change user roles')
             return
         
@@ -311,8 +404,8 @@ class RoomConsumer(AsyncWebsocketConsumer):
         if not settings:
             return
         
-        is_owner = await self.is_current_user_owner()
-        if not is_owner:
+        access = await self.get_access()
+        if not access.is_owner:
             await self.send_error('Only room owner can update settings')
             return
         
@@ -334,14 +427,13 @@ class RoomConsumer(AsyncWebsocketConsumer):
         if not user_id:
             return
         
-        has_permission = await self.check_permission(['admin', 'moderator'])
-        if not has_permission:
+        access = await self.get_access()
+        if not access.has_role('admin', 'moderator'):
             await self.send_error('You do not have permission to mute users')
             return
         
         # Mute user
         from datetime import timedelta
-        from django.utils import timezone
         
         duration_minutes = int(duration) if duration else 10  # Default 10 minutes
         muted_until = timezone.now() + timedelta(minutes=duration_minutes)
@@ -465,6 +557,14 @@ class RoomConsumer(AsyncWebsocketConsumer):
             'data': event['data']
         }))
 
+    async def room_deleted(self, event):
+        """The room was deleted; nothing more can happen in it"""
+        await self.send(text_data=json.dumps({
+            'type': 'room_deleted',
+            'room_id': event['room_id'],
+        }))
+        await self.close()
+
     # Group Management Broadcast Handlers
     async def user_kicked(self, event):
         """Notify user they were kicked"""
@@ -521,82 +621,78 @@ class RoomConsumer(AsyncWebsocketConsumer):
         }))
 
     # Database Helpers
-    @database_sync_to_async
-    def save_message(self, room_id, user, encrypted_content, replied_to_id=None):
-        return Message.objects.create(
+    # These await the async ORM directly. Channels runs every thread-sensitive
+    # call of a process on one shared thread, so each helper is a single query
+    # and a single hop to it; lookups that used to fetch a row and then save or
+    # delete it are now conditional UPDATEs and DELETEs.
+    async def get_access(self):
+        """
+        The room's owner and the current user's role and mute (see
+        rooms/access.py); owner_id is None if the room is gone
+        """
+        if self.access is None:
+            access = await aget_room_access(self.room_id, self.user)
+            self.access = access or RoomAccess(self.room_id, self.user.id, None, None, None)
+        return self.access
+
+    async def save_message(self, room_id, user, encrypted_content, replied_to_id=None):
+        return await Message.objects.acreate(
             room_id=room_id, 
             sender=user, 
-            content=encrypted_content,
+            ciphertext=encrypted_content,
             replied_to_id=replied_to_id if replied_to_id else None
         )
 
-    @database_sync_to_async
-    def get_replied_to_info(self, message_id):
+    async def get_replied_to_info(self, message_id, created_at=None):
         """Get basic info about the message being replied to"""
-        try:
-            message = Message.objects.get(id=message_id)
-            decrypted_content = EncryptionService.decrypt(message.content)
-            return {
-                'id': str(message.id),
-                'username': message.sender.username if message.sender else 'System',
-                'message': decrypted_content,
-                'created_at': str(message.created_at)
-            }
-        except Message.DoesNotExist:
+        message = await Message.objects.filter(message_lookup(message_id, created_at)).values(
+            'id', 'content', 'ciphertext', 'sender__username', 'created_at'
+        ).afirst()
+        if message is None:
             return None
+        try:
+            stored = message['ciphertext'] if message['ciphertext'] is not None else message['content']
+            decrypted_content = await EncryptionService.adecrypt(stored)
         except Exception:
             # If decryption fails, return encrypted placeholder
-            try:
-                message = Message.objects.get(id=message_id)
-                return {
-                    'id': str(message.id),
-                    'username': message.sender.username if message.sender else 'System',
-                    'message': '[Encrypted]',
-                    'created_at': str(message.created_at)
-                }
-            except:
-                return None
-
-    @database_sync_to_async
-    def get_message(self, message_id):
-        try:
-            return Message.objects.get(id=message_id)
-        except Message.DoesNotExist:
-            return None
-
-    @database_sync_to_async
-    def update_message_content(self, message, encrypted_content):
-        message.content = encrypted_content
-        message.is_edited = True
-        message.save()
-
-    @database_sync_to_async
-    def delete_message(self, message):
-        message.delete()
+            decrypted_content = '[Encrypted]'
+        return {
+            'id': str(message['id']),
+            'username': message['sender__username'] or 'System',
+            'message': decrypted_content,
+            'created_at': str(message['created_at'])
+        }
 
-    @database_sync_to_async
-    def mark_message_seen(self, message_id, user):
-        """Mark message as seen using atomic transaction"""
-        from django.db import transaction
-        from .models import MessageSeen
-        
-        with transaction.atomic():
-            # Get or create MessageSeen record
-            MessageSeen.objects.get_or_create(
-                message_id=message_id,
-                user=user
-            )
+    async def update_message_content(self, message_id, encrypted_content, created_at=None):
+        """Edit one of the current user's messages; False if there is none"""
+        lookup = message_lookup(message_id, created_at)
+        return bool(await Message.objects.filter(lookup, sender_id=self.user.id).aupdate(
+            ciphertext=encrypted_content,
+            content='',
+            is_edited=True,
+            updated_at=timezone.now()
+        ))
+
+    async def delete_message(self, message_id, created_at=None):
+        """Delete one of the current user's messages; False if there is none"""
+        lookup = message_lookup(message_id, created_at)
+        deleted, _ = await Message.objects.filter(lookup, sender_id=self.user.id).adelete()
+        return bool(deleted)
+
+    async def mark_message_seen(self, message_id, user):
+        await MessageSeen.objects.aget_or_create(
+            message_id=message_id,
+            user=user
+        )
 
-    @database_sync_to_async
-    def add_reaction_to_db(self, message_id, user, emoji):
-        from .models import Reaction
+    async def add_reaction_to_db(self, message_id, user, emoji):
         try:
             # Basic validation
             if not message_id or not emoji:
                 return False
             
             # Use get_or_create to avoid duplicates (though model has unique constaint)
-            Reaction.objects.get_or_create(
+            await Reaction.objects.aget_or_create(
                 message_id=message_id,
                 user=user,
                 emoji=emoji
@@ -606,135 +702,58 @@ class RoomConsumer(AsyncWebsocketConsumer):
             # Catch potential integrity errors or invalid message_id
             return False
 
-    @database_sync_to_async
-    def remove_reaction_from_db(self, message_id, user, emoji):
-        from .models import Reaction
+    async def remove_reaction_from_db(self, message_id, user, emoji):
         try:
-            reaction = Reaction.objects.filter(
+            deleted, _ = await Reaction.objects.filter(
                 message_id=message_id,
                 user=user,
                 emoji=emoji
-            ).first()
-            if reaction:
-                reaction.delete()
-                return True
-            return False
+            ).adelete()
+            return bool(deleted)
         except Exception:
             return False
 
-    @database_sync_to_async
-    def get_unread_count(self, user, room_id):
+    async def get_unread_count(self, user, room_id):
         """Calculate unread messages for user in room"""
-        from .models import MessageSeen
-        
-        # Get all messages in room
-        total_messages = Message.objects.filter(room_id=room_id).exclude(sender=user).count()
-        
-        # Get messages seen by user
-        seen_messages = MessageSeen.objects.filter(
-            user=user,
-            message__room_id=room_id
-        ).count()
-        
-        return total_messages - seen_messages
+        counts = await Message.objects.filter(room_id=room_id).aaggregate(
+            # Messages from others, and the ones the user has seen
+            total=Count('id', filter=~Q(sender=user)),
+            seen=Count('id', filter=Exists(MessageSeen.objects.filter(message=OuterRef('pk'), user=user))),
+        )
+        return counts['total'] - counts['seen']
 
     # Group Management Database Helpers
-    @database_sync_to_async
-    def check_permission(self, required_roles):
-        """Check if current user has one of the required roles"""
-        from .models import RoomMembership
-        try:
-            membership = RoomMembership.objects.get(room_id=self.room_id, user=self.user)
-            return membership.role in required_roles
-        except RoomMembership.DoesNotExist:
-            return False
-
-    @database_sync_to_async
-    def is_current_user_owner(self):
-        """Check if current user is room owner"""
-        try:
-            room = Room.objects.get(id=self.room_id)
-            return room.owner_id == self.user.id
-        except Room.DoesNotExist:
-            return False
-
-    @database_sync_to_async
-    def is_room_owner(self, user_id):
-        """Check if specified user is room owner"""
-        try:
-            room = Room.objects.get(id=self.room_id)
-            return str(room.owner_id) == str(user_id)
-        except Room.DoesNotExist:
-            return False
-
-    @database_sync_to_async
-    def remove_user_from_room_by_id(self, user_id):
-        """Remove a user from the room by user ID"""
-        from .models import RoomMembership
-        try:
-            membership = RoomMembership.objects.get(room_id=self.room_id, user_id=user_id)
-            membership.delete()
-            return True
-        except RoomMembership.DoesNotExist:
-            return False
+    async def remove_user_from_room_by_id(self, user_id):
+        """Remove a user from the room by user ID, freeing their seat"""
+        return await database_sync_to_async(remove_member)(self.room_id, user_id)
 
-    @database_sync_to_async
-    def update_user_role(self, user_id, role):
+    async def update_user_role(self, user_id, role):
         """Update user's role in the room"""
-        from .models import RoomMembership
-        try:
-            membership = RoomMembership.objects.get(room_id=self.room_id, user_id=user_id)
-            membership.role = role
-            membership.save()
-            return True
-        except RoomMembership.DoesNotExist:
-            return False
+        updated = await RoomMembership.objects.filter(room_id=self.room_id, user_id=user_id).aupdate(role=role)
+        await ainvalidate_access(self.room_id, user_id)
+        return bool(updated)
 
-    @database_sync_to_async
-    def update_room(self, settings):
+    async def update_room(self, settings):
         """Update room settings"""
-        try:
-            room = Room.objects.get(id=self.room_id)
-            # Update allowed fields
-            if 'name' in settings:
-                room.name = settings['name']
-            if 'description' in settings:
-                room.description = settings['description']
-            if 'topic' in settings:
-                room.topic = settings['topic']
-            if 'capacity' in settings:
-                room.capacity = settings['capacity']
-            if 'is_private' in settings:
-                room.is_private = settings['is_private']
-            room.save()
-            return True
-        except Room.DoesNotExist:
-            return False
+        # Update allowed fields
+        fields = {
+            field: settings[field]
+            for field in ('name', 'description', 'topic', 'capacity', 'is_private')
+            if field in settings
+        }
+        updated = await Room.objects.filter(id=self.room_id).aupdate(updated_at=timezone.now(), **fields)
+        if updated and 'capacity' in fields:
+            # A raised capacity frees seats for anyone waiting
+            await database_sync_to_async(admit_waitlisted)(self.room_id)
+        return bool(updated)
 
-    @database_sync_to_async
-    def mute_user(self, user_id, muted_until):
+    async def mute_user(self, user_id, muted_until):
         """Mute a user until specified time"""
-        from .models import RoomMembership
-        try:
-            membership = RoomMembership.objects.get(room_id=self.room_id, user_id=user_id)
-            membership.muted_until = muted_until
-            membership.save()
-            return True
-        except RoomMembership.DoesNotExist:
-            return False
-
-    @database_sync_to_async
-    def is_user_muted(self):
-        """Check if current user is muted"""
-        from .models import RoomMembership
-        from django.utils import timezone
-        try:
-            membership = RoomMembership.objects.get(room_id=self.room_id, user=self.user)
-            if membership.muted_until:
-                return membership.muted_until > timezone.now()
-            return False
-        except RoomMembership.DoesNotExist:
-            return False
+        updated = await RoomMembership.objects.filter(
+            room_id=self.room_id, user_id=user_id
+        ).aupdate(muted_until=muted_until)
+        await ainvalidate_access(self.room_id, user_id)
+        return bool(updated)
 
     async def send_error(self, message):
         """Send error message to user"""
@@ -744,8 +763,9 @@ class RoomConsumer(AsyncWebsocketConsumer):
         }))
 
     # Presence helpers
-    async def broadcast_presence(self):
-        users = await self.get_room_users(self.room_id)
+    async def broadcast_presence(self, users=None):
+        if users is None:
+            users = await self.get_room_users(self.room_id)
         await self.channel_layer.group_send(
             self.room_group_name,
             {
@@ -760,18 +780,14 @@ class RoomConsumer(AsyncWebsocketConsumer):
             'users': event['users']
         }))
 
+    # The presence helpers read, change and return the online list in one hop
     @database_sync_to_async
     def add_user_to_room(self, room_id, user):
-        from .models import RoomMembership
-        
         # Get user's role from membership
-        try:
-            membership = RoomMembership.objects.get(room_id=room_id, user=user)
-            role = membership.role
-        except RoomMembership.DoesNotExist:
-            role = 'member'
+        access = get_room_access(room_id, user)
+        role = access.role if access and access.role else 'member'
         
-        key = f"room:{room_id}:online_users"
+        key = presence_key(room_id)
         user_data = {
             'id': str(user.id), 
             'username': user.username,
@@ -780,17 +796,19 @@ class RoomConsumer(AsyncWebsocketConsumer):
         current_users = cache.get(key, {})
         current_users[str(user.id)] = user_data
         cache.set(key, current_users, timeout=None)
+        return list(current_users.values())
 
-    @database_sync_to_async
+    @sync_to_async
     def remove_user_from_room(self, room_id, user):
-        key = f"room:{room_id}:online_users"
+        key = presence_key(room_id)
         current_users = cache.get(key, {})
         if str(user.id) in current_users:
             del current_users[str(user.id)]
             cache.set(key, current_users, timeout=None)
+        return list(current_users.values())
             
-    @database_sync_to_async
+    @sync_to_async
     def get_room_users(self, room_id):
-        key = f"room:{room_id}:online_users"
+        key = presence_key(room_id)
         data = cache.get(key, {})
         return list(data.values())
@@ -0,0 +1,103 @@
+"""
+Buffered download counters.
+
+Downloads are counted with an atomic HINCRBY into a Redis hash instead of a
+row write per request. A periodic flush (see the flush_download_counts
+command) folds the buffered deltas into RoomFile.download_count with F()
+updates, so concurrent downloads of a hot file never contend for its row.
+"""
+from collections import defaultdict
+
+import redis
+from django.db import transaction
+from django.db.models import F
+
+from .models import RoomFile
+from utils.redis_client import get_redis
+
+PENDING_KEY = 'room_files:downloads:pending'
+FLUSHING_KEY = 'room_files:downloads:flushing'
+FLUSH_LOCK_KEY = 'room_files:downloads:flush-lock'
+# Longer than any flush takes; a flusher that died frees the lock after this
+FLUSH_LOCK_TIMEOUT = 300  # seconds
+
+# HINCRBY each field by minus its delta, dropping fields that reach zero
+_SUBTRACT_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    if redis.call('HINCRBY', KEYS[1], ARGV[i], -tonumber(ARGV[i + 1])) <= 0 then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+end
+"""
+
+
+def record_download(file_id):
+    try:
+        get_redis().hincrby(PENDING_KEY, str(file_id), 1)
+    except redis.RedisError:
+        # Never lose a count because Redis is unavailable
+        RoomFile.objects.filter(id=file_id).update(download_count=F('download_count') + 1)
+
+
+def pending_downloads(file_ids):
+    """Map of file id -> downloads not yet flushed to the database"""
+    keys = [str(file_id) for file_id in file_ids]
+    if not keys:
+        return {}
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.hmget(PENDING_KEY, keys)
+        pipe.hmget(FLUSHING_KEY, keys)
+        pending, flushing = pipe.execute()
+    except redis.RedisError:
+        return {}
+    return {
+        key: int(a or 0) + int(b or 0)
+        for key, a, b in zip(keys, pending, flushing)
+        if a or b
+    }
+
+
+def flush_download_counts(batch_size=500):
+    """
+    Move buffered deltas into the database; returns the number of files updated.
+
+    One flusher runs at a time, under a Redis lock. It reads the buffered
+    deltas, adds them to the rows, and once that has committed subtracts
+    exactly what it applied from the hash, so downloads counted meanwhile
+    stay buffered and nothing is applied twice. Only a crash between the
+    commit and the subtraction can count those deltas again.
+    """
+    client = get_redis()
+    lock = client.lock(FLUSH_LOCK_KEY, timeout=FLUSH_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        return 0  # another flusher is at it
+    try:
+        # FLUSHING_KEY is only left behind by flushes from before the lock
+        return sum(_flush_hash(client, key, batch_size) for key in (FLUSHING_KEY, PENDING_KEY))
+    finally:
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            pass  # expired meanwhile; the subtraction already happened
+
+
+def _flush_hash(client, key, batch_size):
+    deltas = {file_id: int(delta) for file_id, delta in client.hgetall(key).items() if int(delta) > 0}
+    if not deltas:
+        return 0
+
+    # Files sharing a delta are updated together, one statement per batch
+    by_delta = defaultdict(list)
+    for file_id, delta in deltas.items():
+        by_delta[delta].append(file_id)
+
+    updated = 0
+    with transaction.atomic():
+        for delta, file_ids in by_delta.items():
+            for i in range(0, len(file_ids), batch_size):
+                updated += RoomFile.objects.filter(id__in=file_ids[i:i + batch_size]).update(
+                    download_count=F('download_count') + delta
+                )
+    client.register_script(_SUBTRACT_SCRIPT)(keys=[key], args=[item for pair in deltas.items() for item in pair])
+    return updated
@@ -0,0 +1,197 @@
+"""
+Conditional and byte-range serving for room file downloads.
+
+Stored files never change once uploaded, so a strong ETag can be derived from
+their identity alone: the content hash for deduplicated blobs, or the row id
+plus size for older uploads. Clients revalidate with If-None-Match /
+If-Modified-Since and get a bodiless 304, and media players can seek with
+Range requests instead of re-fetching the whole file.
+
+How the bytes themselves leave the server depends on FILE_DELIVERY_MODE:
+
+- ``asgi``: stream from the event loop with file reads in worker threads.
+  Plain FileResponse is a synchronous iterator, which Django's ASGI handler
+  drains into memory before sending anything.
+- ``x-accel``: hand the transfer to nginx with ``X-Accel-Redirect``. nginx
+  needs an internal location mapping FILE_DELIVERY_ACCEL_PREFIX onto
+  MEDIA_ROOT, e.g. ``location /protected-media/ { internal; alias /app/media/; }``.
+- ``x-sendfile``: hand the transfer to Apache / lighttpd with ``X-Sendfile``.
+- ``django``: FileResponse, for WSGI deployments.
+
+Permission checks, conditional requests and download counting always happen
+here; in the proxy modes the proxy also serves the Range itself.
+"""
+import asyncio
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+
+STREAM_BLOCK_SIZE = 64 * 1024
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def file_etag(room_file):
+    if room_file.blob_id:
+        return f'"{room_file.blob_id}"'
+    return f'"{room_file.id.hex}-{room_file.file_size}"'
+
+
+def parse_range(header, size):
+    """
+    Return (start, end) inclusive for a single satisfiable byte range,
+    None to ignore the header, or False if it can't be satisfied.
+
+    Multi-range requests are answered with the full body, which RFC 9110
+    permits and saves us from multipart/byteranges framing.
+    """
+    match = _RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+
+    if not first:
+        # Suffix range: the final N bytes
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+
+    start = int(first)
+    if start >= size:
+        return False
+    end = int(last) if last else size - 1
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+def _if_range_passes(request, etag, last_modified):
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        # Weak validators never match for If-Range
+        return etag in parse_etags(if_range) and not if_range.startswith('W/')
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def iter_file_range(fileobj, start, length, block_size=STREAM_BLOCK_SIZE):
+    try:
+        fileobj.seek(start)
+        while length > 0:
+            data = fileobj.read(min(block_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fileobj.close()
+
+
+async def aiter_file_range(path, start, length, block_size=STREAM_BLOCK_SIZE):
+    """Async counterpart of iter_file_range; only the reads leave the event loop"""
+    fileobj = await asyncio.to_thread(open, path, 'rb')
+    try:
+        await asyncio.to_thread(fileobj.seek, start)
+        while length > 0:
+            data = await asyncio.to_thread(fileobj.read, min(block_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fileobj.close()
+
+
+def delivery_response(storage, name, size, content_type, byte_range=None, mode=None):
+    """Response carrying a stored file's body (or one range of it) for the given mode"""
+    mode = mode or getattr(settings, 'FILE_DELIVERY_MODE', 'django')
+
+    if mode in ('x-accel', 'x-sendfile'):
+        response = HttpResponse(content_type=content_type)
+        if mode == 'x-accel':
+            response['X-Accel-Redirect'] = settings.FILE_DELIVERY_ACCEL_PREFIX + quote(name)
+        else:
+            response['X-Sendfile'] = storage.path(name)
+        return response
+
+    start, end = byte_range or (0, size - 1)
+    length = max(end - start + 1, 0)
+    if mode == 'asgi':
+        response = StreamingHttpResponse(
+            aiter_file_range(storage.path(name), start, length),
+            content_type=content_type
+        )
+        response['Content-Length'] = str(length)
+    elif byte_range is None:
+        response = FileResponse(storage.open(name, 'rb'), content_type=content_type)
+    else:
+        response = StreamingHttpResponse(
+            iter_file_range(storage.open(name, 'rb'), start, length),
+            content_type=content_type
+        )
+        response['Content-Length'] = str(length)
+
+    if byte_range is not None:
+        response.status_code = 206
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    return response
+
+
+def serve_stored_file(request, storage, name, *, size, content_type, etag, last_modified,
+                      filename, as_attachment=True, on_download=None):
+    """
+    Build the response for a download, honouring conditional and Range
+    headers. `on_download` is called when the request actually starts a
+    transfer from the beginning of the file, so 304s and seeks inside an
+    already-playing file aren't counted as new downloads.
+    """
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        return _with_validators(not_modified, etag, last_modified)
+
+    byte_range = None
+    range_header = request.META.get('HTTP_RANGE')
+    if range_header and _if_range_passes(request, etag, last_modified):
+        byte_range = parse_range(range_header, size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return _with_validators(response, etag, last_modified)
+
+    if on_download and (byte_range is None or byte_range[0] == 0):
+        on_download()
+
+    response = delivery_response(storage, name, size, content_type, byte_range)
+    disposition = 'attachment' if as_attachment else 'inline'
+    response['Content-Disposition'] = f'{disposition}; filename="{filename}"'
+    return _with_validators(response, etag, last_modified)
+
+
+def serve_room_file(request, room_file, on_download=None):
+    return serve_stored_file(
+        request, room_file.file.storage, room_file.file.name,
+        size=room_file.file_size,
+        content_type=room_file.file_type,
+        etag=file_etag(room_file),
+        last_modified=int(room_file.created_at.timestamp()),
+        filename=room_file.original_filename,
+        on_download=on_download
+    )
+
+
+def _with_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Accept-Ranges'] = 'bytes'
+    # Always revalidate so membership is re-checked; unchanged files cost a 304
+    response['Cache-Control'] = 'private, no-cache'
+    return response
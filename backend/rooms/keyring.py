@@ -0,0 +1,199 @@
+"""
+Per-room message keys.
+
+Each room's messages are encrypted with a data key of its own, a random
+AES-256 key kept in RoomKey wrapped by one of the master keys in
+settings.MESSAGE_MASTER_KEYS. The wrap is bound to the room, so a wrapped key
+can't be passed off as another room's. Unwrapped keys are cached in-process
+(see Keyring), so encrypting or decrypting a message seldom costs a query.
+
+Rotating a master key means listing a new one first and running
+rewrap_room_keys, which re-wraps each data key in turn. The data keys
+themselves don't change, so messages are left alone and reads carry on
+throughout. Rotating a room's data key (reencrypt_messages --rotate) makes a
+new key active for new messages. Messages under the old key stay readable and
+reencrypt_messages moves them to the new one in the background.
+"""
+import base64
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import lru_cache
+
+import redis
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from utils.redis_client import get_redis
+from .models import RoomKey
+
+WRAP_NONCE_SIZE = 12
+DEV_MASTER_KEY_ID = 'dev'
+# Redis hash of the latest reencrypt_messages run's progress and throughput
+REENCRYPT_METRICS_KEY = 'crypto:reencrypt'
+
+
+class Keyring:
+    """
+    A thread-safe LRU cache whose entries also expire `ttl` seconds after
+    being loaded, so a key changed elsewhere (rotated, or its room deleted)
+    isn't used for long
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (value, expires at)
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def peek(self, key):
+        """The cached value, or None; never loads"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def get(self, key, load):
+        value = self.peek(key)
+        if value is None:
+            with self.lock:
+                self.misses += 1
+            # Loaded outside the lock; two threads missing at once both load
+            value = load(key)
+            self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# RoomKey id -> cipher, for decrypting
+data_keys = Keyring(settings.ROOM_KEY_CACHE_SIZE, settings.ROOM_KEY_CACHE_TTL)
+# Room id -> (RoomKey id, cipher) of its active key, for encrypting
+active_keys = Keyring(settings.ROOM_KEY_CACHE_SIZE, settings.ROOM_KEY_CACHE_TTL)
+
+
+def master_keys():
+    """{id: cipher} of the configured master keys; the first wraps new keys"""
+    return _master_keys(settings.MESSAGE_MASTER_KEYS, settings.SECRET_KEY)
+
+
+@lru_cache(maxsize=4)
+def _master_keys(config, secret_key):
+    keys = {}
+    for pair in filter(None, (item.strip() for item in config.split(','))):
+        key_id, _, key = pair.partition(':')
+        keys[key_id] = AESGCM(base64.urlsafe_b64decode(key))
+    # Wraps keys when none are configured, and stays around to unwrap those
+    # until rewrap_room_keys has moved them to a configured one
+    key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b'message-master-key').derive(
+        secret_key.encode()
+    )
+    keys.setdefault(DEV_MASTER_KEY_ID, AESGCM(key))
+    return keys
+
+
+def current_master_key_id():
+    return next(iter(master_keys()))
+
+
+def wrap_key(room_id, data_key):
+    """(master key id, wrapped key) of a room's data key under the current master key"""
+    master_key_id = current_master_key_id()
+    nonce = os.urandom(WRAP_NONCE_SIZE)
+    wrapped = master_keys()[master_key_id].encrypt(nonce, data_key, uuid.UUID(str(room_id)).bytes)
+    return master_key_id, nonce + wrapped
+
+
+def unwrap_key(room_key):
+    master = master_keys().get(room_key.master_key_id)
+    if master is None:
+        raise KeyError(f"Master key {room_key.master_key_id!r} is not configured")
+    wrapped = bytes(room_key.wrapped_key)
+    return master.decrypt(
+        wrapped[:WRAP_NONCE_SIZE], wrapped[WRAP_NONCE_SIZE:], uuid.UUID(str(room_key.room_id)).bytes
+    )
+
+
+def data_key(key_id):
+    """The cipher of a RoomKey, by id"""
+    return data_keys.get(key_id, _load_data_key)
+
+
+def _load_data_key(key_id):
+    return AESGCM(unwrap_key(RoomKey.objects.get(pk=key_id)))
+
+
+def active_room_key(room_id):
+    """(RoomKey id, cipher) new messages of the room are encrypted with; creates its first key"""
+    return active_keys.get(str(room_id), _load_active_key)
+
+
+def _load_active_key(room_id):
+    room_key = RoomKey.objects.filter(room_id=room_id, is_active=True).first()
+    if room_key is None:
+        room_key = create_room_key(room_id)
+    cipher = AESGCM(unwrap_key(room_key))
+    data_keys.put(room_key.pk, cipher)
+    return room_key.pk, cipher
+
+
+def create_room_key(room_id, retire=False):
+    """
+    A new active data key for the room. With `retire` it replaces the current
+    one, which other processes keep using for new messages until their cached
+    copy expires.
+    """
+    master_key_id, wrapped = wrap_key(room_id, AESGCM.generate_key(bit_length=256))
+    try:
+        with transaction.atomic():
+            if retire:
+                RoomKey.objects.filter(room_id=room_id, is_active=True).update(is_active=False)
+            room_key = RoomKey.objects.create(room_id=room_id, wrapped_key=wrapped, master_key_id=master_key_id)
+    except IntegrityError:
+        # The room's first key was created concurrently
+        return RoomKey.objects.get(room_id=room_id, is_active=True)
+    active_keys.put(str(room_id), (room_key.pk, AESGCM(unwrap_key(room_key))))
+    return room_key
+
+
+def rewrap_room_key(room_key):
+    """Wrap a data key with the current master key; False if it changed meanwhile"""
+    master_key_id, wrapped = wrap_key(room_key.room_id, unwrap_key(room_key))
+    return bool(RoomKey.objects.filter(pk=room_key.pk, master_key_id=room_key.master_key_id).update(
+        master_key_id=master_key_id, wrapped_key=wrapped,
+    ))
+
+
+def record_reencrypt_metrics(metrics, reset=False):
+    """Store a run's metrics; `reset` drops the previous run's first"""
+    try:
+        with get_redis().pipeline() as pipe:
+            if reset:
+                pipe.delete(REENCRYPT_METRICS_KEY)
+            pipe.hset(REENCRYPT_METRICS_KEY, mapping=metrics)
+            pipe.execute()
+    except redis.RedisError:
+        pass  # metrics never get in the way of the job
+
+
+def reencrypt_metrics():
+    """The latest reencrypt_messages run's metrics, as recorded"""
+    return get_redis().hgetall(REENCRYPT_METRICS_KEY)
@@ -0,0 +1,52 @@
+"""
+Websocket latency telemetry.
+
+Clients keep their clock in step with the server with NTP-style clock_ping /
+clock_pong exchanges over the room socket (see RoomConsumer.handle_clock_ping)
+and report the round trip and clock offset they measured with their next
+ping. The latest report of each connection is kept in one Redis hash until
+the connection closes; the ws_latency command summarizes it.
+"""
+import json
+import time
+
+import redis
+
+from utils.redis_client import aget_redis, get_redis
+
+LATENCY_KEY = 'ws:latency'
+# Reports recorded per connection at most this often, in seconds
+REPORT_INTERVAL = 10
+# Reports older than this are from connections that went away uncleanly
+STALE_AFTER = 120
+
+
+async def arecord_latency(channel_name, room_id, user_id, rtt, offset):
+    report = {'room_id': str(room_id), 'user_id': user_id, 'rtt': rtt, 'offset': offset, 'at': time.time()}
+    try:
+        await aget_redis().hset(LATENCY_KEY, channel_name, json.dumps(report))
+    except redis.RedisError:
+        pass  # telemetry never gets in the way of the socket
+
+
+async def aforget_latency(channel_name):
+    try:
+        await aget_redis().hdel(LATENCY_KEY, channel_name)
+    except redis.RedisError:
+        pass
+
+
+def latency_reports():
+    """Current report of every open connection; stale ones are pruned"""
+    client = get_redis()
+    reports, stale = [], []
+    cutoff = time.time() - STALE_AFTER
+    for channel_name, value in client.hgetall(LATENCY_KEY).items():
+        report = json.loads(value)
+        if report['at'] < cutoff:
+            stale.append(channel_name)
+        else:
+            reports.append(report)
+    if stale:
+        client.hdel(LATENCY_KEY, *stale)
+    return reports
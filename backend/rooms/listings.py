@@ -0,0 +1,57 @@
+"""
+Filtering and caching for a room's file list.
+
+Lists are cursor-paginated newest first, which walks the (room, -created_at)
+index directly. The unfiltered first page is what every client requests when
+it opens a room, so it is cached per room and dropped whenever a file is
+added or removed.
+"""
+from django.core.cache import cache
+from django.db.models import Q
+from rest_framework import exceptions
+
+FIRST_PAGE_CACHE_TTL = 60  # seconds; bounds staleness of buffered download counts
+
+# ?type= categories, matching the groups in ALLOWED_FILE_EXTENSIONS
+FILE_CATEGORIES = {
+    'document': ['.pdf', '.doc', '.docx', '.txt', '.md'],
+    'image': ['.jpg', '.jpeg', '.png', '.gif', '.webp'],
+    'audio': ['.mp3', '.wav'],
+    'archive': ['.zip', '.rar'],
+    'code': ['.py', '.js', '.ts', '.html', '.css'],
+}
+
+
+def first_page_cache_key(room_id):
+    return f"room:{room_id}:files:first_page"
+
+
+def invalidate_file_list(room_id):
+    cache.delete(first_page_cache_key(room_id))
+
+
+def filter_room_files(queryset, params):
+    """Apply the optional ?type= and ?uploaded_by= filters"""
+    category = params.get('type')
+    if category:
+        if category not in FILE_CATEGORIES:
+            raise exceptions.ValidationError(
+                {'type': f"Unknown file type. Choose from: {', '.join(FILE_CATEGORIES)}"}
+            )
+        matches = Q()
+        for ext in FILE_CATEGORIES[category]:
+            matches |= Q(original_filename__iendswith=ext)
+        queryset = queryset.filter(matches)
+
+    uploader = params.get('uploaded_by')
+    if uploader:
+        if not uploader.isdigit():
+            raise exceptions.ValidationError({'uploaded_by': 'Must be a user id.'})
+        queryset = queryset.filter(uploaded_by_id=int(uploader))
+
+    return queryset
+
+
+def is_first_page_request(params):
+    """True for the plain, unfiltered first page; the only one that is cached"""
+    return not any(params.get(key) for key in ('cursor', 'type', 'uploaded_by', 'page_size'))
@@ -0,0 +1,36 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from rooms.archive import archive_room
+from rooms.models import Message
+
+
+class Command(BaseCommand):
+    help = "Move old messages out of the database into per-room archive segments"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', help='Only archive this room')
+        parser.add_argument('--older-than-days', type=int, default=settings.MESSAGE_ARCHIVE_AFTER_DAYS,
+                            help='Archive messages older than this many days')
+        parser.add_argument('--keep', type=int, default=settings.MESSAGE_ARCHIVE_MIN_HOT,
+                            help="Never archive a room's newest N messages")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['older_than_days'])
+        if options['room']:
+            room_ids = [options['room']]
+        else:
+            room_ids = list(
+                Message.objects.filter(created_at__lt=cutoff, room__deleted_at__isnull=True)
+                .values_list('room_id', flat=True).distinct()
+            )
+        total = 0
+        for room_id in room_ids:
+            archived = archive_room(room_id, cutoff, min_hot=options['keep'])
+            if archived:
+                self.stdout.write(f"Archived {archived} message(s) of room {room_id}")
+            total += archived
+        self.stdout.write(self.style.SUCCESS(f"Archived {total} message(s) from {len(room_ids)} room(s)"))
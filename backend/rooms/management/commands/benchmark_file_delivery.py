@@ -0,0 +1,93 @@
+import asyncio
+import os
+import time
+import tracemalloc
+import uuid
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from rooms.downloads import delivery_response
+
+MODES = ['django', 'asgi', 'x-accel', 'x-sendfile']
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare file delivery modes by streaming a scratch file through each "
+        "response the way Django's ASGI handler does, with concurrent downloads"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size-mb', type=int, default=50)
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+
+    def handle(self, *args, **options):
+        size = options['size_mb'] * 1024 * 1024
+        name = f"benchmarks/{uuid.uuid4()}.bin"
+        path = default_storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as scratch:
+            for _ in range(options['size_mb']):
+                scratch.write(os.urandom(1024 * 1024))
+
+        self.stdout.write(
+            f"{options['concurrency']} concurrent downloads of {options['size_mb']} MB\n"
+            f"{'mode':<12}{'worker MB/s':>14}{'worker bytes':>16}{'peak mem MB':>14}{'max loop lag ms':>18}"
+        )
+        try:
+            for mode in options['modes']:
+                result = asyncio.run(self.run_mode(name, size, mode, options['concurrency']))
+                self.stdout.write(
+                    f"{mode:<12}{result['throughput']:>14.1f}{result['bytes']:>16,}"
+                    f"{result['peak_mb']:>14.1f}{result['lag_ms']:>18.1f}"
+                )
+        finally:
+            os.remove(path)
+
+        self.stdout.write(
+            "Proxy modes move no file bytes through the worker; their throughput "
+            "is whatever the front proxy sustains."
+        )
+
+    async def run_mode(self, name, size, mode, concurrency):
+        lag = {'max': 0.0}
+        stop = asyncio.Event()
+
+        async def ticker():
+            # Measures how long the event loop is blocked between ticks
+            while not stop.is_set():
+                before = time.perf_counter()
+                await asyncio.sleep(0.005)
+                lag['max'] = max(lag['max'], time.perf_counter() - before - 0.005)
+
+        async def download():
+            response = delivery_response(default_storage, name, size, 'application/octet-stream', mode=mode)
+            received = 0
+            if response.streaming:
+                # Same consumption path as ASGIHandler.send_response
+                async for part in response:
+                    received += len(part)
+            else:
+                received = len(response.content)
+            response.close()
+            return received
+
+        tracemalloc.start()
+        tick = asyncio.create_task(ticker())
+        started = time.perf_counter()
+        received = await asyncio.gather(*(download() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await tick
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        total = sum(received)
+        return {
+            'bytes': total,
+            'throughput': total / elapsed / (1024 * 1024),
+            'peak_mb': peak / (1024 * 1024),
+            'lag_ms': lag['max'] * 1000,
+        }
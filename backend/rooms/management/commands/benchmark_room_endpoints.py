@@ -0,0 +1,173 @@
+import asyncio
+import hashlib
+import json
+import statistics
+import threading
+import time
+import uuid
+
+from channels.layers import get_channel_layer
+from django.core.asgi import get_asgi_application
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from rest_framework_simplejwt.tokens import AccessToken
+
+from rooms.blobs import release_room_file
+from rooms.models import Room, RoomFile, RoomMembership
+from rooms.uploads import create_room_file
+from users.models import CustomUser
+
+SCENARIOS = ['pomodoro-get', 'pomodoro-post', 'join-leave', 'files-list', 'file-download']
+
+
+class Command(BaseCommand):
+    help = (
+        "Load the room REST endpoints through Django's ASGI handler (as daphne "
+        "runs them) and report throughput, latency, event loop lag and threads"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help='Requests per scenario')
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+        parser.add_argument('--layer-latency-ms', type=float, default=0,
+                            help='Add this much delay to each channel layer send, to stand in '
+                                 'for a Redis round trip when benchmarking against a local layer')
+
+    def handle(self, *args, **options):
+        concurrency = options['concurrency']
+        tag = uuid.uuid4().hex[:8]
+        owner = CustomUser.objects.create_user(username=f'bench-{tag}', email=f'bench-{tag}@example.com')
+        users = [
+            CustomUser.objects.create_user(username=f'bench-{tag}-{i}', email=f'bench-{tag}-{i}@example.com')
+            for i in range(concurrency)
+        ]
+        room = Room.objects.create(name=f'bench-{tag}', owner=owner, capacity=concurrency + 1, member_count=1)
+        RoomMembership.objects.create(room=room, user=owner, role='admin')
+        body = tag.encode() * 32 * 1024  # unique per run so it doesn't share a real blob
+        room_file = create_room_file(
+            room, owner, ContentFile(body, name='bench.bin'), hashlib.sha256(body).hexdigest(),
+            filename='bench.bin', file_size=len(body), file_type='application/octet-stream'
+        )
+
+        self.owner_token = str(AccessToken.for_user(owner))
+        self.user_tokens = [str(AccessToken.for_user(user)) for user in users]
+        self.room, self.room_file = room, room_file
+        self.app = get_asgi_application()
+        if options['layer_latency_ms']:
+            self.delay_channel_layer(options['layer_latency_ms'] / 1000)
+
+        self.stdout.write(
+            f"{options['requests']} requests per scenario, {concurrency} concurrent\n"
+            f"{'scenario':<16}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'errors':>8}"
+            f"{'peak threads':>14}{'max loop lag ms':>17}"
+        )
+        try:
+            for scenario in options['scenarios']:
+                result = asyncio.run(self.run_scenario(scenario, options['requests'], concurrency))
+                self.stdout.write(
+                    f"{scenario:<16}{result['rps']:>9.1f}{result['p50']:>9.1f}{result['p95']:>9.1f}"
+                    f"{result['errors']:>8}{result['threads']:>14}{result['lag']:>17.1f}"
+                )
+        finally:
+            release_room_file(RoomFile.objects.get(pk=room_file.pk))
+            room.delete()
+            CustomUser.objects.filter(username__startswith=f'bench-{tag}').delete()
+
+    def delay_channel_layer(self, delay):
+        layer = get_channel_layer()
+        group_send = layer.group_send
+
+        async def delayed_group_send(group, message):
+            await asyncio.sleep(delay)
+            await group_send(group, message)
+
+        layer.group_send = delayed_group_send
+
+    def requests_for(self, scenario, worker):
+        """The request(s) one iteration of a scenario makes, as (method, path, body, token)"""
+        base = f'/api/rooms/{self.room.id}'
+        if scenario == 'pomodoro-get':
+            return [('GET', f'{base}/pomodoro/', None, self.owner_token)]
+        if scenario == 'pomodoro-post':
+            return [('POST', f'{base}/pomodoro/', {'action': 'pause'}, self.owner_token)]
+        if scenario == 'join-leave':
+            token = self.user_tokens[worker]
+            return [('POST', f'{base}/join/', None, token), ('POST', f'{base}/leave/', None, token)]
+        if scenario == 'files-list':
+            return [('GET', f'{base}/files/?type=document', None, self.owner_token)]
+        return [('GET', f'{base}/files/{self.room_file.id}/', None, self.owner_token)]
+
+    async def call(self, method, path, body, token):
+        payload = json.dumps(body).encode() if body is not None else b''
+        path, _, query = path.partition('?')
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': method, 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+            'query_string': query.encode(), 'root_path': '',
+            'headers': [
+                (b'host', b'localhost'),
+                (b'cookie', f'access_token={token}'.encode()),
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(payload)).encode()),
+            ],
+            'client': ('127.0.0.1', 50000), 'server': ('localhost', 80),
+        }
+        request_sent = False
+        never = asyncio.Event()
+        status = None
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {'type': 'http.request', 'body': payload, 'more_body': False}
+            await never.wait()  # the client never disconnects early
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+
+        await self.app(scope, receive, send)
+        return status
+
+    async def run_scenario(self, scenario, total, concurrency):
+        stats = {'lag': 0.0, 'threads': threading.active_count()}
+        stop = asyncio.Event()
+        latencies, errors = [], 0
+        remaining = iter(range(total))
+
+        async def monitor():
+            while not stop.is_set():
+                before = time.perf_counter()
+                await asyncio.sleep(0.005)
+                stats['lag'] = max(stats['lag'], time.perf_counter() - before - 0.005)
+                stats['threads'] = max(stats['threads'], threading.active_count())
+
+        async def worker(index):
+            nonlocal errors
+            for _ in remaining:
+                for method, path, body, token in self.requests_for(scenario, index):
+                    started = time.perf_counter()
+                    status = await self.call(method, path, body, token)
+                    latencies.append(time.perf_counter() - started)
+                    if status >= 400:
+                        errors += 1
+
+        tick = asyncio.create_task(monitor())
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await tick
+
+        latencies.sort()
+        return {
+            'rps': len(latencies) / elapsed,
+            'p50': statistics.median(latencies) * 1000,
+            'p95': latencies[int(len(latencies) * 0.95) - 1] * 1000,
+            'errors': errors,
+            'threads': stats['threads'],
+            'lag': stats['lag'] * 1000,
+        }
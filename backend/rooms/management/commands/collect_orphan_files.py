@@ -0,0 +1,37 @@
+import time
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from rooms.orphans import collect_orphan_files
+
+
+class Command(BaseCommand):
+    help = "Delete files under MEDIA_ROOT/room_files/ that no RoomFile or blob refers to"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep running, collecting every N seconds (default: run once)')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Files checked against the database per query')
+        parser.add_argument('--min-age-minutes', type=int, default=60,
+                            help='Leave files younger than this alone (uploads still committing)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report what would be deleted without deleting it')
+
+    def handle(self, *args, **options):
+        while True:
+            scanned, removed, freed = collect_orphan_files(
+                default_storage,
+                batch_size=options['batch_size'],
+                min_age=options['min_age_minutes'] * 60,
+                dry_run=options['dry_run']
+            )
+            verb = 'Would remove' if options['dry_run'] else 'Removed'
+            self.stdout.write(
+                f"Scanned {scanned} file(s). {verb} {removed} orphan(s), "
+                f"{freed / (1024 * 1024):.1f} MB"
+            )
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
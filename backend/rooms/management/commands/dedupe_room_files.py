@@ -0,0 +1,60 @@
+import hashlib
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from rooms.blobs import store_blob
+from rooms.listings import invalidate_file_list
+from rooms.models import RoomFile
+from rooms.uploads import STREAM_READ_SIZE, MovableFile
+
+
+class Command(BaseCommand):
+    help = "Move files uploaded before deduplication into the content-addressed blob store"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        migrated = shared = missing = 0
+        legacy = RoomFile.objects.filter(blob__isnull=True).order_by('pk')
+        last_pk = None
+
+        while True:
+            page = legacy.filter(pk__gt=last_pk) if last_pk else legacy
+            batch = list(page[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+
+            for room_file in batch:
+                storage = room_file.file.storage
+                old_name = room_file.file.name
+                if not old_name or not storage.exists(old_name):
+                    missing += 1
+                    continue
+
+                digest = hashlib.sha256()
+                with storage.open(old_name, 'rb') as source:
+                    for data in iter(lambda: source.read(STREAM_READ_SIZE), b''):
+                        digest.update(data)
+
+                with transaction.atomic():
+                    with MovableFile(open(storage.path(old_name), 'rb')) as content:
+                        blob = store_blob(content, digest.hexdigest(), room_file.file_size)
+                    room_file.blob = blob
+                    room_file.file.name = blob.file.name
+                    room_file.save(update_fields=['blob', 'file'])
+                # The file's URL moved with it
+                invalidate_file_list(room_file.room_id)
+
+                # Either moved into the blob already, or a duplicate of stored content
+                if storage.exists(old_name):
+                    storage.delete(old_name)
+                    shared += 1
+                migrated += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Migrated {migrated} file(s) ({shared} deduplicated against existing blobs); "
+            f"{missing} file(s) missing from storage were skipped"
+        ))
@@ -0,0 +1,42 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rooms.partitions import detach_message_partition, is_partitioned, message_partitions
+
+
+class Command(BaseCommand):
+    help = (
+        "Take the message partitions of months before --before out of the "
+        "message table, without blocking writes to newer months. Detached "
+        "months are kept as standalone tables unless --drop is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--before', required=True,
+                            help='First month to keep, as YYYY-MM')
+        parser.add_argument('--drop', action='store_true',
+                            help='Drop the detached tables instead of keeping them')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='List the partitions that would be detached')
+
+    def handle(self, *args, **options):
+        try:
+            year, month = options['before'].split('-')
+            before = date(int(year), int(month), 1)
+        except ValueError:
+            raise CommandError("--before must be a month such as 2024-01")
+        if not is_partitioned():
+            raise CommandError("The message table isn't partitioned on this database")
+
+        old = [(name, rows) for name, month, rows in message_partitions() if month < before]
+        if not old:
+            self.stdout.write(f"No message partitions before {options['before']}")
+            return
+        for name, rows in old:
+            if options['dry_run']:
+                self.stdout.write(f"Would detach {name} (~{rows} messages)")
+                continue
+            detach_message_partition(name, drop=options['drop'])
+            action = 'Detached and dropped' if options['drop'] else 'Detached'
+            self.stdout.write(f"{action} {name} (~{rows} messages)")
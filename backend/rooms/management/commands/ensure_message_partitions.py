@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError
+
+from rooms.partitions import MONTHS_AHEAD, ensure_message_partitions, is_partitioned
+
+
+class Command(BaseCommand):
+    help = "Create the monthly message partitions for the current and coming months"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=MONTHS_AHEAD,
+                            help='Months after the current one to have partitions for')
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep running, checking every N seconds (default: check once)')
+
+    def handle(self, *args, **options):
+        if not is_partitioned():
+            self.stdout.write("The message table isn't partitioned on this database; nothing to do")
+            return
+        while True:
+            try:
+                created = ensure_message_partitions(ahead=options['ahead'])
+            except DatabaseError as exc:
+                # Most likely the lock timeout; the next run tries again
+                self.stderr.write(f"Creating message partitions failed: {exc}")
+                created = []
+            for name in created:
+                self.stdout.write(f"Created {name}")
+            if not created and not options['interval']:
+                self.stdout.write("All message partitions are in place")
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
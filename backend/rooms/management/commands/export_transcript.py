@@ -0,0 +1,34 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rooms.exports import DEFAULT_CHUNK_SIZE, EXPORT_FORMATS, stream_transcript
+from rooms.models import Room
+
+
+class Command(BaseCommand):
+    help = "Export a room's decrypted message history as NDJSON or CSV"
+
+    def add_arguments(self, parser):
+        parser.add_argument('room_id')
+        parser.add_argument('--type', dest='export_format', choices=list(EXPORT_FORMATS), default='ndjson')
+        parser.add_argument('--output', '-o', help='File to write to (defaults to stdout)')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            room = Room.objects.get(id=options['room_id'])
+        except (Room.DoesNotExist, ValueError):
+            raise CommandError(f"Room {options['room_id']} not found")
+
+        chunks = stream_transcript(room.id, options['export_format'], chunk_size=options['chunk_size'])
+
+        if options['output']:
+            with open(options['output'], 'wb') as out:
+                for chunk in chunks:
+                    out.write(chunk)
+            self.stderr.write(self.style.SUCCESS(f"Transcript for '{room.name}' written to {options['output']}"))
+        else:
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
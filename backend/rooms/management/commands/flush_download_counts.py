@@ -0,0 +1,33 @@
+import time
+
+import redis
+from django.core.management.base import BaseCommand
+from django.db import InterfaceError, OperationalError, close_old_connections
+
+from rooms.counters import flush_download_counts
+
+
+class Command(BaseCommand):
+    help = "Fold download counts buffered in Redis into RoomFile.download_count"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep running, flushing every N seconds (default: flush once)')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                updated = flush_download_counts(batch_size=options['batch_size'])
+            except (redis.RedisError, InterfaceError, OperationalError) as exc:
+                if not options['interval']:
+                    raise
+                # Buffered deltas stay in Redis until a flush gets through
+                self.stderr.write(f"Flushing download counts failed, retrying: {exc}")
+                close_old_connections()
+            else:
+                if updated or not options['interval']:
+                    self.stdout.write(f"Flushed download counts for {updated} file(s)")
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import statistics
+import threading
+import time
+import uuid
+
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.db.backends.signals import connection_created
+
+from rooms.models import Message, Room, RoomMembership
+from rooms.routing import websocket_urlpatterns
+from users.models import CustomUser
+from utils.encryption_service import EncryptionService
+
+SCENARIOS = ['chat', 'reply', 'edit', 'seen', 'react', 'mute']
+
+
+class Command(BaseCommand):
+    help = (
+        "Connect a number of websocket clients to one room's RoomConsumer and have "
+        "each send chat events as fast as they are acknowledged; reports throughput, "
+        "latency, event loop lag and threads"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=20)
+        parser.add_argument('--events', type=int, default=50, help='Events each client sends per scenario')
+        parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+        parser.add_argument('--layer-latency-ms', type=float, default=0,
+                            help='Add this much delay to each channel layer send, to stand in '
+                                 'for a Redis round trip when testing against a local layer')
+        parser.add_argument('--query-latency-ms', type=float, default=0,
+                            help='Add this much delay to each SQL statement, to stand in for '
+                                 'a network round trip to the database')
+
+    def handle(self, *args, **options):
+        clients = options['clients']
+        tag = uuid.uuid4().hex[:8]
+        owner = CustomUser.objects.create_user(username=f'loadtest-{tag}', email=f'loadtest-{tag}@example.com')
+        self.users = [
+            CustomUser.objects.create_user(username=f'loadtest-{tag}-{i}', email=f'loadtest-{tag}-{i}@example.com')
+            for i in range(clients)
+        ]
+        self.target = CustomUser.objects.create_user(username=f'loadtest-{tag}-target', email=f'loadtest-{tag}-target@example.com')
+        self.room = Room.objects.create(name=f'loadtest-{tag}', owner=owner, capacity=clients + 2)
+        RoomMembership.objects.bulk_create(
+            [RoomMembership(room=self.room, user=user, role='admin') for user in self.users]
+            + [RoomMembership(room=self.room, user=self.target)]
+        )
+        # One message per client to reply to, edit, mark seen and react to
+        self.messages = Message.objects.bulk_create([
+            Message(room=self.room, sender=user, ciphertext=EncryptionService.encrypt('load test', self.room.id))
+            for user in self.users
+        ])
+        self.application = URLRouter(websocket_urlpatterns)
+
+        if options['layer_latency_ms']:
+            self.delay_channel_layer(options['layer_latency_ms'] / 1000)
+        if options['query_latency_ms']:
+            self.delay_queries(options['query_latency_ms'] / 1000)
+
+        self.stdout.write(
+            f"{clients} clients, {options['events']} events each per scenario\n"
+            f"{'scenario':<10}{'events/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'timeouts':>10}"
+            f"{'peak threads':>14}{'max loop lag ms':>17}"
+        )
+        try:
+            for scenario in options['scenarios']:
+                result = asyncio.run(self.run_scenario(scenario, options['events']))
+                self.stdout.write(
+                    f"{scenario:<10}{result['rate']:>10.1f}{result['p50']:>9.1f}{result['p95']:>9.1f}"
+                    f"{result['timeouts']:>10}{result['threads']:>14}{result['lag']:>17.1f}"
+                )
+        finally:
+            connection_created.disconnect(dispatch_uid='loadtest_room_consumer')
+            self.room.delete()
+            CustomUser.objects.filter(username__startswith=f'loadtest-{tag}').delete()
+
+    def delay_channel_layer(self, delay):
+        layer = get_channel_layer()
+        group_send = layer.group_send
+
+        async def delayed_group_send(group, message):
+            await asyncio.sleep(delay)
+            await group_send(group, message)
+
+        layer.group_send = delayed_group_send
+
+    def delay_queries(self, delay):
+        def delayed_execute(execute, sql, params, many, context):
+            time.sleep(delay)
+            return execute(sql, params, many, context)
+
+        # Connections are per thread and may be reopened, so hook each new one
+        def add_delay(sender, connection, **kwargs):
+            connection.execute_wrappers.append(delayed_execute)
+
+        connection_created.connect(add_delay, weak=False, dispatch_uid='loadtest_room_consumer')
+
+    def event_for(self, scenario, index):
+        """The event a client sends and a predicate matching its acknowledgement"""
+        user, message_id = self.users[index], str(self.messages[index].id)
+        if scenario == 'chat':
+            return {'type': 'chat_message', 'content': 'hello'}, \
+                lambda event: event['type'] == 'chat_message' and event['sender_id'] == str(user.id)
+        if scenario == 'reply':
+            return {'type': 'chat_message', 'content': 'hello', 'replied_to_id': message_id}, \
+                lambda event: event['type'] == 'chat_message' and event['sender_id'] == str(user.id)
+        if scenario == 'edit':
+            return {'type': 'edit_message', 'message_id': message_id, 'content': 'edited'}, \
+                lambda event: event['type'] == 'message_update' and event['id'] == message_id
+        if scenario == 'seen':
+            return {'type': 'mark_seen', 'message_id': message_id}, \
+                lambda event: event['type'] == 'unread_count_update'
+        if scenario == 'react':
+            return {'type': 'add_reaction', 'message_id': message_id, 'emoji': '👍'}, \
+                lambda event: event['type'] == 'message_reaction_added' and event['user_id'] == str(user.id)
+        return {'type': 'mute_user', 'user_id': self.target.id, 'duration': 1}, \
+            lambda event: event['type'] == 'user_muted_notification' and event['muted_by'] == user.username
+
+    def connect_as(self, user):
+        application = self.application
+
+        async def authenticated(scope, receive, send):
+            return await application({**scope, 'user': user}, receive, send)
+
+        return WebsocketCommunicator(authenticated, f'/ws/room/{self.room.id}/')
+
+    async def run_scenario(self, scenario, events):
+        stats = {'lag': 0.0, 'threads': threading.active_count()}
+        stop = asyncio.Event()
+        latencies, timeouts = [], 0
+
+        async def monitor():
+            while not stop.is_set():
+                before = time.perf_counter()
+                await asyncio.sleep(0.005)
+                stats['lag'] = max(stats['lag'], time.perf_counter() - before - 0.005)
+                stats['threads'] = max(stats['threads'], threading.active_count())
+
+        async def acknowledged(communicator, matches):
+            # Everyone receives every room broadcast; skip the ones for others
+            while True:
+                event = json.loads(await communicator.receive_from(timeout=10))
+                if matches(event):
+                    return
+
+        async def client(index, communicator):
+            nonlocal timeouts
+            event, matches = self.event_for(scenario, index)
+            for _ in range(events):
+                started = time.perf_counter()
+                await communicator.send_to(text_data=json.dumps(event))
+                try:
+                    await acknowledged(communicator, matches)
+                except asyncio.TimeoutError:
+                    timeouts += 1
+                    return
+                latencies.append(time.perf_counter() - started)
+
+        communicators = [self.connect_as(user) for user in self.users]
+        for communicator in communicators:
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise RuntimeError('The consumer refused the connection')
+        # Drain the presence updates from everyone joining
+        await asyncio.sleep(0.2)
+        for communicator in communicators:
+            while not await communicator.receive_nothing(timeout=0.01):
+                await communicator.receive_from()
+
+        tick = asyncio.create_task(monitor())
+        started = time.perf_counter()
+        await asyncio.gather(*(client(i, c) for i, c in enumerate(communicators)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await tick
+        for communicator in communicators:
+            await communicator.disconnect()
+
+        latencies = sorted(latencies) or [0]
+        return {
+            'rate': len(latencies) / elapsed,
+            'p50': statistics.median(latencies) * 1000,
+            'p95': latencies[max(int(len(latencies) * 0.95) - 1, 0)] * 1000,
+            'timeouts': timeouts,
+            'threads': stats['threads'],
+            'lag': stats['lag'] * 1000,
+        }
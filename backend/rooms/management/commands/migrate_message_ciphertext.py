@@ -0,0 +1,57 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from rooms.models import Message
+from utils.encryption_service import DECRYPTION_ERROR, EncryptionService
+
+
+class Command(BaseCommand):
+    help = "Re-encrypt messages still stored as Fernet tokens into the binary ciphertext format"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to pause between batches, to go easy on a busy database')
+
+    def handle(self, *args, **options):
+        migrated = failed = skipped = 0
+        before = stored = 0
+        legacy = Message.objects.filter(ciphertext__isnull=True).exclude(content='').order_by('pk')
+        last_pk = None
+
+        while True:
+            page = legacy.filter(pk__gt=last_pk) if last_pk else legacy
+            batch = list(page.values_list('pk', 'created_at', 'room_id', 'content')[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+
+            plaintexts = EncryptionService.decrypt_many([token for pk, created_at, room_id, token in batch])
+            with transaction.atomic():
+                for (pk, created_at, room_id, token), text in zip(batch, plaintexts):
+                    if text == DECRYPTION_ERROR:
+                        failed += 1
+                        continue
+                    ciphertext = EncryptionService.encrypt(text, room_id)
+                    # Only if the message hasn't been edited or deleted since it was read;
+                    # created_at lets PostgreSQL look in a single partition
+                    if Message.objects.filter(
+                        pk=pk, created_at=created_at, ciphertext__isnull=True, content=token
+                    ).update(ciphertext=ciphertext, content=''):
+                        migrated += 1
+                        before += len(token)
+                        stored += len(ciphertext)
+                    else:
+                        skipped += 1
+
+            self.stdout.write(f"Migrated {migrated} message(s) so far")
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        saved = f" ({before} bytes down to {stored})" if migrated else ''
+        self.stdout.write(self.style.SUCCESS(
+            f"Migrated {migrated} message(s){saved}; {skipped} were edited or deleted meanwhile, "
+            f"{failed} could not be decrypted"
+        ))
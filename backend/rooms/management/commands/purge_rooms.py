@@ -0,0 +1,51 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import InterfaceError, OperationalError, close_old_connections
+
+from rooms.purge import BATCH_SIZE, claim_purge, run_purge
+
+
+class Command(BaseCommand):
+    help = "Remove the rows and files of deleted rooms in batches, reporting progress"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep running, looking for new purges every N seconds (default: run once)')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        self.verbose = options['verbosity'] > 1
+        while True:
+            try:
+                if self.purge_next(options['batch_size']):
+                    continue  # straight on to the next one
+            except (InterfaceError, OperationalError) as exc:
+                if not options['interval']:
+                    raise
+                # A purge claimed before the error is picked up again once it goes stale
+                self.stderr.write(f"Database error while purging rooms, retrying: {exc}")
+                close_old_connections()
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def purge_next(self, batch_size):
+        """Claim and run one purge; True if it finished"""
+        purge = claim_purge()
+        if purge is None:
+            return False
+        self.stdout.write(f"Purging room {purge.room_name!r} ({purge.room_id})")
+        if run_purge(purge, batch_size, on_progress=self.report):
+            self.stdout.write(self.style.SUCCESS(f"Purged room {purge.room_id}: {self.summary(purge)}"))
+            return True
+        # Retried on a later round
+        self.stderr.write(f"Purge of room {purge.room_id} failed (attempt {purge.attempts}):\n{purge.error}")
+        return False
+
+    def report(self, purge, kind):
+        if self.verbose:
+            self.stdout.write(f"  {kind}: {purge.progress[kind]}")
+
+    def summary(self, purge):
+        return ', '.join(f"{count} {kind}" for kind, count in purge.progress.items()) or 'nothing left'
@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from rooms.models import UploadSession
+from rooms.uploads import discard_session_file
+
+
+class Command(BaseCommand):
+    help = "Delete resumable upload sessions (and their part files) that have gone idle"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=settings.UPLOAD_SESSION_TTL_HOURS,
+                            help='Idle time after which a session is considered abandoned')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+        stale = UploadSession.objects.filter(updated_at__lt=cutoff)
+
+        purged = 0
+        for session in stale.iterator():
+            discard_session_file(session)
+            session.delete()
+            purged += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Purged {purged} stale upload session(s)"))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from rooms.archive import rebuild_segment_catalog
+
+
+class Command(BaseCommand):
+    help = (
+        "Catalog archive segment files the database doesn't know about, e.g. "
+        "after restoring a database backup, and remove leftover ones"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report what would change without changing it')
+
+    def handle(self, *args, **options):
+        cataloged, removed, missing = rebuild_segment_catalog(dry_run=options['dry_run'])
+        catalog, remove = ('Would catalog', 'would remove') if options['dry_run'] else ('Cataloged', 'removed')
+        self.stdout.write(f"{catalog} {cataloged} segment(s), {remove} {removed} leftover file(s)")
+        for path in missing:
+            self.stderr.write(f"Segment file missing: {path}")
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from rooms.blobs import reconcile_blob_refs
+from rooms.quotas import reconcile_room_usage
+
+
+class Command(BaseCommand):
+    help = "Recompute per-room storage usage and blob reference counts from the file rows"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep running, reconciling every N seconds (default: run once)')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        while True:
+            rooms = reconcile_room_usage(batch_size=options['batch_size'])
+            corrected, released = reconcile_blob_refs(batch_size=options['batch_size'])
+            if rooms or corrected or released or not options['interval']:
+                self.stdout.write(
+                    f"Corrected storage usage for {rooms} room(s); fixed {corrected} blob "
+                    f"reference count(s) and released {released} unused blob(s)"
+                )
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
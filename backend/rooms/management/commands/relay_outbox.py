@@ -0,0 +1,45 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+from django.db import InterfaceError, OperationalError, close_old_connections
+
+from rooms.outbox import MAX_BACKOFF, relay_batch
+
+
+class Command(BaseCommand):
+    help = "Deliver queued broadcast events from the outbox table to the channel layer"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=0.2,
+                            help='Seconds to wait when the outbox is empty')
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--once', action='store_true', help='Drain the outbox once and exit')
+
+    def handle(self, *args, **options):
+        asyncio.run(self.relay(options['batch_size'], options['poll_interval'], options['once']))
+
+    async def relay(self, batch_size, poll_interval, once):
+        channel_layer = get_channel_layer()
+        backoff = poll_interval
+        while True:
+            try:
+                sent, failed = await relay_batch(channel_layer, batch_size)
+            except (InterfaceError, OperationalError) as exc:
+                if once:
+                    raise
+                # A batch claimed before the error is sent again once its claim expires
+                self.stderr.write(f"Database error relaying the outbox, retrying in {backoff:g}s: {exc}")
+                await sync_to_async(close_old_connections)()
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                continue
+            backoff = poll_interval
+            if failed:
+                self.stderr.write(f"Relayed {sent} event(s); {failed} will be retried")
+            if sent + failed >= batch_size:
+                continue  # more are probably waiting
+            if once:
+                break
+            await asyncio.sleep(poll_interval)
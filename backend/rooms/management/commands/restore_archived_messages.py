@@ -0,0 +1,30 @@
+from datetime import date, datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from rooms.archive import restore_room
+from rooms.models import Room
+
+
+class Command(BaseCommand):
+    help = "Move a room's archived messages back into the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('room_id')
+        parser.add_argument('--since', help='Only restore back to this day, as YYYY-MM-DD (default: everything)')
+
+    def handle(self, *args, **options):
+        try:
+            room = Room.objects.get(id=options['room_id'])
+        except (Room.DoesNotExist, ValueError):
+            raise CommandError(f"Room {options['room_id']} not found")
+        since = None
+        if options['since']:
+            try:
+                since = timezone.make_aware(datetime.combine(date.fromisoformat(options['since']), time.min))
+            except ValueError:
+                raise CommandError("--since must be a date such as 2024-01-31")
+
+        restored = restore_room(room.id, since=since)
+        self.stdout.write(self.style.SUCCESS(f"Restored {restored} message(s) of '{room.name}'"))
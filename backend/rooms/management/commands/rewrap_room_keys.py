@@ -0,0 +1,49 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from rooms.keyring import current_master_key_id, rewrap_room_key
+from rooms.models import RoomKey
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-wrap room data keys that are wrapped by an older master key with the current one; "
+        "messages aren't touched"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to pause between batches')
+
+    def handle(self, *args, **options):
+        current = current_master_key_id()
+        pending = RoomKey.objects.exclude(master_key_id=current).order_by('pk')
+        rewrapped = skipped = 0
+        started = time.monotonic()
+        last_pk = None
+
+        while True:
+            page = pending.filter(pk__gt=last_pk) if last_pk else pending
+            batch = list(page[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            for room_key in batch:
+                if rewrap_room_key(room_key):
+                    rewrapped += 1
+                else:
+                    skipped += 1
+            self.stdout.write(f"Re-wrapped {rewrapped} key(s) so far")
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Re-wrapped {rewrapped} key(s) with master key {current!r} in {elapsed:.1f}s; "
+            f"{skipped} changed meanwhile"
+        ))
+        left = RoomKey.objects.exclude(master_key_id=current).values_list('master_key_id', flat=True).distinct()
+        if left:
+            self.stdout.write(f"Still wrapped by: {', '.join(left)}; run again before removing those master keys")
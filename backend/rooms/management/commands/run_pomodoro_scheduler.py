@@ -0,0 +1,33 @@
+import asyncio
+
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from rooms.pomodoro import PomodoroScheduler
+
+
+class Command(BaseCommand):
+    help = (
+        "Advance running pomodoro timers to their next phase as they run out and broadcast "
+        "the change; also writes timers changed in Redis back to the database"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tick', type=float, default=0.1,
+                            help='Timer resolution in seconds')
+        parser.add_argument('--sync-interval', type=float, default=1.0,
+                            help='Seconds between reads of upcoming deadlines from Redis')
+        parser.add_argument('--flush-interval', type=float, default=5.0,
+                            help='Seconds between writes of changed timers to the database')
+        parser.add_argument('--rebuild-check-interval', type=float, default=60.0,
+                            help='Seconds between checks that Redis still holds the timers')
+
+    def handle(self, *args, **options):
+        scheduler = PomodoroScheduler(
+            get_channel_layer(),
+            tick=options['tick'],
+            sync_interval=options['sync_interval'],
+            flush_interval=options['flush_interval'],
+            rebuild_check_interval=options['rebuild_check_interval'],
+        )
+        asyncio.run(scheduler.run())
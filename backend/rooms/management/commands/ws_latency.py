@@ -0,0 +1,45 @@
+import statistics
+
+from django.core.management.base import BaseCommand
+
+from rooms.latency import latency_reports
+
+
+class Command(BaseCommand):
+    help = (
+        "Summarize the round trip times and clock offsets that open websocket "
+        "connections last reported from their clock sync"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=10,
+                            help='Show this many rooms, slowest first')
+
+    def handle(self, *args, **options):
+        reports = latency_reports()
+        if not reports:
+            self.stdout.write("No connections have reported their latency")
+            return
+
+        self.stdout.write(f"{len(reports)} connection(s)")
+        self.stdout.write(f"{'':<38}{'conns':>6}{'p50 rtt ms':>12}{'p95 rtt ms':>12}{'max |offset| ms':>17}")
+        self.stdout.write(self.summary_row('all rooms', reports))
+        by_room = {}
+        for report in reports:
+            by_room.setdefault(report['room_id'], []).append(report)
+        rows = sorted(by_room.items(), key=lambda item: -self.percentile([r['rtt'] for r in item[1]], 0.95))
+        for room_id, room_reports in rows[:options['rooms']]:
+            self.stdout.write(self.summary_row(room_id, room_reports))
+
+    def summary_row(self, label, reports):
+        rtts = [report['rtt'] for report in reports]
+        worst_offset = max(abs(report['offset']) for report in reports)
+        return (
+            f"{label:<38}{len(reports):>6}{statistics.median(rtts):>12.1f}"
+            f"{self.percentile(rtts, 0.95):>12.1f}{worst_offset:>17.1f}"
+        )
+
+    @staticmethod
+    def percentile(values, fraction):
+        values = sorted(values)
+        return values[max(int(len(values) * fraction + 0.5) - 1, 0)]
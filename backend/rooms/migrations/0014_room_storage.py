@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 22:27
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_storage_used(apps, schema_editor):
+    Room = apps.get_model('rooms', 'Room')
+    RoomFile = apps.get_model('rooms', 'RoomFile')
+    totals = RoomFile.objects.filter(room=OuterRef('pk')).values('room').annotate(total=Sum('file_size')).values('total')
+    Room.objects.update(storage_used=Coalesce(Subquery(totals), 0, output_field=models.PositiveBigIntegerField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0013_fileblob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='storage_quota',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='storage_used',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_storage_used, migrations.RunPython.noop),
+    ]
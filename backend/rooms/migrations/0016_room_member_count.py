@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 22:58
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_member_count(apps, schema_editor):
+    Room = apps.get_model('rooms', 'Room')
+    RoomMembership = apps.get_model('rooms', 'RoomMembership')
+    counts = RoomMembership.objects.filter(room=OuterRef('pk')).values('room').annotate(total=Count('pk')).values('total')
+    Room.objects.update(member_count=Coalesce(Subquery(counts), 0, output_field=models.PositiveIntegerField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0015_outbox_event'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_member_count, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='WaitlistEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='waitlist', to='rooms.room')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='room_waitlist_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room', 'created_at'], name='rooms_waitl_room_id_26036b_idx')],
+                'unique_together': {('room', 'user')},
+            },
+        ),
+    ]
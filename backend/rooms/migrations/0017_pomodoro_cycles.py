@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:40
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0016_room_member_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pomodorosession',
+            name='completed_cycles',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='pomodorosession',
+            name='long_break_interval',
+            field=models.PositiveIntegerField(default=4),
+        ),
+        migrations.AddField(
+            model_name='pomodorosession',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
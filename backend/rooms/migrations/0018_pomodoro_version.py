@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0017_pomodoro_cycles'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pomodorosession',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='pomodorosession',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:34
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0019_partition_messages'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSegment',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('path', models.CharField(max_length=255, unique=True)),
+                ('message_count', models.PositiveIntegerField()),
+                ('newest_at', models.DateTimeField()),
+                ('oldest_at', models.DateTimeField()),
+                ('size', models.PositiveBigIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='message_segments', to='rooms.room')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room', 'newest_at'], name='rooms_messa_room_id_87dfe2_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0020_message_segment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='ciphertext',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='content',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rooms', '0021_message_ciphertext'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('wrapped_key', models.BinaryField()),
+                ('master_key_id', models.CharField(max_length=32)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='keys', to='rooms.room')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['master_key_id'], name='rooms_roomk_master__67896b_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('is_active', True)), fields=('room',), name='one_active_key_per_room')],
+            },
+        ),
+    ]
@@ -0,0 +1,201 @@
+"""
+Range-partition rooms_message by created_at month (see rooms/partitions.py)
+without taking the table offline.
+
+Non-atomic, in steps that each commit on their own:
+1. rooms_message_new is created partitioned, with its partitions, primary
+   key, indexes (under temporary names) and foreign keys.
+2. A trigger on rooms_message mirrors every insert, update and delete into
+   it from then on.
+3. Existing rows are copied across in batches of BATCH_SIZE, in id order.
+   Each batch holds share locks on just its own rows, so a row can't be
+   changed or deleted between being read and being copied.
+4. In one short transaction the old table is dropped and the new one takes
+   its name and index names. This is the only step holding an ACCESS
+   EXCLUSIVE lock. It waits at most LOCK_TIMEOUT for it, and tries again
+   up to SWAP_ATTEMPTS times, so queries don't queue up behind it.
+A run that fails before the swap leaves rooms_message untouched, and the
+next run starts over. Reversing works the same way, back to a plain table.
+
+The copy needs as much free disk as the table and its indexes take up.
+"""
+import re
+import time
+from datetime import datetime, timezone
+
+from django.db import OperationalError, migrations, transaction
+
+from rooms.partitions import MONTHS_AHEAD, add_months, create_partition_sql, is_partitioned, month_start
+
+NEW_TABLE = 'rooms_message_new'
+SYNC_FUNCTION = 'rooms_message_sync'
+BATCH_SIZE = 5000
+LOCK_TIMEOUT = '5s'
+SWAP_ATTEMPTS = 20
+
+
+def _rebuild_message_table(connection, create_sql, primary_key, create_partitions=None):
+    """
+    Swap rooms_message for the table `create_sql` makes as NEW_TABLE, with
+    the same rows, indexes and outgoing foreign keys
+    """
+    with connection.cursor() as cursor:
+        # Left behind by an earlier run that stopped before the swap
+        cursor.execute(f"DROP TRIGGER IF EXISTS {SYNC_FUNCTION} ON rooms_message")
+        cursor.execute(f"DROP FUNCTION IF EXISTS {SYNC_FUNCTION}()")
+        cursor.execute(f"DROP TABLE IF EXISTS {NEW_TABLE}")
+
+        cursor.execute(
+            """
+            SELECT c.relname, pg_get_indexdef(i.indexrelid) FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE i.indrelid = 'rooms_message'::regclass AND NOT i.indisprimary
+            """
+        )
+        indexes = [
+            (name, f"{name[:50]}_new", re.sub(
+                r'^CREATE (UNIQUE )?INDEX \S+ ON (ONLY )?\S+ USING ',
+                lambda match: f"CREATE {match[1] or ''}INDEX {name[:50]}_new ON {NEW_TABLE} USING ",
+                definition,
+            ))
+            for name, definition in cursor.fetchall()
+        ]
+        cursor.execute(
+            """
+            SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+            WHERE conrelid = 'rooms_message'::regclass AND contype = 'f'
+            """
+        )
+        foreign_keys = cursor.fetchall()
+
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(create_sql)
+        if create_partitions:
+            create_partitions(cursor)
+        cursor.execute(f"ALTER TABLE {NEW_TABLE} ADD PRIMARY KEY ({primary_key})")
+        for name, temporary_name, definition in indexes:
+            cursor.execute(definition)
+        for name, definition in foreign_keys:
+            cursor.execute(f"ALTER TABLE {NEW_TABLE} ADD CONSTRAINT {name} {definition}")
+        cursor.execute(
+            f"""
+            CREATE FUNCTION {SYNC_FUNCTION}() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                IF TG_OP <> 'INSERT' THEN
+                    DELETE FROM {NEW_TABLE} WHERE id = OLD.id AND created_at = OLD.created_at;
+                END IF;
+                IF TG_OP <> 'DELETE' THEN
+                    INSERT INTO {NEW_TABLE} SELECT NEW.*;
+                END IF;
+                RETURN NULL;
+            END
+            $$
+            """
+        )
+        cursor.execute(
+            f"CREATE TRIGGER {SYNC_FUNCTION} AFTER INSERT OR UPDATE OR DELETE ON rooms_message "
+            f"FOR EACH ROW EXECUTE FUNCTION {SYNC_FUNCTION}()"
+        )
+
+    # Rows the trigger already copied are newer than the ones read here
+    last_id = '00000000-0000-0000-0000-000000000000'
+    while last_id is not None:
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH batch AS (
+                    SELECT * FROM rooms_message WHERE id > %s ORDER BY id LIMIT %s FOR SHARE
+                ), copied AS (
+                    INSERT INTO {NEW_TABLE} SELECT * FROM batch ON CONFLICT DO NOTHING
+                )
+                SELECT id FROM batch ORDER BY id DESC LIMIT 1
+                """,
+                [last_id, BATCH_SIZE],
+            )
+            row = cursor.fetchone()
+            last_id = row[0] if row else None
+
+    for attempt in range(1, SWAP_ATTEMPTS + 1):
+        try:
+            with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+                cursor.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+                cursor.execute("LOCK TABLE rooms_message IN ACCESS EXCLUSIVE MODE")
+                # Frees the index names for the new table; takes the trigger with it
+                cursor.execute("DROP TABLE rooms_message")
+                cursor.execute(f"DROP FUNCTION {SYNC_FUNCTION}()")
+                cursor.execute(f"ALTER TABLE {NEW_TABLE} RENAME TO rooms_message")
+                cursor.execute(f"ALTER INDEX {NEW_TABLE}_pkey RENAME TO rooms_message_pkey")
+                for name, temporary_name, definition in indexes:
+                    cursor.execute(f"ALTER INDEX {temporary_name} RENAME TO {name}")
+            break
+        except OperationalError:
+            if attempt == SWAP_ATTEMPTS:
+                raise
+            time.sleep(1)
+
+    with connection.cursor() as cursor:
+        # Autovacuum never analyzes a partitioned table, so give the planner statistics now
+        cursor.execute("ANALYZE rooms_message")
+
+
+def partition_messages(apps, schema_editor):
+    connection = schema_editor.connection
+    # Tables partitioned by an earlier version of 0019 are already done
+    if connection.vendor != 'postgresql' or is_partitioned(connection):
+        return
+
+    def create_partitions(cursor):
+        cursor.execute("SELECT min(created_at) FROM rooms_message")
+        oldest = cursor.fetchone()[0]
+        now = datetime.now(timezone.utc)
+        month, last = month_start(oldest or now), add_months(month_start(now), MONTHS_AHEAD)
+        while month <= last:
+            cursor.execute(create_partition_sql(month, parent=NEW_TABLE))
+            month = add_months(month, 1)
+
+    _rebuild_message_table(
+        connection,
+        f"CREATE TABLE {NEW_TABLE} (LIKE rooms_message INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)",
+        primary_key='id, created_at',
+        create_partitions=create_partitions,
+    )
+
+
+def unpartition_messages(apps, schema_editor):
+    """
+    Back to one plain table. Partitions detached meanwhile are left alone, and
+    references to their messages are cleared so the constraints can return.
+    """
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql' or not is_partitioned(connection):
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE rooms_message SET replied_to_id = NULL
+            WHERE replied_to_id IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM rooms_message m WHERE m.id = rooms_message.replied_to_id)
+            """
+        )
+        for table in ('rooms_messageseen', 'rooms_reaction'):
+            cursor.execute(
+                f"DELETE FROM {table} WHERE NOT EXISTS "
+                f"(SELECT 1 FROM rooms_message m WHERE m.id = {table}.message_id)"
+            )
+    _rebuild_message_table(
+        connection,
+        f"CREATE TABLE {NEW_TABLE} (LIKE rooms_message INCLUDING DEFAULTS)",
+        primary_key='id',
+    )
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('rooms', '0023_room_purge'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_messages, unpartition_messages),
+    ]
@@ -1,7 +1,14 @@
 from django.db import models
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
 import uuid
 
+class LiveRoomManager(models.Manager):
+    """Rooms that haven't been deleted"""
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
 class Room(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=255)
@@ -12,9 +19,24 @@ class Room(models.Model):
     
     # Relationships
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='owned_rooms')
+
+    # Number of memberships, kept current by joins and leaves (see rooms/admission.py)
+    member_count = models.PositiveIntegerField(default=0)
+
+    # Bytes of shared files, kept current by uploads and deletes (see rooms/quotas.py)
+    storage_used = models.PositiveBigIntegerField(default=0)
+    # Overrides ROOM_STORAGE_QUOTA_MB for this room, in bytes
+    storage_quota = models.PositiveBigIntegerField(null=True, blank=True)
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Set when the room is deleted; its rows and files are removed afterwards
+    # by a RoomPurge (see rooms/purge.py)
+    deleted_at = models.DateTimeField(null=True, blank=True)
+
+    objects = LiveRoomManager()
+    # Including deleted rooms awaiting their purge
+    all_objects = models.Manager()
 
     def __str__(self):
         return self.name
@@ -38,15 +60,38 @@ class RoomMembership(models.Model):
     def __str__(self):
         return f"{self.user.username} in {self.room.name}"
 
+class WaitlistEntry(models.Model):
+    """A user waiting for a seat in a full room; admitted oldest first"""
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='waitlist')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='room_waitlist_entries')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('room', 'user')
+        indexes = [
+            models.Index(fields=['room', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} waiting for {self.room.name}"
+
 class Message(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='messages', null=True, blank=True)
-    content = models.TextField() # Encrypted content
+    # Encrypted content (see utils/encryption_service.py). Older messages hold
+    # a Fernet token in `content` until migrate_message_ciphertext moves them
+    # to `ciphertext`; new ones leave `content` empty.
+    content = models.TextField(blank=True, default='')
+    ciphertext = models.BinaryField(null=True, blank=True)
     is_edited = models.BooleanField(default=False)
     
     # Reply feature: reference to the message being replied to
-    replied_to = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='replies')
+    # Not a database constraint: the partitioned table's `id` isn't unique on
+    # its own (see rooms/partitions.py)
+    replied_to = models.ForeignKey(
+        'self', on_delete=models.SET_NULL, null=True, blank=True, related_name='replies', db_constraint=False
+    )
     
     # Optional file attachment
     file = models.ForeignKey('RoomFile', on_delete=models.SET_NULL, null=True, blank=True, related_name='messages')
@@ -60,14 +105,70 @@ class Message(models.Model):
     ]
     message_type = models.CharField(max_length=10, choices=MESSAGE_TYPES, default='chat')
     
+    # The partition key on PostgreSQL; filter on it to read fewer partitions
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', 'created_at']),
+        ]
+
     def __str__(self):
         return f"Message by {self.sender} in {self.room}"
 
+    @property
+    def stored_content(self):
+        """The encrypted content in whichever format the row has, for EncryptionService.decrypt"""
+        return self.ciphertext if self.ciphertext is not None else self.content
+
+class MessageSegment(models.Model):
+    """A file of a room's archived messages; see rooms/archive.py"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='message_segments')
+    # Relative to settings.MESSAGE_ARCHIVE_ROOT
+    path = models.CharField(max_length=255, unique=True)
+    message_count = models.PositiveIntegerField()
+    newest_at = models.DateTimeField()
+    oldest_at = models.DateTimeField()
+    size = models.PositiveBigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', 'newest_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.message_count} archived message(s) of {self.room_id}"
+
+class RoomKey(models.Model):
+    """
+    A room's data key, wrapped (encrypted) by one of the master keys; see
+    rooms/keyring.py. Messages name the key they were encrypted with, so a
+    room keeps its old keys once a new one takes over.
+    """
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='keys')
+    wrapped_key = models.BinaryField()
+    # Which of settings.MESSAGE_MASTER_KEYS wraps it
+    master_key_id = models.CharField(max_length=32)
+    # The key new messages of the room are encrypted with
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room'], condition=models.Q(is_active=True), name='one_active_key_per_room'),
+        ]
+        indexes = [
+            models.Index(fields=['master_key_id']),
+        ]
+
+    def __str__(self):
+        return f"Key {self.pk} of {self.room_id}"
+
 class MessageSeen(models.Model):
-    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='seen_by')
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='seen_by', db_constraint=False)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='seen_messages')
     seen_at = models.DateTimeField(auto_now_add=True)
 
@@ -81,7 +182,7 @@ class MessageSeen(models.Model):
         return f"{self.user.username} saw message {self.message.id}"
 
 class Reaction(models.Model):
-    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='reactions')
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='reactions', db_constraint=False)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='message_reactions')
     emoji = models.CharField(max_length=10)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -112,6 +213,29 @@ class PomodoroSession(models.Model):
     work_duration = models.IntegerField(default=25*60)
     short_break_duration = models.IntegerField(default=5*60)
     long_break_duration = models.IntegerField(default=15*60)
+    # Every this many focus phases the break is a long one
+    long_break_interval = models.PositiveIntegerField(default=4)
+
+    # Focus phases finished so far; advanced by the pomodoro scheduler
+    completed_cycles = models.PositiveIntegerField(default=0)
+    # The live timer is kept in Redis (see rooms/pomodoro_state.py); these
+    # track which of its changes the row has caught up with
+    version = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def duration_for(self, phase):
+        return {
+            'work': self.work_duration,
+            'short_break': self.short_break_duration,
+            'long_break': self.long_break_duration,
+        }[phase]
+
+    def phase_ends_at(self):
+        """When the running phase is over, or None while paused"""
+        if not self.is_running or not self.start_time:
+            return None
+        from datetime import timedelta
+        return self.start_time + timedelta(seconds=self.remaining_seconds)
 
     def get_current_remaining(self):
         if not self.is_running or not self.start_time:
@@ -134,6 +258,24 @@ def room_file_path(instance, filename):
     return f"room_files/{instance.room.id}/{new_filename}"
 
 
+def blob_file_path(instance, filename):
+    """Content-addressed path: room_files/blobs/<aa>/<bb>/<sha256>"""
+    digest = instance.sha256
+    return f"room_files/blobs/{digest[:2]}/{digest[2:4]}/{digest}"
+
+
+class FileBlob(models.Model):
+    """A stored file shared by every RoomFile with identical content"""
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    file = models.FileField(upload_to=blob_file_path)
+    size = models.PositiveBigIntegerField()  # in bytes
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Blob {self.sha256[:12]} ({self.ref_count} refs)"
+
+
 class RoomFile(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='files')
@@ -145,9 +287,11 @@ class RoomFile(models.Model):
     )
     
     # File info
+    # For deduplicated uploads `file` points at the shared blob's path
     file = models.FileField(upload_to=room_file_path)
+    blob = models.ForeignKey(FileBlob, on_delete=models.PROTECT, null=True, blank=True, related_name='room_files')
     original_filename = models.CharField(max_length=255)
-    file_size = models.PositiveIntegerField()  # in bytes
+    file_size = models.PositiveBigIntegerField()  # in bytes
     file_type = models.CharField(max_length=100)  # MIME type
     
     # Metadata
@@ -184,3 +328,89 @@ class RoomFile(models.Model):
             size /= 1024
         return f"{size:.1f} TB"
 
+
+
+class UploadSession(models.Model):
+    """An in-progress resumable upload; becomes a RoomFile on completion"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='upload_sessions')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='upload_sessions')
+
+    original_filename = models.CharField(max_length=255)
+    file_size = models.PositiveBigIntegerField()  # declared total, in bytes
+    file_type = models.CharField(max_length=100)
+    description = models.TextField(blank=True)
+    checksum = models.CharField(max_length=64, blank=True)  # optional client-supplied SHA-256
+
+    received_bytes = models.PositiveBigIntegerField(default=0)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Upload of {self.original_filename} ({self.received_bytes}/{self.file_size})"
+
+    @property
+    def temp_path(self):
+        import os
+        return os.path.join(settings.UPLOAD_SESSION_ROOT, f"{self.id}.part")
+
+    @property
+    def is_complete(self):
+        return self.received_bytes >= self.file_size
+
+
+class OutboxEvent(models.Model):
+    """
+    A channel layer event waiting to be sent, written in the same transaction
+    as the change it announces and delivered by the relay_outbox command.
+    """
+    group = models.CharField(max_length=100)
+    payload = models.JSONField(encoder=DjangoJSONEncoder)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # Not before this time: set when claimed by the relay and when backing off
+    available_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['available_at', 'id']),
+        ]
+
+    def __str__(self):
+        return f"{self.payload.get('type')} to {self.group}"
+
+
+class RoomPurge(models.Model):
+    """
+    The removal of a deleted room's rows and files, done in batches by the
+    purge_rooms command (see rooms/purge.py). Outlives the room, so it holds
+    the room's id rather than a foreign key.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    room_id = models.UUIDField(unique=True)
+    room_name = models.CharField(max_length=255)
+    requested_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='room_purges')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    # Rows (or files) removed so far, by kind
+    progress = models.JSONField(default=dict)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Touched after every batch, so a purge whose worker died can be told apart
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'updated_at']),
+        ]
+
+    def __str__(self):
+        return f"Purge of {self.room_name} ({self.status})"
@@ -0,0 +1,86 @@
+"""
+Garbage collection of files under MEDIA_ROOT/room_files/ that no row owns.
+
+Orphans appear when rows go away without their storage: rooms deleted with
+their files cascading, crashes between writing a file and committing its row,
+or bugs. The walk is a lazy os.scandir traversal checked against the database
+a batch at a time, so neither the directory listing nor the set of referenced
+names is ever held in memory whole.
+"""
+import os
+import time
+
+from .models import FileBlob, RoomFile
+from .thumbnails import DERIVATIVES
+
+ROOT = 'room_files'
+
+_DERIVATIVE_SUFFIXES = tuple(f'.{kind}.webp' for kind in DERIVATIVES)
+
+
+def iter_stored_files(root):
+    """Yield (path, stat) for every regular file below `root`, depth first"""
+    stack = [root]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry.path, entry.stat(follow_symlinks=False)
+
+
+def owner_name(name):
+    """The stored file a name belongs to: itself, or the original of a derivative"""
+    for suffix in _DERIVATIVE_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def _referenced(names):
+    referenced = set(FileBlob.objects.filter(file__in=names).values_list('file', flat=True))
+    referenced.update(RoomFile.objects.filter(file__in=names).values_list('file', flat=True))
+    return referenced
+
+
+def collect_orphan_files(storage, batch_size=500, min_age=3600, dry_run=False):
+    """
+    Delete unreferenced files older than `min_age` seconds. The age guard
+    covers uploads whose bytes are written before their row commits.
+    Returns (scanned, removed, bytes_removed).
+    """
+    media_root = storage.path('')
+    cutoff = time.time() - min_age
+    scanned = removed = freed = 0
+    batch = []
+
+    def sweep(batch):
+        nonlocal removed, freed
+        referenced = _referenced({owner for _, _, owner in batch})
+        for path, stat, owner in batch:
+            if owner in referenced or stat.st_mtime > cutoff:
+                continue
+            if not dry_run:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+            removed += 1
+            freed += stat.st_size
+
+    for path, stat in iter_stored_files(storage.path(ROOT)):
+        scanned += 1
+        name = os.path.relpath(path, media_root).replace(os.sep, '/')
+        batch.append((path, stat, owner_name(name)))
+        if len(batch) >= batch_size:
+            sweep(batch)
+            batch = []
+    if batch:
+        sweep(batch)
+
+    return scanned, removed, freed
@@ -0,0 +1,109 @@
+"""
+Transactional outbox for channel layer broadcasts made by the HTTP views.
+
+Views don't call group_send themselves. They write the events with
+`enqueue_broadcast` in the same transaction as the change being announced,
+so an event exists exactly when its change committed, and responses don't
+wait on Redis. The relay_outbox command drains the table to the channel
+layer in batches: events for one group go out in order, different groups
+in parallel. A failed send is retried with backoff, and everything queued
+after it for that group waits until it is out. Attempts are counted per
+event, and events are never dropped: past MAX_BACKOFF they are retried
+every MAX_BACKOFF seconds for as long as it takes, and past ALERT_ATTEMPTS
+each failure is logged as an error.
+
+Delivery is at least once. A relay that dies between sending and deleting
+a batch sends it again once the claim expires. Groups with claimed or
+backing-off events are skipped until those are out, which keeps each room's
+events in order across retries and concurrent relays.
+"""
+import asyncio
+import logging
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+# How long a claimed batch is hidden from other relays while it is sent
+CLAIM_TIMEOUT = timedelta(seconds=30)
+MAX_BACKOFF = 60  # seconds
+# Failures in a row after which an event's retries are logged as errors
+ALERT_ATTEMPTS = 8
+
+
+def enqueue_broadcast(room_id, *events):
+    """Queue events for a room's group; call inside the transaction making the change"""
+    OutboxEvent.objects.bulk_create(
+        [OutboxEvent(group=f"room_{room_id}", payload=event) for event in events]
+    )
+
+
+def claim_batch(batch_size=100):
+    """Lock in the oldest due events, in order, and hide them from other relays"""
+    now = timezone.now()
+    # Groups with events claimed or backing off wait for those to go first
+    held_back = OutboxEvent.objects.filter(available_at__gt=now).values('group')
+    with transaction.atomic():
+        batch = list(
+            OutboxEvent.objects.select_for_update(skip_locked=True)
+            .filter(available_at__lte=now).exclude(group__in=held_back)
+            .order_by('id')[:batch_size]
+        )
+        if batch:
+            OutboxEvent.objects.filter(id__in=[event.id for event in batch]).update(
+                available_at=now + CLAIM_TIMEOUT
+            )
+    return batch
+
+
+def complete_events(sent, failed, held=()):
+    """
+    Delete sent events and push failed ones (attempts so far -> ids) back
+    with an increasing delay. Events `held` back behind a failure weren't
+    tried; they are only unclaimed, and go out once the failed one has.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        if sent:
+            OutboxEvent.objects.filter(id__in=sent).delete()
+        if held:
+            OutboxEvent.objects.filter(id__in=held).update(available_at=now)
+        for attempts, ids in failed.items():
+            if attempts >= ALERT_ATTEMPTS:
+                logger.error("Outbox event(s) %s failed %d times in a row; still retrying", ids, attempts)
+            OutboxEvent.objects.filter(id__in=ids).update(
+                attempts=F('attempts') + 1,
+                available_at=now + timedelta(seconds=min(2 ** attempts, MAX_BACKOFF))
+            )
+
+
+async def relay_batch(channel_layer, batch_size=100):
+    """Send one batch; returns (sent, retried) counts, retried including those held back"""
+    batch = await sync_to_async(claim_batch)(batch_size)
+    by_group = {}
+    for event in batch:
+        by_group.setdefault(event.group, []).append(event)
+
+    sent, failed, held = [], {}, []
+
+    async def send_group(events):
+        for position, event in enumerate(events):
+            try:
+                await channel_layer.group_send(event.group, event.payload)
+            except Exception as exc:
+                logger.warning("Outbox send to %s failed: %s", event.group, exc)
+                failed.setdefault(event.attempts + 1, []).append(event.id)
+                # The rest of the group waits behind it, so it stays in order
+                held.extend(e.id for e in events[position + 1:])
+                return
+            sent.append(event.id)
+
+    await asyncio.gather(*(send_group(events) for events in by_group.values()))
+    await sync_to_async(complete_events)(sent, failed, held)
+    return len(sent), sum(len(ids) for ids in failed.values()) + len(held)
@@ -0,0 +1,148 @@
+"""
+Monthly partitions of the message table.
+
+On PostgreSQL rooms_message is range-partitioned on created_at, one partition
+per calendar month (UTC) named rooms_message_pYYYY_MM. The primary key is
+(id, created_at), since a partitioned table's unique keys have to include the
+partition key. Django still treats `id` alone as the key; ids are UUID4s, so
+uniqueness across partitions isn't enforced by the database.
+
+Foreign keys into the table (MessageSeen, Reaction and replies) can't point at
+a partitioned table's `id` alone either, so they are db_constraint=False and
+Django's on_delete handling is what keeps them tidy.
+
+There is no default partition, so a message can only be inserted into a month
+that already has one. The ensure_message_partitions command keeps
+MONTHS_AHEAD months ready. Old months are taken out of the table with
+detach_message_partitions. It detaches CONCURRENTLY, so writes to the live
+months carry on, and the detached tables stay around until archived or
+dropped.
+
+Queries that filter on room_id and a created_at range only visit the months
+in that range. Ordered scans such as a room's latest messages read the
+partitions newest first and stop once they have enough rows.
+
+Everywhere else (SQLite in development) the table is a plain one, and these
+helpers do nothing.
+"""
+from datetime import date, datetime, timezone as dt_timezone
+
+from django.db import connection, transaction
+
+PARENT = 'rooms_message'
+# Months after the current one that always have a partition
+MONTHS_AHEAD = 3
+# How long partition DDL waits for a lock before giving up until the next run,
+# rather than queueing every insert behind it
+LOCK_TIMEOUT = '5s'
+
+
+def month_start(value):
+    """First day of the month a date or datetime (UTC) falls in"""
+    if isinstance(value, datetime):
+        value = value.astimezone(dt_timezone.utc).date()
+    return value.replace(day=1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"{PARENT}_p{month:%Y_%m}"
+
+
+def create_partition_sql(month, parent=PARENT):
+    return (
+        f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF {parent} "
+        f"FOR VALUES FROM ('{month:%Y-%m-%d} 00:00+00') TO ('{add_months(month, 1):%Y-%m-%d} 00:00+00')"
+    )
+
+
+def is_partitioned(using=None):
+    conn = using or connection
+    if conn.vendor != 'postgresql':
+        return False
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [PARENT])
+        row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def message_partitions():
+    """(name, month, approximate rows) of every attached partition, oldest first"""
+    if not is_partitioned():
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT child.relname, child.reltuples
+            FROM pg_inherits
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = %s::regclass
+            ORDER BY child.relname
+            """,
+            [PARENT],
+        )
+        rows = cursor.fetchall()
+    partitions = []
+    for name, estimate in rows:
+        try:
+            year, month = name[len(PARENT) + 2:].split('_')
+            month = date(int(year), int(month), 1)
+        except ValueError:
+            continue  # not one of ours
+        partitions.append((name, month, max(int(estimate), 0)))
+    return partitions
+
+
+def ensure_message_partitions(ahead=MONTHS_AHEAD, now=None):
+    """Create any missing partitions up to `ahead` months from now; returns their names"""
+    current = month_start(now or datetime.now(dt_timezone.utc))
+    return ensure_partitions_between(current, add_months(current, ahead))
+
+
+def ensure_partitions_between(first, last):
+    """
+    Create any missing partitions for the months from `first` to `last`
+    (dates or datetimes), e.g. before putting old messages back; returns
+    their names
+    """
+    if not is_partitioned():
+        return []
+    existing = {name for name, month, rows in message_partitions()}
+    created = []
+    month, last = month_start(first), month_start(last)
+    while month <= last:
+        if partition_name(month) not in existing:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+                cursor.execute(create_partition_sql(month))
+            created.append(partition_name(month))
+        month = add_months(month, 1)
+    return created
+
+
+def detach_message_partition(name, drop=False):
+    """
+    Take one month out of the message table without blocking writes to the
+    others, optionally dropping it afterwards. Must run outside a
+    transaction, as DETACH ... CONCURRENTLY can't run inside one.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT inhdetachpending FROM pg_inherits WHERE inhrelid = to_regclass(%s)", [name]
+        )
+        row = cursor.fetchone()
+        cursor.execute(f"SET lock_timeout = '{LOCK_TIMEOUT}'")
+        try:
+            if row is not None and row[0]:
+                # An earlier detach was interrupted part-way; complete it
+                cursor.execute(f"ALTER TABLE {PARENT} DETACH PARTITION {name} FINALIZE")
+            else:
+                cursor.execute(f"ALTER TABLE {PARENT} DETACH PARTITION {name} CONCURRENTLY")
+            if drop:
+                cursor.execute(f"DROP TABLE {name}")
+        finally:
+            cursor.execute("RESET lock_timeout")
@@ -0,0 +1,14 @@
+from rest_framework import permissions
+
+from .access import aresolve_access, resolve_access
+
+
+class IsRoomMember(permissions.BasePermission):
+    """Members and the owner of the room named by the view's `room_id`"""
+    message = "You must be a room member to access this room."
+
+    def has_permission(self, request, view):
+        return resolve_access(request, view.kwargs['room_id']).is_member
+
+    async def ahas_permission(self, request, view):
+        return (await aresolve_access(request, view.kwargs['room_id'])).is_member
@@ -0,0 +1,228 @@
+"""
+Server-side pomodoro timers.
+
+A running timer ends its phase at `phase_ends_at()`. The
+run_pomodoro_scheduler command moves timers on to their next phase as those
+deadlines pass: focus, then a short break, or a long one every
+`long_break_interval` focus phases. It broadcasts the new state to the room,
+so clients never have to decide that a phase is over.
+
+Timers live in Redis (rooms/pomodoro_state.py), which also indexes the
+deadline of every running one. Each second the scheduler copies the
+deadlines coming up soon into an in-process TimerWheel, which fires them to
+the tick.
+
+A timer is re-read before it is advanced, so a pause that lands just before
+a deadline wins. Several schedulers can run side by side without advancing a
+timer twice. The scheduler also writes changed timers back to the table and
+reloads Redis from the table when Redis has lost its data.
+"""
+import asyncio
+import logging
+import math
+import time
+from datetime import timedelta
+
+import redis
+from asgiref.sync import sync_to_async
+from django.db import InterfaceError, OperationalError, close_old_connections
+from django.http import Http404
+from django.utils import timezone
+
+from analytics.pipeline import record_focus_phases
+from .pomodoro_state import (
+    DEADLINES_KEY, LOADED_KEY, aupdate_state, flush_pomodoro_state, rebuild_pomodoro_state,
+    save_sessions
+)
+from .serializers import PomodoroSerializer
+from utils.redis_client import aget_redis
+
+logger = logging.getLogger(__name__)
+
+# A timer left unattended longer than this many phases restarts its current
+# phase from now rather than replaying every phase it missed
+MAX_CATCH_UP_PHASES = 100
+# Timers advanced concurrently
+FIRE_BATCH_SIZE = 100
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel. Deadlines are rounded up to a tick and kept in the
+    slot for that tick, so scheduling, rescheduling and cancelling are O(1)
+    and each tick only looks at the timers hashed to one slot, however many
+    timers there are in total.
+    """
+
+    def __init__(self, tick=0.1, slots=4096):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        self.scheduled = {}  # key -> tick it is due at
+        self.current = math.floor(time.time() / tick)  # last tick processed
+
+    def __len__(self):
+        return len(self.scheduled)
+
+    def schedule(self, key, when):
+        """Fire `key` at unix time `when`, replacing any earlier schedule for it"""
+        due = max(math.ceil(when / self.tick), self.current + 1)
+        previous = self.scheduled.get(key)
+        if previous == due:
+            return
+        if previous is not None:
+            del self.slots[previous % len(self.slots)][key]
+        self.scheduled[key] = due
+        self.slots[due % len(self.slots)][key] = due
+
+    def cancel(self, key):
+        due = self.scheduled.pop(key, None)
+        if due is not None:
+            del self.slots[due % len(self.slots)][key]
+
+    def advance(self, now):
+        """Move the wheel on to unix time `now`; returns the keys that came due"""
+        target = math.floor(now / self.tick)
+        fired = []
+        # After a long stall every slot is visited once, not once per tick
+        for tick in range(self.current + 1, min(target, self.current + len(self.slots)) + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for key in [key for key, due in slot.items() if due <= target]:
+                del slot[key]
+                del self.scheduled[key]
+                fired.append(key)
+        self.current = max(self.current, target)
+        return fired
+
+    def next_tick_at(self):
+        return (self.current + 1) * self.tick
+
+
+def complete_phase(session):
+    """Move a running timer on to its next phase, starting when the last one ended"""
+    ended_at = session.phase_ends_at()
+    if session.phase == 'work':
+        session.completed_cycles += 1
+        interval = session.long_break_interval
+        session.phase = 'long_break' if interval and session.completed_cycles % interval == 0 else 'short_break'
+    else:
+        session.phase = 'work'
+    session.remaining_seconds = session.duration_for(session.phase)
+    session.start_time = ended_at
+
+
+def advance_if_due(session):
+    """Complete every phase of `session` that is over; False if none is"""
+    now = timezone.now()
+    ends_at = session.phase_ends_at()
+    if ends_at is None or ends_at > now:
+        # Paused, or restarted since it was scheduled
+        return False
+    phases = 0
+    # Only the latest focus phase counts towards analytics: who was in the
+    # room for the ones before it, if the scheduler fell behind, isn't known
+    session.completed_focus = None
+    while ends_at is not None and ends_at <= now:
+        if phases == MAX_CATCH_UP_PHASES:
+            session.start_time = now
+            break
+        if session.phase == 'work':
+            session.completed_focus = (ends_at - timedelta(seconds=session.work_duration), ends_at)
+        complete_phase(session)
+        if session.remaining_seconds <= 0:
+            # A zero-length phase would never end; stop instead
+            session.is_running = False
+            session.start_time = None
+        ends_at = session.phase_ends_at()
+        phases += 1
+    return True
+
+
+class PomodoroScheduler:
+    def __init__(self, channel_layer, tick=0.1, sync_interval=1.0, flush_interval=5.0, rebuild_check_interval=60.0):
+        self.channel_layer = channel_layer
+        self.wheel = TimerWheel(tick=tick)
+        self.sync_interval = sync_interval
+        self.flush_interval = flush_interval
+        self.rebuild_check_interval = rebuild_check_interval
+        self.next_sync = self.next_flush = self.next_rebuild_check = 0.0
+
+    async def sync(self):
+        """Put the deadlines due before the next sync on the wheel"""
+        horizon = time.time() + 2 * self.sync_interval
+        for room_id, ends_at in await aget_redis().zrangebyscore(DEADLINES_KEY, '-inf', horizon, withscores=True):
+            self.wheel.schedule(room_id, ends_at)
+
+    async def fire(self, room_ids):
+        for start in range(0, len(room_ids), FIRE_BATCH_SIZE):
+            batch = room_ids[start:start + FIRE_BATCH_SIZE]
+            results = await asyncio.gather(
+                *(aupdate_state(room_id, advance_if_due) for room_id in batch), return_exceptions=True
+            )
+            advanced = []
+            for room_id, result in zip(batch, results):
+                if isinstance(result, Http404):
+                    await aget_redis().zrem(DEADLINES_KEY, room_id)
+                elif isinstance(result, Exception):
+                    logger.error("Advancing the pomodoro timer of room %s failed", room_id, exc_info=result)
+                    self.wheel.schedule(room_id, time.time() + self.sync_interval)
+                elif result[1]:
+                    advanced.append(result[0])
+            if not advanced:
+                continue
+
+            for session in advanced:
+                ends_at = session.phase_ends_at()
+                if ends_at is not None:
+                    self.wheel.schedule(str(session.room_id), ends_at.timestamp())
+            # One serializer for the lot; building one per timer costs more than the rest
+            states = PomodoroSerializer(advanced, many=True).data
+            await asyncio.gather(*(
+                self.channel_layer.group_send(f"room_{session.room_id}", {"type": "pomodoro_update", "data": data})
+                for session, data in zip(advanced, states)
+            ))
+            # Phase changes are written to the table straight away; should
+            # that fail they are still marked dirty for the next flush
+            await sync_to_async(save_sessions)(advanced)
+            await self.record_focus(advanced)
+
+    async def record_focus(self, sessions):
+        phases = [
+            (session.room_id, *session.completed_focus) for session in sessions if session.completed_focus
+        ]
+        if not phases:
+            return
+        try:
+            await sync_to_async(record_focus_phases)(phases)
+        except Exception:
+            # Analytics never hold up the timers
+            logger.exception("Recording %d focus phase(s) failed", len(phases))
+
+    async def step(self):
+        now = time.time()
+        if now >= self.next_rebuild_check:
+            if not await aget_redis().exists(LOADED_KEY):
+                loaded = await sync_to_async(rebuild_pomodoro_state)()
+                logger.info("Loaded %d pomodoro timer(s) into Redis", loaded)
+            self.next_rebuild_check = now + self.rebuild_check_interval
+        if now >= self.next_sync:
+            await self.sync()
+            self.next_sync = now + self.sync_interval
+        if now >= self.next_flush:
+            await sync_to_async(flush_pomodoro_state)()
+            self.next_flush = now + self.flush_interval
+
+        due = self.wheel.advance(time.time())
+        if due:
+            await self.fire(due)
+
+    async def run(self):
+        while True:
+            try:
+                await self.step()
+            except (InterfaceError, OperationalError):
+                logger.exception("Database error in the pomodoro scheduler; reconnecting")
+                await sync_to_async(close_old_connections)()
+            except redis.RedisError:
+                logger.exception("Redis error in the pomodoro scheduler; retrying shortly")
+                await asyncio.sleep(self.sync_interval)
+            await asyncio.sleep(max(self.wheel.next_tick_at() - time.time(), 0))
@@ -0,0 +1,244 @@
+"""
+Live pomodoro timers, kept in Redis.
+
+Each room's timer is a hash at pomodoro:<room_id> with the PomodoroSession
+fields the timer uses and a version that goes up with every change. Reads
+come straight from the hash, so polling the timer never touches the
+database. Changes go through `aupdate_state`, a WATCH/MULTI transaction
+that retries when another control or the scheduler got there first. A
+change also:
+- keeps the running phase's deadline in the pomodoro:deadlines sorted set,
+  which the scheduler (rooms/pomodoro.py) watches; and
+- marks the room dirty.
+
+The table is the cold copy:
+- The scheduler writes dirty timers back to the table every few seconds.
+  Phase changes it makes itself are written straight away.
+- A timer missing from Redis is loaded from the table on first use.
+- When Redis has lost everything (the pomodoro:loaded marker is gone), the
+  scheduler reloads every session so running timers keep their deadlines.
+- Control actions not yet flushed when that happens are lost. The flush
+  interval bounds how far a timer can jump back.
+"""
+from datetime import datetime, timezone as dt_timezone
+
+import redis
+from django.db import transaction
+from django.shortcuts import aget_object_or_404
+from django.utils import timezone
+
+from .models import PomodoroSession, Room
+from utils.redis_client import aget_redis, get_redis
+
+DEADLINES_KEY = 'pomodoro:deadlines'
+DIRTY_KEY = 'pomodoro:dirty'
+FLUSHING_KEY = 'pomodoro:flushing'
+LOADED_KEY = 'pomodoro:loaded'
+
+INT_FIELDS = [
+    'id', 'remaining_seconds', 'work_duration', 'short_break_duration', 'long_break_duration',
+    'long_break_interval', 'completed_cycles', 'version',
+]
+# What a flush writes back to the table
+SAVED_FIELDS = [field for field in INT_FIELDS if field != 'id'] + ['phase', 'is_running', 'start_time']
+
+
+def state_key(room_id):
+    return f"pomodoro:{room_id}"
+
+
+def dump_state(session):
+    state = {field: getattr(session, field) for field in INT_FIELDS}
+    state['phase'] = session.phase
+    state['is_running'] = int(session.is_running)
+    state['start_time'] = session.start_time.timestamp() if session.start_time else ''
+    return state
+
+
+def load_state(room_id, state):
+    """An unsaved PomodoroSession holding a timer read from Redis"""
+    session = PomodoroSession(
+        room_id=room_id,
+        phase=state['phase'],
+        is_running=state['is_running'] == '1',
+        start_time=(
+            datetime.fromtimestamp(float(state['start_time']), tz=dt_timezone.utc)
+            if state['start_time'] else None
+        ),
+        **{field: int(state[field]) for field in INT_FIELDS},
+    )
+    session._state.adding = False
+    return session
+
+
+def queue_save(pipe, session, dirty=True):
+    """Queue the commands writing a timer onto a (sync or async) pipeline"""
+    room_id = str(session.room_id)
+    pipe.hset(state_key(room_id), mapping=dump_state(session))
+    ends_at = session.phase_ends_at()
+    if ends_at is None:
+        pipe.zrem(DEADLINES_KEY, room_id)
+    else:
+        pipe.zadd(DEADLINES_KEY, {room_id: ends_at.timestamp()})
+    if dirty:
+        pipe.sadd(DIRTY_KEY, room_id)
+
+
+async def aget_state(room_id):
+    """The room's timer, loaded from the table on first use; raises Http404"""
+    client = aget_redis()
+    state = await client.hgetall(state_key(room_id))
+    if state:
+        return load_state(room_id, state)
+    await aload_from_table(room_id)
+    return load_state(room_id, await client.hgetall(state_key(room_id)))
+
+
+async def aload_from_table(room_id):
+    """Copy a timer into Redis from the table unless it got there meanwhile"""
+    session = await PomodoroSession.objects.filter(room_id=room_id).afirst()
+    if session is None:
+        room = await aget_object_or_404(Room, id=room_id)
+        session, created = await PomodoroSession.objects.aget_or_create(room=room)
+    async with aget_redis().pipeline() as pipe:
+        try:
+            await pipe.watch(state_key(room_id))
+            if not await pipe.exists(state_key(room_id)):
+                pipe.multi()
+                queue_save(pipe, session, dirty=False)
+                await pipe.execute()
+        except redis.WatchError:
+            pass  # someone else loaded or changed it first
+
+
+async def aupdate_state(room_id, change):
+    """
+    Apply `change(session)` to the room's timer; it returns False to leave the
+    timer as it was. Retried from a fresh read if the timer changes
+    underneath it. Returns (session, changed).
+    """
+    key = state_key(room_id)
+    async with aget_redis().pipeline() as pipe:
+        while True:
+            try:
+                await pipe.watch(key)
+                state = await pipe.hgetall(key)
+                if not state:
+                    await pipe.reset()
+                    await aload_from_table(room_id)
+                    continue
+                session = load_state(room_id, state)
+                if not change(session):
+                    await pipe.reset()
+                    return session, False
+                session.version += 1
+                pipe.multi()
+                queue_save(pipe, session)
+                await pipe.execute()
+                return session, True
+            except redis.WatchError:
+                continue
+
+
+def forget_state(room_id):
+    """Drop a deleted room's timer"""
+    pipe = get_redis().pipeline()
+    pipe.delete(state_key(room_id))
+    pipe.zrem(DEADLINES_KEY, str(room_id))
+    pipe.srem(DIRTY_KEY, str(room_id))
+    pipe.execute()
+
+
+def save_sessions(sessions):
+    """
+    Write timers back to the table, skipping any the table already has as
+    new a version of; returns how many rows were written. Timers whose row is
+    gone (the room was deleted) are dropped from Redis.
+    """
+    if not sessions:
+        return 0
+    saved = 0
+    now = timezone.now()
+    with transaction.atomic():
+        for session in sessions:
+            saved += PomodoroSession.objects.filter(id=session.id, version__lt=session.version).update(
+                updated_at=now, **{field: getattr(session, field) for field in SAVED_FIELDS}
+            )
+        existing = set(
+            PomodoroSession.objects.filter(id__in=[session.id for session in sessions]).values_list('id', flat=True)
+        )
+    for session in sessions:
+        if session.id not in existing:
+            forget_state(session.room_id)
+    return saved
+
+
+def flush_pomodoro_state(batch_size=500):
+    """
+    Write dirty timers back to the table; returns the number of rows written.
+
+    As with the download counters, the dirty set is renamed aside first so
+    changes made mid-flush mark their rooms in a fresh set, and a flush that
+    dies part-way is retried by the next run.
+    """
+    client = get_redis()
+    if not client.exists(FLUSHING_KEY):
+        try:
+            client.rename(DIRTY_KEY, FLUSHING_KEY)
+        except redis.ResponseError:
+            return 0  # nothing is dirty
+    room_ids = list(client.smembers(FLUSHING_KEY))
+    saved = 0
+    for start in range(0, len(room_ids), batch_size):
+        batch = room_ids[start:start + batch_size]
+        pipe = client.pipeline(transaction=False)
+        for room_id in batch:
+            pipe.hgetall(state_key(room_id))
+        saved += save_sessions([
+            load_state(room_id, state) for room_id, state in zip(batch, pipe.execute()) if state
+        ])
+    client.delete(FLUSHING_KEY)
+    return saved
+
+
+def rebuild_pomodoro_state(batch_size=500):
+    """
+    Load every session from the table into Redis after it lost its data,
+    leaving timers already back in Redis alone; returns how many were loaded
+    """
+    client = get_redis()
+    loaded = 0
+    sessions = PomodoroSession.objects.order_by('pk').iterator(chunk_size=batch_size)
+    batch = []
+    for session in sessions:
+        batch.append(session)
+        if len(batch) == batch_size:
+            loaded += _load_batch(client, batch)
+            batch = []
+    loaded += _load_batch(client, batch)
+    client.set(LOADED_KEY, timezone.now().isoformat())
+    return loaded
+
+
+def _load_batch(client, sessions):
+    keys = [state_key(session.room_id) for session in sessions]
+    if not keys:
+        return 0
+    with client.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(*keys)
+                # Checked in one round trip on another connection; the WATCH
+                # still catches any of them being written from here on
+                check = client.pipeline(transaction=False)
+                for key in keys:
+                    check.exists(key)
+                present = check.execute()
+                pipe.multi()
+                missing = [session for session, exists in zip(sessions, present) if not exists]
+                for session in missing:
+                    queue_save(pipe, session, dirty=False)
+                pipe.execute()
+                return len(missing)
+            except redis.WatchError:
+                continue
@@ -0,0 +1,18 @@
+"""
+Who is online in a room: each RoomConsumer adds its user to a dict in the
+shared cache on connect and removes them on disconnect.
+"""
+from django.core.cache import cache
+
+
+def presence_key(room_id):
+    return f"room:{room_id}:online_users"
+
+
+def online_user_ids(room_ids):
+    """Map of room id (as a string) -> ids of the users online there"""
+    keys = {presence_key(room_id): str(room_id) for room_id in room_ids}
+    return {
+        keys[key]: [int(user_id) for user_id in users]
+        for key, users in cache.get_many(list(keys)).items()
+    }
@@ -0,0 +1,208 @@
+"""
+Room deletion.
+
+Deleting a room only marks it deleted (Room.deleted_at), which hides it from
+Room.objects and so from every view and socket at once, and queues a
+RoomPurge. A room_deleted event tells the sockets still open on it to close. The purge_rooms command then removes everything the room owned,
+BATCH_SIZE rows at a time, each batch in a transaction of its own:
+
+- upload sessions and their part files;
+- reactions and read receipts of archived messages, then the archive's
+  segments and files;
+- reactions and read receipts, then messages;
+- files, releasing their blob references (and stored bytes with the last);
+- whatever else points at the room (memberships, keys, rollups, ...);
+- finally the room row itself.
+
+Rows are deleted with plain DELETE ... WHERE id IN (...) rather than through
+the ORM, which would load every row and cascade in one go. Progress is saved
+on the RoomPurge after every batch. Each step deletes whatever is left, so a
+purge that failed or whose worker died simply runs again.
+"""
+import traceback
+from datetime import timedelta
+
+import redis
+from django.core.cache import cache
+from django.db import connection, models, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .access import access_cache_key
+from .archive import iter_archived, remove_room_archive
+from .blobs import _delete_stored, release_blob
+from .models import (
+    FileBlob, Message, MessageSeen, MessageSegment, Reaction, Room, RoomFile, RoomMembership, RoomPurge,
+    UploadSession,
+)
+from .outbox import enqueue_broadcast
+from .pomodoro_state import forget_state
+from .uploads import discard_session_file
+
+BATCH_SIZE = 1000
+# A running purge not heard from for this long lost its worker
+STALE_AFTER = timedelta(minutes=10)
+# Failed purges are retried up to this many attempts in all
+MAX_ATTEMPTS = 5
+
+
+def delete_room(room, user):
+    """Mark a room deleted and queue its purge; returns the RoomPurge"""
+    with transaction.atomic():
+        if not Room.objects.filter(pk=room.pk).update(deleted_at=timezone.now()):
+            # Deleted concurrently
+            return RoomPurge.objects.get(room_id=room.pk)
+        purge = RoomPurge.objects.create(room_id=room.pk, room_name=room.name, requested_by=user)
+        # Sent once this commits, like every other broadcast of a change
+        enqueue_broadcast(room.pk, {'type': 'room_deleted', 'room_id': str(room.pk)})
+        user_ids = set(RoomMembership.objects.filter(room_id=room.pk).values_list('user_id', flat=True))
+        user_ids.add(room.owner_id)
+        transaction.on_commit(lambda: _forget_room(room.pk, user_ids))
+    return purge
+
+
+def _forget_room(room_id, user_ids):
+    # Cached access would otherwise let members in for a little longer
+    cache.delete_many([access_cache_key(room_id, user_id) for user_id in user_ids])
+    try:
+        forget_state(room_id)
+    except redis.RedisError:
+        pass  # the scheduler drops it once it finds the session gone
+
+
+def claim_purge():
+    """The next purge to run, marked running; None if there is none"""
+    stale = timezone.now() - STALE_AFTER
+    with transaction.atomic():
+        purge = (
+            RoomPurge.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(status='pending')
+                | Q(status='failed', attempts__lt=MAX_ATTEMPTS)
+                | Q(status='running', updated_at__lt=stale)
+            )
+            .order_by('created_at')
+            .first()
+        )
+        if purge is None:
+            return None
+        purge.status = 'running'
+        purge.attempts += 1
+        purge.error = ''
+        purge.save(update_fields=['status', 'attempts', 'error', 'updated_at'])
+    return purge
+
+
+def run_purge(purge, batch_size=BATCH_SIZE, on_progress=None):
+    """Remove everything of the purge's room; True once it's all gone"""
+    purger = RoomPurger(purge, batch_size, on_progress)
+    try:
+        purger.run()
+    except Exception:
+        purge.status = 'failed'
+        purge.error = traceback.format_exc()
+        purge.save(update_fields=['status', 'error', 'progress', 'updated_at'])
+        return False
+    purge.status = 'done'
+    purge.finished_at = timezone.now()
+    purge.save(update_fields=['status', 'finished_at', 'progress', 'updated_at'])
+    return True
+
+
+def _delete_rows(model, ids):
+    table = connection.ops.quote_name(model._meta.db_table)
+    column = connection.ops.quote_name(model._meta.pk.column)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {table} WHERE {column} IN ({', '.join(['%s'] * len(ids))})",
+            [model._meta.pk.get_db_prep_value(pk, connection) for pk in ids],
+        )
+
+
+class RoomPurger:
+    def __init__(self, purge, batch_size, on_progress=None):
+        self.purge = purge
+        self.room_id = purge.room_id
+        self.batch_size = batch_size
+        self.on_progress = on_progress
+
+    def run(self):
+        self.purge_upload_sessions()
+        self.purge_archive()
+        self.delete_all('reactions', Reaction.objects.filter(message__room_id=self.room_id))
+        self.delete_all('receipts', MessageSeen.objects.filter(message__room_id=self.room_id))
+        self.delete_all('messages', Message.objects.filter(room_id=self.room_id))
+        self.purge_files()
+        self.purge_related()
+        Room.all_objects.filter(pk=self.room_id).delete()
+
+    def advance(self, kind, count):
+        """Count a batch into the purge's progress and save it"""
+        self.purge.progress[kind] = self.purge.progress.get(kind, 0) + count
+        RoomPurge.objects.filter(pk=self.purge.pk).update(progress=self.purge.progress, updated_at=timezone.now())
+        if self.on_progress:
+            self.on_progress(self.purge, kind)
+
+    def batches(self, queryset, *fields):
+        """Batches of the queryset's ids (or `fields` rows), until it's empty"""
+        values = queryset.values_list(*fields) if fields else queryset.values_list('pk', flat=True)
+        while True:
+            batch = list(values[:self.batch_size])
+            if not batch:
+                return
+            yield batch
+
+    def delete_all(self, kind, queryset):
+        for ids in self.batches(queryset):
+            with transaction.atomic():
+                _delete_rows(queryset.model, ids)
+            self.advance(kind, len(ids))
+
+    def purge_upload_sessions(self):
+        for ids in self.batches(UploadSession.objects.filter(room_id=self.room_id)):
+            with transaction.atomic():
+                _delete_rows(UploadSession, ids)
+            for session in (UploadSession(id=pk) for pk in ids):
+                discard_session_file(session)
+            self.advance('upload_sessions', len(ids))
+
+    def purge_archive(self):
+        """Reactions and receipts of archived messages, then the segments themselves"""
+        # The archive leaves them in the table (see rooms/archive.py)
+        for messages in iter_archived(self.room_id):
+            message_ids = [message.id for message in messages]
+            self.delete_all('reactions', Reaction.objects.filter(message_id__in=message_ids))
+            self.delete_all('receipts', MessageSeen.objects.filter(message_id__in=message_ids))
+        self.delete_all('archive_segments', MessageSegment.objects.filter(room_id=self.room_id))
+        remove_room_archive(self.room_id)
+
+    def purge_files(self):
+        files = RoomFile.objects.filter(room_id=self.room_id)
+        for rows in self.batches(files, 'pk', 'blob_id', 'file'):
+            with transaction.atomic():
+                _delete_rows(RoomFile, [pk for pk, blob_id, name in rows])
+                for pk, blob_id, name in rows:
+                    if blob_id:
+                        release_blob(FileBlob(pk=blob_id))
+                    elif name:
+                        # Files uploaded before deduplication own their storage outright
+                        storage = RoomFile._meta.get_field('file').storage
+                        transaction.on_commit(lambda name=name: _delete_stored(storage, name))
+            self.advance('files', len(rows))
+
+    def purge_related(self):
+        """Rows of every other model pointing at the room"""
+        handled = {UploadSession, MessageSegment, Message, RoomFile}
+        for relation in Room._meta.related_objects:
+            model = relation.related_model
+            if model in handled:
+                continue
+            rows = model._base_manager.filter(**{relation.field.name: self.room_id})
+            kind = model._meta.label_lower
+            if relation.on_delete is models.SET_NULL:
+                for ids in self.batches(rows):
+                    with transaction.atomic():
+                        model._base_manager.filter(pk__in=ids).update(**{relation.field.name: None})
+                    self.advance(kind, len(ids))
+            else:
+                self.delete_all(kind, rows)
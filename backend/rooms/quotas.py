@@ -0,0 +1,84 @@
+"""
+Per-room storage accounting.
+
+`Room.storage_used` is the sum of `file_size` over the room's files. Rather
+than aggregating on every lookup it is adjusted in the same transaction that
+creates or deletes a RoomFile, and a quota is enforced by making the increment
+conditional: the UPDATE only matches while there is still room, so concurrent
+uploads can't overshoot. Rooms are charged for every file they hold, even when
+the bytes are shared with another room through deduplication.
+
+`reconcile_room_usage` recomputes the counters from scratch to repair any
+drift (e.g. rows removed outside these helpers).
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, PositiveBigIntegerField, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import Room, RoomFile
+
+
+def default_quota_bytes():
+    return getattr(settings, 'ROOM_STORAGE_QUOTA_MB', 1024) * 1024 * 1024
+
+
+def room_quota(room):
+    return room.storage_quota if room.storage_quota is not None else default_quota_bytes()
+
+
+def has_room_for(room, size):
+    """Advisory check against the last loaded usage; charge_storage is authoritative"""
+    return room.storage_used + size <= room_quota(room)
+
+
+def charge_storage(room_id, size):
+    """Add `size` bytes to a room's usage if it fits its quota; True on success"""
+    quota = Coalesce(F('storage_quota'), Value(default_quota_bytes()), output_field=PositiveBigIntegerField())
+    return bool(
+        Room.objects.filter(pk=room_id, storage_used__lte=quota - size)
+        .update(storage_used=F('storage_used') + size)
+    )
+
+
+def credit_storage(room_id, size):
+    Room.objects.filter(pk=room_id).update(
+        storage_used=Greatest(F('storage_used') - size, Value(0), output_field=PositiveBigIntegerField())
+    )
+
+
+def reconcile_room_usage(batch_size=500):
+    """Recompute storage_used for every room; returns the number corrected"""
+    corrected = 0
+    last_pk = None
+    while True:
+        rooms = Room.objects.order_by('pk').values_list('pk', flat=True)
+        if last_pk:
+            rooms = rooms.filter(pk__gt=last_pk)
+        batch = list(rooms[:batch_size])
+        if not batch:
+            return corrected
+        last_pk = batch[-1]
+
+        totals = dict(
+            RoomFile.objects.filter(room_id__in=batch)
+            .values('room_id').annotate(total=Sum('file_size')).values_list('room_id', 'total')
+        )
+        stored = dict(Room.objects.filter(pk__in=batch).values_list('pk', 'storage_used'))
+        for room_id in batch:
+            if totals.get(room_id, 0) != stored.get(room_id):
+                corrected += _reconcile_room(room_id)
+
+
+def _reconcile_room(room_id):
+    # Uploads and deletes update the room row before touching its files, so
+    # once we hold the row lock nothing is half-applied and the sum is exact
+    with transaction.atomic():
+        room = Room.objects.select_for_update().filter(pk=room_id).first()
+        if room is None:
+            return 0
+        actual = RoomFile.objects.filter(room_id=room_id).aggregate(total=Sum('file_size'))['total'] or 0
+        if actual == room.storage_used:
+            return 0
+        Room.objects.filter(pk=room_id).update(storage_used=actual)
+        return 1
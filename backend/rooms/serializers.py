@@ -1,26 +1,34 @@
 from rest_framework import serializers
-from .models import Room, RoomMembership, Message, MessageSeen, Reaction, PomodoroSession, RoomFile
+from .models import Room, RoomMembership, Message, MessageSeen, Reaction, PomodoroSession, RoomFile, RoomPurge
 from django.contrib.auth import get_user_model
 from utils.encryption_service import EncryptionService
+from django.urls import reverse
+from .counters import pending_downloads
+from .quotas import room_quota
+from .thumbnails import supports_derivatives
 
 User = get_user_model()
 
 class RoomSerializer(serializers.ModelSerializer):
     owner_username = serializers.ReadOnlyField(source='owner.username')
     active_members_count = serializers.SerializerMethodField()
+    storage_limit = serializers.SerializerMethodField()
 
     class Meta:
         model = Room
         fields = [
             'id', 'name', 'description', 'topic', 'is_private', 
             'capacity', 'owner', 'owner_username', 
-            'created_at', 'active_members_count'
+            'created_at', 'active_members_count', 'storage_used', 'storage_limit'
         ]
-        read_only_fields = ['id', 'owner', 'created_at', 'active_members_count']
+        read_only_fields = ['id', 'owner', 'created_at', 'active_members_count', 'storage_used', 'storage_limit']
 
     def get_active_members_count(self, obj):
-        # For now, just count memberships. Later this can refer to Redis active users.
-        return obj.memberships.count()
+        # Room.member_count, kept in step with memberships by rooms/admission.py
+        return obj.member_count
+
+    def get_storage_limit(self, obj):
+        return room_quota(obj)
 
     def validate_capacity(self, value):
         if value > 50:
@@ -52,19 +60,23 @@ class RoomFileSerializer(serializers.ModelSerializer):
     file_size_display = serializers.ReadOnlyField()
     is_image = serializers.ReadOnlyField()
     file_extension = serializers.ReadOnlyField()
+    download_count = serializers.SerializerMethodField()
+    thumbnail_url = serializers.SerializerMethodField()
+    preview_url = serializers.SerializerMethodField()
 
     class Meta:
         model = RoomFile
         fields = [
             'id', 'room', 'uploaded_by', 'uploaded_by_username',
             'file', 'file_url', 'original_filename', 'file_size', 'file_size_display',
-            'file_type', 'file_extension', 'is_image',
+            'file_type', 'file_extension', 'is_image', 'thumbnail_url', 'preview_url',
             'description', 'download_count', 'created_at'
         ]
         read_only_fields = [
             'id', 'room', 'uploaded_by', 'uploaded_by_username',
             'file_url', 'file_size', 'file_size_display', 'file_type',
-            'file_extension', 'is_image', 'download_count', 'created_at'
+            'file_extension', 'is_image', 'thumbnail_url', 'preview_url',
+            'download_count', 'created_at'
         ]
 
     def get_file_url(self, obj):
@@ -75,6 +87,26 @@ class RoomFileSerializer(serializers.ModelSerializer):
             return obj.file.url
         return None
 
+    def get_thumbnail_url(self, obj):
+        return self._derivative_url(obj, 'thumbnail')
+
+    def get_preview_url(self, obj):
+        return self._derivative_url(obj, 'preview')
+
+    def _derivative_url(self, obj, kind):
+        if not supports_derivatives(obj):
+            return None
+        url = reverse('room-file-derivative', kwargs={'room_id': obj.room_id, 'file_id': obj.id, 'kind': kind})
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+    def get_download_count(self, obj):
+        # Include downloads still buffered in Redis; list views prefetch them
+        pending = self.context.get('pending_downloads')
+        if pending is None:
+            pending = pending_downloads([obj.id])
+        return obj.download_count + pending.get(str(obj.id), 0)
+
 
 class MessageSerializer(serializers.ModelSerializer):
     username = serializers.SerializerMethodField()
@@ -96,7 +128,11 @@ class MessageSerializer(serializers.ModelSerializer):
     
     def get_replied_to_message(self, obj):
         """Return basic info about the message being replied to"""
-        if not obj.replied_to:
+        try:
+            if not obj.replied_to:
+                return None
+        except Message.DoesNotExist:
+            # Its month has been detached from the message table
             return None
         
         try:
@@ -104,7 +140,7 @@ class MessageSerializer(serializers.ModelSerializer):
             return {
                 'id': str(obj.replied_to.id),
                 'username': obj.replied_to.sender.username if obj.replied_to.sender else 'System',
-                'message': EncryptionService.decrypt(obj.replied_to.content),
+                'message': EncryptionService.decrypt(obj.replied_to.stored_content),
                 'created_at': obj.replied_to.created_at
             }
         except:
@@ -119,7 +155,7 @@ class MessageSerializer(serializers.ModelSerializer):
         data = super().to_representation(instance)
         # Decrypt content for display
         try:
-            data['message'] = EncryptionService.decrypt(instance.content)
+            data['message'] = EncryptionService.decrypt(instance.stored_content)
         except:
             data['message'] = '[Encrypted]'
             
@@ -139,43 +175,26 @@ class MessageSerializer(serializers.ModelSerializer):
 class PomodoroSerializer(serializers.ModelSerializer):
     current_time = serializers.SerializerMethodField()
     remaining = serializers.SerializerMethodField()
+    # When the running phase is over, for clients counting down on a synced clock
+    ends_at = serializers.SerializerMethodField()
 
     class Meta:
         model = PomodoroSession
-        fields = ['id', 'phase', 'is_running', 'start_time', 'remaining', 'work_duration', 'short_break_duration', 'long_break_duration', 'current_time']
+        fields = ['id', 'phase', 'is_running', 'start_time', 'remaining', 'work_duration', 'short_break_duration', 'long_break_duration', 'long_break_interval', 'completed_cycles', 'version', 'ends_at', 'current_time']
 
     def get_remaining(self, obj):
         return obj.get_current_remaining()
 
+    def get_ends_at(self, obj):
+        ends_at = obj.phase_ends_at()
+        return ends_at.isoformat() if ends_at else None
+
     def get_current_time(self, obj):
         from django.utils import timezone
         return timezone.now().isoformat()
 
-
-class RoomFileSerializer(serializers.ModelSerializer):
-    uploaded_by_username = serializers.ReadOnlyField(source='uploaded_by.username')
-    file_url = serializers.SerializerMethodField()
-    file_size_display = serializers.ReadOnlyField()
-    is_image = serializers.ReadOnlyField()
-    file_extension = serializers.ReadOnlyField()
-
+class RoomPurgeSerializer(serializers.ModelSerializer):
     class Meta:
-        model = RoomFile
-        fields = [
-            'id', 'room', 'uploaded_by', 'uploaded_by_username',
-            'file', 'file_url', 'original_filename', 'file_size', 'file_size_display',
-            'file_type', 'file_extension', 'is_image',
-            'description', 'download_count', 'created_at'
-        ]
-        read_only_fields = [
-            'id', 'room', 'uploaded_by', 'uploaded_by_username',
-            'file_url', 'file_size', 'file_size_display', 'file_type',
-            'file_extension', 'is_image', 'download_count', 'created_at'
-        ]
-
-    def get_file_url(self, obj):
-        request = self.context.get('request')
-        if request and obj.file:
-            return request.build_absolute_uri(obj.file.url)
-        return None
-
+        model = RoomPurge
+        fields = ['id', 'room_id', 'room_name', 'status', 'progress', 'created_at', 'updated_at', 'finished_at']
+        read_only_fields = fields
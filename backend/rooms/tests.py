@@ -1,3 +1,773 @@
-from django.test import TestCase
+import base64
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from rest_framework.test import APIClient
+
+from utils.encryption_service import (
+    COMPRESS_MIN, DECRYPTION_ERROR, FLAG_COMPRESSED, EncryptionService, get_aead, get_cipher_suite, is_legacy,
+    key_id_of,
+)
+from .admission import (
+    RoomFull, join_room, join_waitlist, leave_waitlist, release_seat, remove_member, take_seat,
+)
+from .archive import FIELDS, RoomHistory, archive_room, decode_row, encode_row, open_segment, to_micros
+from .keyring import (
+    DEV_MASTER_KEY_ID, Keyring, active_keys, create_room_key, data_keys, rewrap_room_key, unwrap_key, wrap_key,
+)
+from .models import (
+    Message, MessageSeen, MessageSegment, OutboxEvent, PomodoroSession, Reaction, Room, RoomKey, RoomMembership,
+    RoomPurge, WaitlistEntry,
+)
+from .pomodoro import MAX_CATCH_UP_PHASES, TimerWheel, advance_if_due, complete_phase
+from .purge import RoomPurger, _delete_rows, claim_purge, delete_room, run_purge
+
+User = get_user_model()
+
+
+def make_user(name):
+    return User.objects.create_user(username=name, email=f'{name}@example.com')
+
+
+class SeatTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='Seats', owner=make_user('owner'), capacity=2)
+
+    def member_count(self):
+        return Room.objects.get(pk=self.room.pk).member_count
+
+    def test_take_seat_stops_at_capacity(self):
+        self.assertTrue(take_seat(self.room.id))
+        self.assertTrue(take_seat(self.room.id))
+        self.assertFalse(take_seat(self.room.id))
+        self.assertEqual(self.member_count(), 2)
+
+    def test_release_seat_never_goes_below_zero(self):
+        take_seat(self.room.id)
+        release_seat(self.room.id)
+        release_seat(self.room.id)
+        self.assertEqual(self.member_count(), 0)
+
+    def test_join_room_takes_one_seat_per_user(self):
+        user = make_user('alice')
+        membership, created = join_room(self.room, user)
+        self.assertTrue(created)
+        again, created = join_room(self.room, user)
+        self.assertFalse(created)
+        self.assertEqual(again.pk, membership.pk)
+        self.assertEqual(self.member_count(), 1)
+
+    def test_join_room_announces_the_join(self):
+        join_room(self.room, make_user('alice'))
+        self.assertTrue(Message.objects.filter(room=self.room, message_type='join').exists())
+        self.assertEqual(OutboxEvent.objects.get().group, f'room_{self.room.id}')
+
+    def test_join_full_room_raises(self):
+        join_room(self.room, make_user('alice'))
+        join_room(self.room, make_user('bob'))
+        with self.assertRaises(RoomFull):
+            join_room(self.room, make_user('carol'))
+        self.assertEqual(self.member_count(), 2)
+        self.assertEqual(RoomMembership.objects.filter(room=self.room).count(), 2)
+
+
+class WaitlistTests(TestCase):
+    def setUp(self):
+        self.owner = make_user('owner')
+        self.room = Room.objects.create(name='Full', owner=self.owner, capacity=1)
+        join_room(self.room, self.owner, 'admin')
+        self.alice, self.bob, self.carol = make_user('alice'), make_user('bob'), make_user('carol')
+
+    def test_positions_follow_arrival_order(self):
+        self.assertEqual(join_waitlist(self.room, self.alice), 1)
+        self.assertEqual(join_waitlist(self.room, self.bob), 2)
+        self.assertEqual(join_waitlist(self.room, self.carol), 3)
+        # Joining again keeps the place in the queue
+        self.assertEqual(join_waitlist(self.room, self.bob), 2)
+
+    def test_leaving_the_waitlist_moves_the_rest_up(self):
+        join_waitlist(self.room, self.alice)
+        join_waitlist(self.room, self.bob)
+        join_waitlist(self.room, self.carol)
+        self.assertTrue(leave_waitlist(self.room.id, self.bob))
+        self.assertFalse(leave_waitlist(self.room.id, self.bob))
+        self.assertEqual(join_waitlist(self.room, self.carol), 2)
+
+    def test_leaving_member_admits_longest_waiting(self):
+        join_waitlist(self.room, self.alice)
+        join_waitlist(self.room, self.bob)
+
+        self.assertTrue(remove_member(self.room.id, self.owner.id))
+
+        members = set(RoomMembership.objects.filter(room=self.room).values_list('user_id', flat=True))
+        self.assertEqual(members, {self.alice.id})
+        self.assertEqual(Room.objects.get(pk=self.room.pk).member_count, 1)
+        self.assertEqual(
+            list(WaitlistEntry.objects.filter(room=self.room).values_list('user_id', flat=True)), [self.bob.id]
+        )
+        self.assertEqual(join_waitlist(self.room, self.bob), 1)
+
+    def test_remove_non_member(self):
+        join_waitlist(self.room, self.alice)
+        self.assertFalse(remove_member(self.room.id, self.bob.id))
+        self.assertFalse(RoomMembership.objects.filter(room=self.room, user=self.alice).exists())
+
+    def test_join_waitlist_with_a_free_seat_admits(self):
+        remove_member(self.room.id, self.owner.id)
+        self.assertIsNone(join_waitlist(self.room, self.alice))
+        self.assertTrue(RoomMembership.objects.filter(room=self.room, user=self.alice).exists())
+        self.assertFalse(WaitlistEntry.objects.filter(room=self.room).exists())
+
+    def test_members_on_the_waitlist_are_skipped(self):
+        join_waitlist(self.room, self.alice)
+        join_waitlist(self.room, self.bob)
+        # Alice got in some other way meanwhile
+        RoomMembership.objects.create(room=self.room, user=self.alice)
+
+        remove_member(self.room.id, self.owner.id)
+
+        members = set(RoomMembership.objects.filter(room=self.room).values_list('user_id', flat=True))
+        self.assertEqual(members, {self.alice.id, self.bob.id})
+        self.assertFalse(WaitlistEntry.objects.filter(room=self.room).exists())
+
+
+@skipUnless(connection.vendor == 'postgresql', "needs concurrent transactions")
+class ConcurrentJoinTests(TransactionTestCase):
+    def test_only_one_join_gets_the_last_seat(self):
+        owner = make_user('owner')
+        room = Room.objects.create(name='Last seat', owner=owner, capacity=2)
+        join_room(room, owner, 'admin')
+        users = [make_user(f'user{i}') for i in range(6)]
+        barrier = threading.Barrier(len(users))
+        results = []
+
+        def join(user):
+            try:
+                barrier.wait()
+                join_room(room, user)
+                results.append('joined')
+            except RoomFull:
+                results.append('full')
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=join, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results), ['full'] * 5 + ['joined'])
+        self.assertEqual(Room.objects.get(pk=room.pk).member_count, 2)
+        self.assertEqual(RoomMembership.objects.filter(room=room).count(), 2)
+
+
+class TimerWheelTests(SimpleTestCase):
+    def setUp(self):
+        self.wheel = TimerWheel(tick=1, slots=8)
+        self.start = self.wheel.current  # whole seconds, as tick=1
+
+    def test_fires_when_due(self):
+        self.wheel.schedule('a', self.start + 2.5)
+        self.assertEqual(self.wheel.advance(self.start + 2), [])
+        self.assertEqual(self.wheel.advance(self.start + 3), ['a'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_later_laps_of_a_slot_wait(self):
+        # Both hash to the same slot; only the first is due on this lap
+        self.wheel.schedule('soon', self.start + 3)
+        self.wheel.schedule('later', self.start + 11)
+        self.assertEqual(self.wheel.advance(self.start + 5), ['soon'])
+        self.assertEqual(self.wheel.advance(self.start + 10), [])
+        self.assertEqual(self.wheel.advance(self.start + 11), ['later'])
+
+    def test_reschedule_and_cancel(self):
+        self.wheel.schedule('a', self.start + 2)
+        self.wheel.schedule('a', self.start + 6)
+        self.wheel.schedule('b', self.start + 3)
+        self.wheel.cancel('b')
+        self.assertEqual(self.wheel.advance(self.start + 5), [])
+        self.assertEqual(self.wheel.advance(self.start + 6), ['a'])
+
+    def test_past_deadlines_fire_on_the_next_tick(self):
+        self.wheel.schedule('late', self.start - 30)
+        self.assertEqual(self.wheel.advance(self.start + 1), ['late'])
+
+    def test_stall_longer_than_a_revolution_fires_everything_once(self):
+        for offset in (1, 4, 9, 13, 20):
+            self.wheel.schedule(offset, self.start + offset)
+        self.wheel.schedule('after', self.start + 1010)
+
+        fired = self.wheel.advance(self.start + 1000)
+
+        self.assertEqual(sorted(fired), [1, 4, 9, 13, 20])
+        self.assertEqual(self.wheel.current, self.start + 1000)
+        self.assertEqual(self.wheel.advance(self.start + 1009), [])
+        self.assertEqual(self.wheel.advance(self.start + 1010), ['after'])
+
+    def test_going_back_in_time_fires_nothing(self):
+        self.wheel.schedule('a', self.start + 2)
+        self.wheel.advance(self.start + 1)
+        self.assertEqual(self.wheel.advance(self.start - 5), [])
+        self.assertEqual(self.wheel.current, self.start + 1)
+
+
+def running_timer(started_ago, **settings):
+    settings = {'work_duration': 60, 'short_break_duration': 30, 'long_break_duration': 90,
+                'long_break_interval': 2, **settings}
+    return PomodoroSession(
+        room_id=uuid.uuid4(), is_running=True, phase='work', remaining_seconds=settings['work_duration'],
+        start_time=timezone.now() - timedelta(seconds=started_ago), **settings
+    )
+
+
+class CompletePhaseTests(SimpleTestCase):
+    def test_focus_then_short_break(self):
+        session = running_timer(0)
+        ended_at = session.phase_ends_at()
+        complete_phase(session)
+        self.assertEqual(session.phase, 'short_break')
+        self.assertEqual(session.completed_cycles, 1)
+        self.assertEqual(session.remaining_seconds, 30)
+        # The break starts when the focus phase ended, not when it was noticed
+        self.assertEqual(session.start_time, ended_at)
+
+    def test_long_break_every_interval(self):
+        session = running_timer(0)
+        phases = []
+        for _ in range(8):
+            complete_phase(session)
+            phases.append(session.phase)
+        self.assertEqual(phases, ['short_break', 'work', 'long_break', 'work'] * 2)
+        self.assertEqual(session.completed_cycles, 4)
+        self.assertEqual(session.remaining_seconds, 60)
+
+    def test_no_long_breaks_without_interval(self):
+        session = running_timer(0, long_break_interval=0)
+        for _ in range(3):
+            complete_phase(session)
+            self.assertEqual(session.phase, 'short_break')
+            complete_phase(session)
+        self.assertEqual(session.completed_cycles, 3)
+
+
+class AdvanceIfDueTests(SimpleTestCase):
+    def test_paused_or_not_due(self):
+        paused = running_timer(600)
+        paused.is_running = False
+        self.assertFalse(advance_if_due(paused))
+        self.assertFalse(advance_if_due(running_timer(59)))
+
+    def test_one_phase_over(self):
+        session = running_timer(61)
+        focus_ended = session.phase_ends_at()
+        self.assertTrue(advance_if_due(session))
+        self.assertEqual(session.phase, 'short_break')
+        self.assertEqual(session.completed_cycles, 1)
+        self.assertEqual(session.completed_focus, (focus_ended - timedelta(seconds=60), focus_ended))
+
+    def test_catches_up_on_missed_phases(self):
+        # work 0-60, short break -90, work -150, long break -240, work -300
+        session = running_timer(250)
+        started = session.start_time
+        self.assertTrue(advance_if_due(session))
+        self.assertEqual(session.phase, 'work')
+        self.assertEqual(session.completed_cycles, 2)
+        self.assertEqual(session.start_time, started + timedelta(seconds=240))
+        # Only the latest focus phase is reported
+        self.assertEqual(
+            session.completed_focus, (started + timedelta(seconds=90), started + timedelta(seconds=150))
+        )
+
+    def test_long_neglected_timer_restarts_its_phase(self):
+        session = running_timer(10 * 24 * 3600)
+        before = timezone.now()
+        self.assertTrue(advance_if_due(session))
+        self.assertTrue(session.is_running)
+        self.assertEqual(session.completed_cycles, MAX_CATCH_UP_PHASES // 2)
+        self.assertGreaterEqual(session.start_time, before)
+        self.assertGreater(session.phase_ends_at(), timezone.now())
+
+    def test_zero_length_phase_stops_the_timer(self):
+        session = running_timer(61, short_break_duration=0)
+        self.assertTrue(advance_if_due(session))
+        self.assertEqual(session.phase, 'short_break')
+        self.assertFalse(session.is_running)
+        self.assertIsNone(session.phase_ends_at())
+
+
+class ArchiveTestCase(TestCase):
+    """A temporary MESSAGE_ARCHIVE_ROOT, and small segments and blocks"""
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.enterContext(override_settings(MESSAGE_ARCHIVE_ROOT=Path(root)))
+        self.enterContext(mock.patch('rooms.archive.SEGMENT_SIZE', 10))
+        self.enterContext(mock.patch('rooms.archive.BLOCK_SIZE', 4))
+        self.addCleanup(open_segment.cache_clear)
+        self.owner = make_user('owner')
+        self.room = Room.objects.create(name='History', owner=self.owner)
+        RoomMembership.objects.create(room=self.room, user=self.owner, role='admin')
+
+    def post_messages(self, count):
+        """`count` messages a minute apart, returned oldest first"""
+        start = timezone.now() - timedelta(minutes=count)
+        messages = []
+        for i in range(count):
+            message = Message.objects.create(
+                room=self.room, sender=self.owner,
+                ciphertext=EncryptionService.encrypt(f'message {i}', self.room.id),
+            )
+            Message.objects.filter(pk=message.pk).update(created_at=start + timedelta(minutes=i))
+            message.created_at = start + timedelta(minutes=i)
+            messages.append(message)
+        return messages
+
+
+class RoomHistoryTests(ArchiveTestCase):
+    def setUp(self):
+        super().setUp()
+        self.messages = self.post_messages(30)
+        # 28 archived, oldest first, into segments of 10, 10 and 8; 2 stay in the table
+        self.assertEqual(archive_room(self.room.id, timezone.now(), min_hot=2), 28)
+        self.newest_first = [message.id for message in reversed(self.messages)]
+
+    def history(self, before=None, after=None):
+        queryset = Message.objects.filter(room=self.room)
+        if before:
+            queryset = queryset.filter(created_at__lt=before)
+        if after:
+            queryset = queryset.filter(created_at__gte=after)
+        return RoomHistory(queryset.order_by('-created_at'), self.room.id, before=before, after=after)
+
+    def test_archived_into_segments(self):
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 2)
+        self.assertEqual(
+            list(MessageSegment.objects.filter(room=self.room).order_by('-newest_at')
+                 .values_list('message_count', flat=True)),
+            [8, 10, 10]
+        )
+
+    def test_whole_history_in_order(self):
+        history = self.history()
+        self.assertEqual(history.count(), 30)
+        messages = history[0:30]
+        self.assertEqual([message.id for message in messages], self.newest_first)
+        self.assertEqual(
+            EncryptionService.decrypt_many([message.stored_content for message in messages]),
+            [f'message {i}' for i in reversed(range(30))]
+        )
+
+    def test_pages_across_the_table_and_segments(self):
+        history = self.history()
+        for size in (1, 3, 7, 10, 29):
+            pages = [history[start:start + size] for start in range(0, 30, size)]
+            self.assertEqual([message.id for page in pages for message in page], self.newest_first, size)
+
+    def test_slices_at_boundaries(self):
+        history = self.history()
+        # The table holds 0-1, the segments 2-9, 10-19 and 20-29
+        for start, stop in ((1, 3), (2, 10), (9, 11), (5, 25), (19, 21), (21, 30), (29, 30), (30, 30)):
+            self.assertEqual([message.id for message in history[start:stop]], self.newest_first[start:stop])
+
+    def test_archived_messages_load_their_sender(self):
+        oldest = self.history()[29:30][0]
+        self.assertEqual(oldest.sender, self.owner)
+        self.assertFalse(oldest._state.adding)
+
+    def test_before_inside_a_segment(self):
+        # Message 15 is in the middle segment, in its second block
+        before = self.messages[15].created_at
+        history = self.history(before=before)
+        self.assertEqual(history.count(), 15)
+        self.assertEqual([message.id for message in history[0:15]], self.newest_first[15:])
+        self.assertEqual([message.id for message in history[4:9]], self.newest_first[19:24])
+
+    def test_after_inside_a_segment(self):
+        after = self.messages[5].created_at
+        history = self.history(after=after)
+        self.assertEqual(history.count(), 25)
+        self.assertEqual([message.id for message in history[0:25]], self.newest_first[:25])
+
+    def test_before_and_after_in_one_segment(self):
+        history = self.history(before=self.messages[17].created_at, after=self.messages[12].created_at)
+        self.assertEqual([message.id for message in history[0:10]], self.newest_first[13:18])
+
+    def test_between_messages(self):
+        history = self.history(
+            before=self.messages[17].created_at - timedelta(seconds=30),
+            after=self.messages[12].created_at + timedelta(seconds=30),
+        )
+        self.assertEqual([message.id for message in history[0:10]], self.newest_first[13:17])
+
+    def test_range_in_the_table_only(self):
+        history = self.history(after=self.messages[28].created_at)
+        self.assertEqual(history.archived_count, 0)
+        self.assertEqual([message.id for message in history[0:10]], self.newest_first[:2])
+
+    def test_message_view_pages_into_the_archive(self):
+        client = APIClient()
+        client.force_authenticate(self.owner)
+        url = reverse('room-messages', kwargs={'room_id': self.room.id})
+        listed = []
+        for page in (1, 2, 3):
+            data = client.get(url, {'page': page, 'page_size': 12}).json()
+            self.assertEqual(data['count'], 30)
+            listed += data['results']
+        self.assertEqual([message['id'] for message in listed], [str(pk) for pk in self.newest_first])
+        self.assertEqual(listed[-1]['message'], 'message 0')
+
+        before = self.messages[15].created_at.isoformat()
+        data = client.get(url, {'before': before, 'page_size': 5}).json()
+        self.assertEqual(data['count'], 15)
+        self.assertEqual([message['id'] for message in data['results']], [str(pk) for pk in self.newest_first[15:20]])
+
+
+class PositionBeforeTests(ArchiveTestCase):
+    def setUp(self):
+        super().setUp()
+        self.messages = self.post_messages(10)
+        archive_room(self.room.id, timezone.now(), min_hot=0)
+        segment = MessageSegment.objects.get(room=self.room)
+        self.reader = open_segment(segment.path)
+        # Blocks of 4, 4 and 2, newest first
+        self.assertEqual([block[2] for block in self.reader.blocks], [4, 4, 2])
+
+    def micros(self, i, seconds=0):
+        return to_micros(self.messages[i].created_at + timedelta(seconds=seconds))
+
+    def test_exact_times(self):
+        # Position p holds message 9 - p
+        for i in range(10):
+            self.assertEqual(self.reader.position_before(self.micros(i)), 10 - i)
+
+    def test_between_rows(self):
+        for i in range(10):
+            self.assertEqual(self.reader.position_before(self.micros(i, seconds=30)), 9 - i)
+
+    def test_outside_the_segment(self):
+        self.assertEqual(self.reader.position_before(self.micros(9, seconds=1)), 0)
+        self.assertEqual(self.reader.position_before(self.micros(0)), 10)
+        self.assertEqual(self.reader.position_before(self.micros(0, seconds=-3600)), 10)
+
+
+def shared_key_ciphertext(text, flags=0):
+    """`text` in the version 1 format, encrypted under the key derived from SECRET_KEY"""
+    data = text.encode()
+    if flags & FLAG_COMPRESSED:
+        data = zlib.compress(data)
+    header = bytes((1, flags))
+    nonce = os.urandom(12)
+    return header + nonce + get_aead().encrypt(nonce, data, header)
+
+
+class KeyringTestCase(TestCase):
+    def setUp(self):
+        # Cached keys are keyed by RoomKey ids, which rolled back tests reuse
+        data_keys.clear()
+        active_keys.clear()
+        self.addCleanup(data_keys.clear)
+        self.addCleanup(active_keys.clear)
+        self.room = Room.objects.create(name='Secrets', owner=make_user('owner'))
+
+
+class MessageFormatTests(KeyringTestCase):
+    def test_round_trip(self):
+        for text in ('', 'hello', 'héllo ✓', 'x' * 5000):
+            ciphertext = EncryptionService.encrypt(text, self.room.id)
+            self.assertIsInstance(ciphertext, bytes)
+            self.assertEqual(EncryptionService.decrypt(ciphertext), text)
+            # As read back from PostgreSQL
+            self.assertEqual(EncryptionService.decrypt(memoryview(ciphertext)), text)
+
+    def test_header(self):
+        ciphertext = EncryptionService.encrypt('hello', self.room.id)
+        self.assertEqual(ciphertext[0], 2)
+        self.assertEqual(ciphertext[1], 0)
+        self.assertEqual(key_id_of(ciphertext), RoomKey.objects.get(room=self.room, is_active=True).pk)
+        self.assertFalse(is_legacy(ciphertext))
+        # version, flags, key id, nonce, then the text and the 16-byte tag
+        self.assertEqual(len(ciphertext), 2 + 8 + 12 + len('hello') + 16)
+
+    def test_long_compressible_text_is_compressed(self):
+        text = 'focus ' * 200
+        ciphertext = EncryptionService.encrypt(text, self.room.id)
+        self.assertEqual(ciphertext[1], FLAG_COMPRESSED)
+        self.assertLess(len(ciphertext), len(text))
+        self.assertEqual(EncryptionService.decrypt(ciphertext), text)
+
+    def test_short_text_is_not_compressed(self):
+        text = 'a' * (COMPRESS_MIN - 1)
+        ciphertext = EncryptionService.encrypt(text, self.room.id)
+        self.assertEqual(ciphertext[1], 0)
+        self.assertEqual(EncryptionService.decrypt(ciphertext), text)
+
+    def test_compression_that_does_not_help_is_skipped(self):
+        text = 'a' * COMPRESS_MIN
+        with mock.patch('utils.encryption_service.zlib.compress', lambda data: data + b'!'):
+            ciphertext = EncryptionService.encrypt(text, self.room.id)
+        self.assertEqual(ciphertext[1], 0)
+        self.assertEqual(EncryptionService.decrypt(ciphertext), text)
+
+    def test_tampering_fails(self):
+        ciphertext = EncryptionService.encrypt('focus ' * 200, self.room.id)
+        other_room = Room.objects.create(name='Other', owner=self.room.owner)
+        other_key_id = key_id_of(EncryptionService.encrypt('x', other_room.id))
+        tampered = [
+            bytes((2, 0)) + ciphertext[2:],  # compression flag cleared
+            bytes((1,)) + ciphertext[1:],  # claims to be version 1
+            bytes((9,)) + ciphertext[1:],  # unknown version
+            ciphertext[:2] + other_key_id.to_bytes(8, 'big') + ciphertext[10:],  # another room's key
+            ciphertext[:30] + bytes((ciphertext[30] ^ 1,)) + ciphertext[31:],  # body
+            ciphertext[:-1],  # truncated tag
+        ]
+        for value in tampered:
+            self.assertEqual(EncryptionService.decrypt(value), DECRYPTION_ERROR)
+
+    def test_version_1(self):
+        self.assertEqual(EncryptionService.decrypt(shared_key_ciphertext('old')), 'old')
+        text = 'old ' * 100
+        compressed = shared_key_ciphertext(text, FLAG_COMPRESSED)
+        self.assertIsNone(key_id_of(compressed))
+        self.assertEqual(EncryptionService.decrypt(compressed), text)
+        self.assertEqual(EncryptionService.decrypt(bytes((1, 0)) + compressed[2:]), DECRYPTION_ERROR)
+
+    def test_fernet_token(self):
+        token = get_cipher_suite().encrypt('older'.encode()).decode()
+        self.assertTrue(is_legacy(token))
+        self.assertIsNone(key_id_of(token))
+        self.assertEqual(EncryptionService.decrypt(token), 'older')
+        self.assertEqual(EncryptionService.decrypt(token[:-4] + 'AAAA'), DECRYPTION_ERROR)
+
+    def test_decrypt_many_mixes_formats(self):
+        values = [
+            get_cipher_suite().encrypt(b'fernet').decode(),
+            shared_key_ciphertext('version 1'),
+            EncryptionService.encrypt('version 2', self.room.id),
+            b'\x02garbage',
+        ]
+        self.assertEqual(
+            EncryptionService.decrypt_many(values), ['fernet', 'version 1', 'version 2', DECRYPTION_ERROR]
+        )
+
+    def test_stored_content(self):
+        token = get_cipher_suite().encrypt(b'legacy').decode()
+        self.assertEqual(EncryptionService.decrypt(Message(content=token).stored_content), 'legacy')
+        ciphertext = EncryptionService.encrypt('binary', self.room.id)
+        self.assertEqual(EncryptionService.decrypt(Message(ciphertext=ciphertext).stored_content), 'binary')
+
+
+class SegmentRowTests(KeyringTestCase):
+    def row(self, **fields):
+        moment = timezone.now()
+        values = {
+            'id': uuid.uuid4(), 'created_at': moment, 'updated_at': moment, 'sender_id': None,
+            'message_type': 'text', 'is_edited': False, 'replied_to_id': None, 'file_id': None,
+            'content': '', 'ciphertext': None, **fields,
+        }
+        return [values[field] for field in FIELDS]
+
+    def test_binary_ciphertext_round_trip(self):
+        ciphertext = EncryptionService.encrypt('archived', self.room.id)
+        row = self.row(ciphertext=ciphertext)
+        message = decode_row(self.room.id, encode_row(row))
+        self.assertEqual(message.id, row[0])
+        self.assertEqual(message.created_at, row[1])
+        self.assertEqual(message.ciphertext, ciphertext)
+        self.assertEqual(EncryptionService.decrypt(message.stored_content), 'archived')
+
+    def test_fernet_round_trip(self):
+        token = get_cipher_suite().encrypt(b'archived').decode()
+        message = decode_row(self.room.id, encode_row(self.row(content=token)))
+        self.assertIsNone(message.ciphertext)
+        self.assertEqual(EncryptionService.decrypt(message.stored_content), 'archived')
+
+    def test_rows_written_before_the_binary_format(self):
+        # Segments archived then have no ciphertext field
+        token = get_cipher_suite().encrypt(b'archived').decode()
+        old_row = encode_row(self.row(content=token))[:-1]
+        self.assertEqual(len(old_row), 9)
+        message = decode_row(self.room.id, old_row)
+        self.assertIsNone(message.ciphertext)
+        self.assertEqual(message.content, token)
+        self.assertEqual(EncryptionService.decrypt(message.stored_content), 'archived')
+
+
+def master_key_config(*key_ids):
+    return ','.join(f"{key_id}:{base64.urlsafe_b64encode(os.urandom(32)).decode()}" for key_id in key_ids)
+
+
+class KeyringTests(KeyringTestCase):
+    def test_wrap_is_bound_to_the_room(self):
+        data_key = AESGCM.generate_key(bit_length=256)
+        master_key_id, wrapped = wrap_key(self.room.id, data_key)
+        self.assertEqual(master_key_id, DEV_MASTER_KEY_ID)
+        key = RoomKey(room_id=self.room.id, master_key_id=master_key_id, wrapped_key=wrapped)
+        self.assertEqual(unwrap_key(key), data_key)
+        # Copied onto another room, the wrapped key is useless
+        with self.assertRaises(InvalidTag):
+            unwrap_key(RoomKey(room_id=uuid.uuid4(), master_key_id=master_key_id, wrapped_key=wrapped))
+
+    def test_first_configured_master_key_wraps(self):
+        with override_settings(MESSAGE_MASTER_KEYS=master_key_config('2026', '2025')):
+            master_key_id, wrapped = wrap_key(self.room.id, AESGCM.generate_key(bit_length=256))
+            self.assertEqual(master_key_id, '2026')
+        # Once the key isn't configured any more it can't be unwrapped
+        with self.assertRaises(KeyError):
+            unwrap_key(RoomKey(room_id=self.room.id, master_key_id=master_key_id, wrapped_key=wrapped))
+
+    def test_rewrap_moves_to_the_current_master_key(self):
+        ciphertext = EncryptionService.encrypt('kept', self.room.id)
+        room_key = RoomKey.objects.get(room=self.room)
+        self.assertEqual(room_key.master_key_id, DEV_MASTER_KEY_ID)
+
+        with override_settings(MESSAGE_MASTER_KEYS=master_key_config('new')):
+            self.assertTrue(rewrap_room_key(room_key))
+            rewrapped = RoomKey.objects.get(pk=room_key.pk)
+            self.assertEqual(rewrapped.master_key_id, 'new')
+            self.assertNotEqual(bytes(rewrapped.wrapped_key), bytes(room_key.wrapped_key))
+            self.assertEqual(unwrap_key(rewrapped), unwrap_key(room_key))
+            data_keys.clear()
+            self.assertEqual(EncryptionService.decrypt(ciphertext), 'kept')
+            # Already moved by someone else
+            self.assertFalse(rewrap_room_key(room_key))
+
+    def test_rotated_data_key(self):
+        old = EncryptionService.encrypt('old', self.room.id)
+        old_key = RoomKey.objects.get(room=self.room)
+        new_key = create_room_key(self.room.id, retire=True)
+
+        new = EncryptionService.encrypt('new', self.room.id)
+        self.assertEqual(key_id_of(old), old_key.pk)
+        self.assertEqual(key_id_of(new), new_key.pk)
+        self.assertEqual(RoomKey.objects.get(room=self.room, is_active=True), new_key)
+        data_keys.clear()
+        active_keys.clear()
+        self.assertEqual(EncryptionService.decrypt_many([old, new]), ['old', 'new'])
+
+    def test_rooms_have_their_own_keys(self):
+        other_room = Room.objects.create(name='Other', owner=self.room.owner)
+        ours = EncryptionService.encrypt('ours', self.room.id)
+        theirs = EncryptionService.encrypt('theirs', other_room.id)
+        self.assertNotEqual(key_id_of(ours), key_id_of(theirs))
+
+
+class KeyringCacheTests(SimpleTestCase):
+    def test_least_recently_used_is_evicted(self):
+        cache = Keyring(size=2, ttl=60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.peek('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.peek('b'))
+        self.assertEqual((cache.peek('a'), cache.peek('c')), (1, 3))
+
+    def test_entries_expire(self):
+        cache = Keyring(size=2, ttl=60)
+        cache.put('a', 1)
+        with mock.patch('rooms.keyring.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.peek('a'))
+            self.assertEqual(cache.get('a', lambda key: 2), 2)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+
+class RoomPurgeTests(ArchiveTestCase):
+    def setUp(self):
+        super().setUp()
+        self.member = make_user('member')
+        RoomMembership.objects.create(room=self.room, user=self.member)
+        self.messages = self.post_messages(7)
+        for message in self.messages:
+            Reaction.objects.create(message=message, user=self.member, emoji='+1')
+            MessageSeen.objects.create(message=message, user=self.member)
+        # 4 archived, with their reactions and receipts left in the tables
+        self.assertEqual(archive_room(self.room.id, timezone.now(), min_hot=3), 4)
+
+        self.other_room = Room.objects.create(name='Other', owner=self.owner)
+        self.other_message = Message.objects.create(room=self.other_room, sender=self.owner, content='stays')
+        Reaction.objects.create(message=self.other_message, user=self.member, emoji='+1')
+
+    def test_delete_room_hides_it_and_closes_its_sockets(self):
+        purge = delete_room(self.room, self.owner)
+
+        self.assertFalse(Room.objects.filter(pk=self.room.pk).exists())
+        self.assertTrue(Room.all_objects.filter(pk=self.room.pk).exists())
+        self.assertEqual((purge.status, purge.room_name), ('pending', 'History'))
+        event = OutboxEvent.objects.get(group=f'room_{self.room.id}')
+        self.assertEqual(event.payload, {'type': 'room_deleted', 'room_id': str(self.room.id)})
+        # Deleting again finds the purge already queued
+        self.assertEqual(delete_room(self.room, self.owner), purge)
+        self.assertEqual(RoomPurge.objects.count(), 1)
+
+    def test_purge_removes_the_room_in_batches(self):
+        delete_room(self.room, self.owner)
+        purge = claim_purge()
+        reported = []
+
+        self.assertTrue(run_purge(purge, batch_size=2, on_progress=lambda purge, kind: reported.append(kind)))
+
+        room_messages = Message.objects.filter(room_id=self.room.id)
+        self.assertFalse(room_messages.exists())
+        message_ids = [message.id for message in self.messages]
+        self.assertFalse(Reaction.objects.filter(message_id__in=message_ids).exists())
+        self.assertFalse(MessageSeen.objects.filter(message_id__in=message_ids).exists())
+        self.assertFalse(MessageSegment.objects.filter(room_id=self.room.id).exists())
+        self.assertFalse((settings.MESSAGE_ARCHIVE_ROOT / str(self.room.id)).exists())
+        self.assertFalse(RoomMembership.objects.filter(room_id=self.room.id).exists())
+        self.assertFalse(Room.all_objects.filter(pk=self.room.pk).exists())
+
+        purge.refresh_from_db()
+        self.assertEqual(purge.status, 'done')
+        self.assertEqual(
+            {kind: purge.progress[kind] for kind in ('reactions', 'receipts', 'messages', 'archive_segments')},
+            {'reactions': 7, 'receipts': 7, 'messages': 3, 'archive_segments': 1},
+        )
+        self.assertEqual(purge.progress['rooms.roommembership'], 2)
+        # 3 messages in batches of 2
+        self.assertEqual(reported.count('messages'), 2)
+
+        # Other rooms keep everything
+        self.assertTrue(Reaction.objects.filter(message=self.other_message).exists())
+        self.assertTrue(Room.objects.filter(pk=self.other_room.pk).exists())
+
+    def test_failed_purge_carries_on_where_it_stopped(self):
+        delete_room(self.room, self.owner)
+        purge = claim_purge()
+        with mock.patch.object(RoomPurger, 'purge_files', side_effect=RuntimeError('disk gone')):
+            self.assertFalse(run_purge(purge, batch_size=2))
+
+        purge.refresh_from_db()
+        self.assertEqual(purge.status, 'failed')
+        self.assertIn('disk gone', purge.error)
+        # Batches before the failure stay deleted
+        self.assertFalse(Message.objects.filter(room_id=self.room.id).exists())
+
+        retry = claim_purge()
+        self.assertEqual((retry.pk, retry.attempts), (purge.pk, 2))
+        self.assertTrue(run_purge(retry, batch_size=2))
+        self.assertFalse(Room.all_objects.filter(pk=self.room.pk).exists())
+        self.assertEqual(RoomPurge.objects.get(pk=purge.pk).progress['messages'], 3)
+
+    def test_delete_rows_removes_only_the_given_ids(self):
+        hot = Message.objects.filter(room=self.room).order_by('id').values_list('id', flat=True)
+        ids = list(hot)
+        _delete_rows(Message, ids[:2])
+        self.assertEqual(list(hot.all()), ids[2:])
+        self.assertTrue(Message.objects.filter(pk=self.other_message.pk).exists())
@@ -0,0 +1,90 @@
+"""
+Thumbnail and preview derivatives for shared images.
+
+Derivatives are rendered in a process pool right after an image is uploaded
+and stored next to the original as ``<name>.<kind>.webp``. Because
+deduplicated uploads share a blob path, every room sharing the same image
+shares its derivatives too. If a derivative is requested before the pool
+has produced it (or the pool was never started), it is rendered on demand.
+"""
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+
+from utils.imaging import RENDER_ERRORS, imaging_available, render_derivative
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVES = {
+    'thumbnail': (256, 256),
+    'preview': (1280, 1280),
+}
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # Spawned workers don't inherit the server's threads or open sockets
+        _executor = ProcessPoolExecutor(
+            max_workers=getattr(settings, 'THUMBNAIL_WORKERS', 2),
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return _executor
+
+
+def supports_derivatives(room_file):
+    return imaging_available() and room_file.is_image and bool(room_file.file)
+
+
+def derivative_name(name, kind):
+    return f"{name}.{kind}.webp"
+
+
+def derivative_path(room_file, kind):
+    return room_file.file.storage.path(derivative_name(room_file.file.name, kind))
+
+
+def _log_failure(future):
+    if future.exception():
+        logger.warning("Image derivative rendering failed: %s", future.exception())
+
+
+def schedule_derivatives(room_file):
+    """Queue all derivatives of an uploaded image on the process pool"""
+    if not supports_derivatives(room_file):
+        return
+    src = room_file.file.path
+    for kind, max_size in DERIVATIVES.items():
+        dest = derivative_path(room_file, kind)
+        if os.path.exists(dest):
+            continue
+        try:
+            future = _get_executor().submit(render_derivative, src, dest, max_size)
+        except RuntimeError:
+            return  # pool shutting down; the lazy path will cover it
+        future.add_done_callback(_log_failure)
+
+
+def ensure_derivative(room_file, kind):
+    """
+    Path to a derivative, rendering it in-process if it doesn't exist yet;
+    None if the upload can't be rendered (corrupt or not really an image)
+    """
+    dest = derivative_path(room_file, kind)
+    if not os.path.exists(dest):
+        try:
+            render_derivative(room_file.file.path, dest, DERIVATIVES[kind])
+        except RENDER_ERRORS as exc:
+            logger.info("No %s for file %s: %s", kind, room_file.id, exc)
+            return None
+    return dest
+
+
+def delete_derivatives(storage, name):
+    for kind in DERIVATIVES:
+        storage.delete(derivative_name(name, kind))
@@ -0,0 +1,320 @@
+"""
+File upload helpers shared by the single-request and resumable upload views.
+
+Resumable uploads follow a small initiate / PUT chunks / complete protocol.
+Chunks are appended straight to a part file on disk and hashed as they are
+written, so a transfer never has to be held in memory and a dropped
+connection only costs the chunk that was in flight.
+"""
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.uploadhandler import FileUploadHandler
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from .blobs import store_blob
+from .listings import invalidate_file_list
+from .models import Message, RoomFile
+from .outbox import enqueue_broadcast
+from .quotas import charge_storage, has_room_for, room_quota
+from .serializers import RoomFileSerializer
+from .thumbnails import schedule_derivatives
+from utils.encryption_service import EncryptionService
+
+STREAM_READ_SIZE = 64 * 1024
+
+# session id -> (offset, sha256, last written) for sessions whose chunks
+# arrived in order on this process, least recently written first. Finalizing
+# falls back to re-hashing the part file when the running digest is missing
+# (restart, chunks served by another worker, or evicted). Sessions finalized
+# elsewhere or abandoned never leave by themselves, so the oldest entries are
+# dropped past UPLOAD_DIGEST_CACHE_SIZE or once idle for the session TTL.
+_running_digests = OrderedDict()
+_running_digests_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    """Raised when an upload request can't be honoured; carries an HTTP status"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def validate_upload(filename, size, max_size_mb):
+    """Check extension and size limits, raising UploadError on failure"""
+    if size > max_size_mb * 1024 * 1024:
+        raise UploadError(f'File too large. Maximum size is {max_size_mb}MB')
+
+    ext = os.path.splitext(filename)[1].lower()
+    allowed_extensions = getattr(settings, 'ALLOWED_FILE_EXTENSIONS', [])
+    if allowed_extensions and ext not in allowed_extensions:
+        raise UploadError(f'File type not allowed. Allowed types: {allowed_extensions}')
+
+
+def guess_mime_type(filename):
+    mime_type, _ = mimetypes.guess_type(filename)
+    return mime_type or 'application/octet-stream'
+
+
+class SHA256UploadHandler(FileUploadHandler):
+    """
+    Hashes multipart file fields as they stream in.
+
+    Install it ahead of Django's default handlers: it passes every chunk
+    through untouched, so the digest is ready as soon as the file is stored.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.digests = {}
+        self._digest = None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self._digest = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self._digest.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        self.digests[self.field_name] = self._digest.hexdigest()
+        return None
+
+
+def _quota_error(room):
+    return UploadError(
+        f'Room storage quota exceeded ({room.storage_used} of {room_quota(room)} bytes used)',
+        status_code=413
+    )
+
+
+def check_room_quota(room, size):
+    """Reject an upload early, before any bytes are stored, if it can't fit"""
+    if not has_room_for(room, size):
+        raise _quota_error(room)
+
+
+def create_room_file(room, user, content, sha256, *, filename, file_size, file_type, description=''):
+    """
+    Store `content` (deduplicated by `sha256`) and create its RoomFile.
+
+    The room's storage quota is charged first, in the same transaction: if it
+    doesn't fit, UploadError (413) is raised before anything is stored, so a
+    rolled back upload never leaves a blob file behind (or a part file moved).
+    """
+    with transaction.atomic():
+        if not charge_storage(room.id, file_size):
+            room.refresh_from_db(fields=['storage_used', 'storage_quota'])
+            raise _quota_error(room)
+        blob = store_blob(content, sha256, file_size)
+        room_file = RoomFile(
+            room=room,
+            uploaded_by=user,
+            blob=blob,
+            original_filename=filename,
+            file_size=file_size,
+            file_type=file_type,
+            description=description
+        )
+        room_file.file.name = blob.file.name
+        room_file.save()
+    # Thumbnails/previews render in the background once the row is visible
+    transaction.on_commit(lambda: schedule_derivatives(room_file))
+    return room_file
+
+
+def announce_room_file(request, room, room_file):
+    """
+    Record the chat message for a newly shared file and queue its broadcast to
+    the Files tab and the chat; call in the transaction creating the file.
+    Returns the serialized file.
+    """
+    # A reader in between would otherwise cache the list without the new file
+    transaction.on_commit(lambda: invalidate_file_list(room.id))
+    serializer = RoomFileSerializer(room_file, context={'request': request})
+    ws_data = json.loads(json.dumps(serializer.data, cls=DjangoJSONEncoder))
+
+    content_text = "Shared a file"
+    message = Message.objects.create(
+        room=room,
+        sender=request.user,
+        ciphertext=EncryptionService.encrypt(content_text, room.id),
+        file=room_file,
+        message_type='file'
+    )
+
+    enqueue_broadcast(
+        room.id,
+        # For the Files tab
+        {
+            "type": "file_uploaded",
+            "data": ws_data
+        },
+        # For the Chat tab
+        {
+            "type": "chat_message",
+            "content": content_text,  # Broadcast plaintext for immediate display
+            "username": request.user.username,
+            "id": str(message.id),
+            "sender_id": str(request.user.id),
+            "message_type": "file",
+            "created_at": message.created_at.isoformat(),
+            "file": ws_data
+        },
+    )
+    return serializer.data
+
+
+# Resumable upload sessions
+
+def start_session_file(session):
+    os.makedirs(os.path.dirname(session.temp_path), exist_ok=True)
+    open(session.temp_path, 'wb').close()
+    _remember_digest(session.id, 0, hashlib.sha256())
+
+
+def _running_digest(session_id):
+    """(offset, sha256) hashed so far for a session on this process, or None"""
+    with _running_digests_lock:
+        entry = _running_digests.get(session_id)
+    return entry[:2] if entry else None
+
+
+def _remember_digest(session_id, offset, digest):
+    now = time.monotonic()
+    idle_since = now - settings.UPLOAD_SESSION_TTL_HOURS * 3600
+    with _running_digests_lock:
+        _running_digests[session_id] = (offset, digest, now)
+        _running_digests.move_to_end(session_id)
+        while _running_digests:
+            oldest = next(iter(_running_digests.values()))
+            if len(_running_digests) <= settings.UPLOAD_DIGEST_CACHE_SIZE and oldest[2] > idle_since:
+                break
+            _running_digests.popitem(last=False)
+
+
+def _forget_digest(session_id):
+    with _running_digests_lock:
+        _running_digests.pop(session_id, None)
+
+
+def write_chunk(session, offset, stream, expected_sha256=None):
+    """
+    Append one chunk from `stream` at `offset` and return the bytes written.
+
+    The caller must hold a row lock on the session. A chunk that fails its
+    checksum or overruns the declared size is truncated away again so the
+    client can simply retry from the same offset.
+    """
+    if offset != session.received_bytes:
+        raise UploadError(
+            f'Offset mismatch: expected {session.received_bytes}, got {offset}',
+            status_code=409
+        )
+
+    running = _running_digest(session.id)
+    if running and running[0] != offset:
+        running = None
+    file_digest = running[1].copy() if running else None
+    chunk_digest = hashlib.sha256()
+    remaining = session.file_size - offset
+    written = 0
+
+    with open(session.temp_path, 'r+b') as part:
+        part.seek(offset)
+        while True:
+            data = stream.read(STREAM_READ_SIZE)
+            if not data:
+                break
+            written += len(data)
+            if written > remaining:
+                part.truncate(offset)
+                raise UploadError('Chunk exceeds the declared file size')
+            part.write(data)
+            chunk_digest.update(data)
+            if file_digest:
+                file_digest.update(data)
+
+        if expected_sha256 and chunk_digest.hexdigest() != expected_sha256.lower():
+            part.truncate(offset)
+            raise UploadError('Chunk checksum mismatch', status_code=422)
+
+    if file_digest:
+        _remember_digest(session.id, offset + written, file_digest)
+    else:
+        _forget_digest(session.id)
+    return written
+
+
+def session_sha256(session):
+    """SHA-256 of the assembled part file, re-hashing from disk only if needed"""
+    running = _running_digest(session.id)
+    if running and running[0] == session.received_bytes:
+        return running[1].hexdigest()
+
+    digest = hashlib.sha256()
+    with open(session.temp_path, 'rb') as part:
+        for data in iter(lambda: part.read(STREAM_READ_SIZE), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class MovableFile(File):
+    """A local file FileSystemStorage will move into place instead of copying"""
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def finalize_session(session):
+    """
+    Create the RoomFile for a fully received session.
+
+    A new blob takes ownership of the part file by moving it into storage;
+    if the content is already stored the part file is simply discarded.
+    """
+    if not session.is_complete:
+        raise UploadError(
+            f'Upload incomplete: received {session.received_bytes} of {session.file_size} bytes',
+            status_code=409
+        )
+
+    # Keep the part file if it can't fit; the client can free space and retry
+    check_room_quota(session.room, session.file_size)
+
+    digest = session_sha256(session)
+    if session.checksum and digest != session.checksum.lower():
+        discard_session_file(session)
+        raise UploadError('File checksum mismatch; the upload has been discarded', status_code=422)
+
+    with MovableFile(open(session.temp_path, 'rb')) as part:
+        room_file = create_room_file(
+            session.room, session.user, part, digest,
+            filename=session.original_filename,
+            file_size=session.file_size,
+            file_type=session.file_type,
+            description=session.description
+        )
+    # A no-op if a new blob moved the part file; otherwise the bytes were
+    # already stored and the part file is redundant
+    discard_session_file(session)
+    return room_file
+
+
+def discard_session_file(session):
+    _forget_digest(session.id)
+    try:
+        os.remove(session.temp_path)
+    except FileNotFoundError:
+        pass
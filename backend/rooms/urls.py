@@ -1,19 +1,29 @@
 from django.urls import path
 from .views import (
-    RoomListCreateView, RoomDetailView, RoomMessagesView, 
+    RoomListCreateView, RoomDetailView, RoomPurgeView, RoomMessagesView, 
     JoinRoomView, LeaveRoomView, RoomMembersView, RoomPomodoroView,
-    RoomFileListCreateView, RoomFileDetailView
+    RoomFileListCreateView, RoomFileDetailView, RoomFileDerivativeView, RoomFileArchiveView,
+    RoomTranscriptExportView,
+    UploadSessionCreateView, UploadSessionDetailView, UploadSessionCompleteView
 )
 
 urlpatterns = [
     path('', RoomListCreateView.as_view(), name='room-list-create'),
     path('<uuid:pk>/', RoomDetailView.as_view(), name='room-detail'),
+    path('<uuid:room_id>/purge/', RoomPurgeView.as_view(), name='room-purge'),
     path('<uuid:room_id>/messages/', RoomMessagesView.as_view(), name='room-messages'),
+    path('<uuid:room_id>/export/', RoomTranscriptExportView.as_view(), name='room-export'),
     path('<uuid:room_id>/join/', JoinRoomView.as_view(), name='room-join'),
     path('<uuid:room_id>/leave/', LeaveRoomView.as_view(), name='room-leave'),
     path('<uuid:room_id>/members/', RoomMembersView.as_view(), name='room-members'),
     path('<uuid:room_id>/pomodoro/', RoomPomodoroView.as_view(), name='room-pomodoro'),
     # File sharing
     path('<uuid:room_id>/files/', RoomFileListCreateView.as_view(), name='room-files'),
+    path('<uuid:room_id>/files/archive/', RoomFileArchiveView.as_view(), name='room-file-archive'),
     path('<uuid:room_id>/files/<uuid:file_id>/', RoomFileDetailView.as_view(), name='room-file-detail'),
+    path('<uuid:room_id>/files/<uuid:file_id>/<str:kind>/', RoomFileDerivativeView.as_view(), name='room-file-derivative'),
+    # Resumable uploads
+    path('<uuid:room_id>/uploads/', UploadSessionCreateView.as_view(), name='room-upload-create'),
+    path('<uuid:room_id>/uploads/<uuid:upload_id>/', UploadSessionDetailView.as_view(), name='room-upload-detail'),
+    path('<uuid:room_id>/uploads/<uuid:upload_id>/complete/', UploadSessionCompleteView.as_view(), name='room-upload-complete'),
 ]
@@ -1,108 +1,139 @@
 from rest_framework import generics, permissions, filters, exceptions, status
 from rest_framework.views import APIView
+from rest_framework.request import Request
 from rest_framework.response import Response
-from rest_framework.parsers import MultiPartParser, FormParser
-from django.shortcuts import get_object_or_404
-from django.http import FileResponse
+from django.shortcuts import aget_object_or_404, get_object_or_404
+from django.http import Http404, StreamingHttpResponse
 from django.conf import settings
-from rest_framework.pagination import PageNumberPagination
-from .models import Room, RoomMembership, Message, PomodoroSession, RoomFile
-from .serializers import RoomSerializer, MessageSerializer, RoomMembershipSerializer, PomodoroSerializer, RoomFileSerializer
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from django.core.cache import cache
+from .models import Room, RoomMembership, Message, PomodoroSession, RoomFile, RoomPurge, UploadSession
+from .serializers import RoomSerializer, MessageSerializer, RoomMembershipSerializer, PomodoroSerializer, RoomFileSerializer, RoomPurgeSerializer
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.db import close_old_connections, transaction
+from asgiref.sync import sync_to_async
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
-from utils.encryption_service import EncryptionService
+from utils.async_views import AsyncAPIView
+from utils.streaming import aiter_sync
+from .access import aresolve_access
+from .archive import RoomHistory
+from .admission import (
+    RoomFull, admit_waitlisted, announce_membership, join_room, join_waitlist,
+    leave_waitlist, remove_member
+)
+from .archives import iter_zip_archive
+from .blobs import release_room_file
+from .counters import record_download, pending_downloads
+from .downloads import file_etag, serve_room_file, serve_stored_file
+from .exports import EXPORT_FORMATS, stream_transcript
+from .listings import (
+    FIRST_PAGE_CACHE_TTL, filter_room_files, first_page_cache_key,
+    invalidate_file_list, is_first_page_request
+)
+from .outbox import enqueue_broadcast
+from .pomodoro_state import aget_state, aupdate_state
+from .permissions import IsRoomMember
+from .purge import delete_room
+from .thumbnails import DERIVATIVES, derivative_name, ensure_derivative, supports_derivatives
+from .uploads import (
+    UploadError, SHA256UploadHandler, validate_upload, check_room_quota, guess_mime_type,
+    create_room_file, announce_room_file,
+    start_session_file, write_chunk, finalize_session, discard_session_file
+)
+import io
 import os
-import mimetypes
-import json
-from django.core.serializers.json import DjangoJSONEncoder
+import uuid
 
-class RoomPomodoroView(APIView):
-    permission_classes = [permissions.IsAuthenticated]
+import redis
 
-    def get_object(self, room_id):
-        room = get_object_or_404(Room, id=room_id)
-        session, created = PomodoroSession.objects.get_or_create(room=room)
-        return session
 
-    def check_write_permission(self, room_id, user):
-        # Check if user is owner of the room
-        room = get_object_or_404(Room, id=room_id)
-        if room.owner == user:
-            return
+class RoomPomodoroView(AsyncAPIView):
+    """
+    The live timer is read from and changed in Redis (see pomodoro_state.py);
+    the table only catches up a few seconds later, so neither polling nor
+    controlling the timer waits on the database.
+    """
+    ACTIONS = ('start', 'pause', 'reset', 'set_phase')
 
-        # Check if user is admin or moderator
-        if not RoomMembership.objects.filter(
-            room_id=room_id, 
-            user=user, 
-            role__in=['admin', 'moderator']
-        ).exists():
+    async def get_object(self, room_id):
+        # The session almost always exists already
+        try:
+            return await PomodoroSession.objects.aget(room_id=room_id)
+        except PomodoroSession.DoesNotExist:
+            room = await aget_object_or_404(Room, id=room_id)
+            session, created = await PomodoroSession.objects.aget_or_create(room=room)
+            return session
+
+    async def check_write_permission(self, request, room_id):
+        # Owners, admins and moderators control the timer
+        access = await aresolve_access(request, room_id)
+        if not access.is_moderator:
             raise exceptions.PermissionDenied("Only admins can control the timer.")
 
-    def get(self, request, room_id):
-        session = self.get_object(room_id)
+    async def get(self, request, room_id):
+        try:
+            session = await aget_state(room_id)
+        except redis.RedisError:
+            # Serve the last state written to the table rather than fail
+            session = await self.get_object(room_id)
         serializer = PomodoroSerializer(session)
         return Response(serializer.data)
 
-    def post(self, request, room_id):
+    async def post(self, request, room_id):
         action = request.data.get('action')
-        session = self.get_object(room_id)
-        
-        # Verify user is a room member
-        self.check_write_permission(room_id, request.user)
+        await self.check_write_permission(request, room_id)
+        if action not in self.ACTIONS:
+            return Response({'error': 'Invalid action'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            session, changed = await aupdate_state(
+                room_id, lambda session: self.apply_action(session, action, request.data)
+            )
+        except redis.RedisError:
+            return Response({'error': 'The timer is unavailable, try again shortly'},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        data = PomodoroSerializer(session).data
+        if changed:
+            # Nothing is written to the database, so there is no transaction
+            # for the outbox to join; clients order updates by `version`
+            await get_channel_layer().group_send(f"room_{room_id}", {
+                "type": "pomodoro_update",
+                "data": data
+            })
+        return Response(data)
 
+    def apply_action(self, session, action, data):
+        """Change the timer as asked; returns False when there is nothing to change"""
         if action == 'start':
-            if not session.is_running:
-                session.start_time = timezone.now()
-                session.is_running = True
-                session.save()
-        elif action == 'pause':
             if session.is_running:
-                # Calculate remaining and save
-                session.remaining_seconds = session.get_current_remaining()
-                session.is_running = False
-                session.start_time = None
-                session.save()
+                return False
+            session.start_time = timezone.now()
+            session.is_running = True
+        elif action == 'pause':
+            if not session.is_running:
+                return False
+            # Calculate remaining and save
+            session.remaining_seconds = session.get_current_remaining()
+            session.is_running = False
+            session.start_time = None
         elif action == 'reset':
-             # Stop and reset to default for current phase
-             session.is_running = False
-             session.start_time = None
-             if session.phase == 'work':
-                 session.remaining_seconds = session.work_duration
-             elif session.phase == 'short_break':
-                 session.remaining_seconds = session.short_break_duration
-             elif session.phase == 'long_break':
-                 session.remaining_seconds = session.long_break_duration
-             session.save()
+            # Stop and reset to default for current phase
+            session.is_running = False
+            session.start_time = None
+            session.remaining_seconds = session.duration_for(session.phase)
         elif action == 'set_phase':
-             phase = request.data.get('phase')
-             if phase in dict(PomodoroSession.PHASE_CHOICES):
-                 session.phase = phase
-                 session.is_running = False
-                 session.start_time = None
-                 # Set duration based on phase
-                 if phase == 'work':
-                     session.remaining_seconds = session.work_duration
-                 elif phase == 'short_break':
-                     session.remaining_seconds = session.short_break_duration
-                 elif phase == 'long_break':
-                     session.remaining_seconds = session.long_break_duration
-                 session.save()
-        else:
-            return Response({'error': 'Invalid action'}, status=status.HTTP_400_BAD_REQUEST)
+            phase = data.get('phase')
+            if phase not in dict(PomodoroSession.PHASE_CHOICES):
+                return False
+            session.phase = phase
+            session.is_running = False
+            session.start_time = None
+            # Set duration based on phase
+            session.remaining_seconds = session.duration_for(phase)
+        return True
 
-        # Broadcast update
-        serializer = PomodoroSerializer(session)
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"room_{room_id}",
-            {
-                "type": "pomodoro_update",
-                "data": serializer.data
-            }
-        )
-        
-        return Response(serializer.data)
 
 class RoomPagination(PageNumberPagination):
     page_size = 10
@@ -118,13 +149,14 @@ class RoomListCreateView(generics.ListCreateAPIView):
     search_fields = ['name', 'topic']
 
     def perform_create(self, serializer):
-        room = serializer.save(owner=self.request.user)
-        # Automatically create admin membership for room owner
-        RoomMembership.objects.create(
-            room=room,
-            user=self.request.user,
-            role='admin'
-        )
+        with transaction.atomic():
+            room = serializer.save(owner=self.request.user, member_count=1)
+            # Automatically create admin membership for room owner
+            RoomMembership.objects.create(
+                room=room,
+                user=self.request.user,
+                role='admin'
+            )
 
 class RoomDetailView(generics.RetrieveUpdateDestroyAPIView):
     queryset = Room.objects.all()
@@ -135,6 +167,26 @@ class RoomDetailView(generics.RetrieveUpdateDestroyAPIView):
         # Optional: restrict updates to owner, read to everyone/members
         return super().get_queryset()
 
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            room = serializer.save()
+            # Raising the capacity frees seats for anyone waiting
+            admit_waitlisted(room.id)
+
+    def destroy(self, request, *args, **kwargs):
+        # The room disappears at once; its messages, files and the rest are
+        # removed in the background (see rooms/purge.py)
+        purge = delete_room(self.get_object(), request.user)
+        return Response(RoomPurgeSerializer(purge).data, status=status.HTTP_202_ACCEPTED)
+
+class RoomPurgeView(generics.RetrieveAPIView):
+    """Progress of the purge of a room the user deleted"""
+    serializer_class = RoomPurgeSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_object(self):
+        return get_object_or_404(RoomPurge, room_id=self.kwargs['room_id'], requested_by=self.request.user)
+
 class MessagePagination(PageNumberPagination):
     page_size = 50
     page_size_query_param = 'page_size'
@@ -142,82 +194,103 @@ class MessagePagination(PageNumberPagination):
 
 class RoomMessagesView(generics.ListAPIView):
     serializer_class = MessageSerializer
-    permission_classes = [permissions.IsAuthenticated]
+    permission_classes = [permissions.IsAuthenticated, IsRoomMember]
     pagination_class = MessagePagination
     
     def get_queryset(self):
         room_id = self.kwargs['room_id']
-        user = self.request.user
-        
-        # Check if user is a member of the room
-        if not RoomMembership.objects.filter(room_id=room_id, user=user).exists():
-            raise exceptions.PermissionDenied("You must join this room to view messages.")
-            
-        return Message.objects.filter(room_id=room_id).order_by('-created_at')
+        queryset = Message.objects.filter(room_id=room_id)
+        self.time_range = {}
+        # A time range keeps the query to the partitions of the months it spans
+        for param, lookup in (('before', 'created_at__lt'), ('after', 'created_at__gte')):
+            value = self.request.query_params.get(param)
+            if not value:
+                continue
+            try:
+                moment = parse_datetime(value)
+            except ValueError:
+                moment = None
+            if moment is None:
+                raise exceptions.ValidationError({param: 'Must be an ISO 8601 datetime.'})
+            if timezone.is_naive(moment):
+                moment = timezone.make_aware(moment)
+            queryset = queryset.filter(**{lookup: moment})
+            self.time_range[param] = moment
+        return queryset.order_by('-created_at')
+
+    def paginate_queryset(self, queryset):
+        # Pages past the messages in the table carry on into the room's archive
+        return super().paginate_queryset(RoomHistory(queryset, self.kwargs['room_id'], **self.time_range))
+
+    def list(self, request, *args, **kwargs):
+        page = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        context = self.get_serializer_context()
+        # Buffered downloads of the page's files in one Redis round trip, not one per file
+        context['pending_downloads'] = pending_downloads([m.file_id for m in page if m.file_id])
+        serializer = self.get_serializer(page, many=True, context=context)
+        return self.get_paginated_response(serializer.data)
+
+class RoomTranscriptExportView(APIView):
+    """Stream a room's full message history as NDJSON or CSV"""
+    permission_classes = [permissions.IsAuthenticated, IsRoomMember]
+
+    def get(self, request, room_id):
+        # Not `format`: DRF reserves that query param for renderer selection
+        export_format = request.query_params.get('type', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            return Response(
+                {'error': f'Unsupported export type. Choose one of: {list(EXPORT_FORMATS)}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        response = StreamingHttpResponse(
+            aiter_sync(stream_transcript(room_id, export_format)),
+            content_type=EXPORT_FORMATS[export_format]
+        )
+        timestamp = timezone.now().strftime('%Y%m%d-%H%M%S')
+        response['Content-Disposition'] = f'attachment; filename="transcript-{room_id}-{timestamp}.{export_format}"'
+        return response
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 
-class JoinRoomView(APIView):
-    permission_classes = [permissions.IsAuthenticated]
+class JoinRoomView(AsyncAPIView):
     
-    def post(self, request, room_id):
-        """Join a room by creating a membership"""
+    async def post(self, request, room_id):
+        """Join a room by creating a membership, or wait for a seat with {"waitlist": true}"""
         try:
-            room = Room.objects.get(id=room_id)
+            room = await Room.objects.aget(id=room_id)
         except Room.DoesNotExist:
             return Response(
                 {'error': 'Room not found'}, 
                 status=status.HTTP_404_NOT_FOUND
             )
         
-        # Check if room is at capacity
-        current_members = RoomMembership.objects.filter(room=room).count()
-        if current_members >= room.capacity:
-            return Response(
-                {'error': 'Room is at full capacity'}, 
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
         # Determine role (admin if owner, else member)
-        role = 'admin' if room.owner == request.user else 'member'
+        role = 'admin' if room.owner_id == request.user.id else 'member'
         
-        # Check if user is already a member
-        membership, created = RoomMembership.objects.get_or_create(
-            room=room,
-            user=request.user,
-            defaults={'role': role}
-        )
+        # Takes a seat only if one is free, and only once per user
+        try:
+            membership, created = await sync_to_async(join_room)(room, request.user, role)
+        except RoomFull:
+            if not request.data.get('waitlist'):
+                return Response(
+                    {'error': 'Room is at full capacity'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            position = await sync_to_async(join_waitlist)(room, request.user)
+            if position is not None:
+                return Response({
+                    'message': 'Added to the waitlist',
+                    'room_id': str(room.id),
+                    'position': position
+                }, status=status.HTTP_202_ACCEPTED)
+            # A seat was given back in the meantime and they were admitted
+            membership = await RoomMembership.objects.aget(room=room, user=request.user)
+            created = True
         
         if created:
-            # Create system message
-            try:
-                content = f"{request.user.username} joined the room"
-                encrypted_content = EncryptionService.encrypt(content)
-                sys_msg = Message.objects.create(
-                    room=room,
-                    sender=None, # System Sender
-                    content=encrypted_content,
-                    message_type='join'
-                )
-                
-                channel_layer = get_channel_layer()
-                async_to_sync(channel_layer.group_send)(
-                    f'room_{room.id}',
-                    {
-                        'type': 'chat_message',
-                        'content': content,
-                        'username': 'System',
-                        'id': str(sys_msg.id),
-                        'sender_id': None,
-                        'message_type': 'join',
-                        'created_at': sys_msg.created_at.isoformat()
-                    }
-                )
-            except Exception as e:
-                print(f"Failed to create join message: {e}")
-
             return Response({
                 'message': 'Successfully joined room',
                 'room_id': str(room.id),
@@ -230,50 +303,35 @@ class JoinRoomView(APIView):
                 'role': membership.role
             }, status=status.HTTP_200_OK)
 
-class LeaveRoomView(APIView):
-    permission_classes = [permissions.IsAuthenticated]
+    async def delete(self, request, room_id):
+        """Give up a place on the room's waitlist"""
+        if not await sync_to_async(leave_waitlist)(room_id, request.user):
+            return Response({'error': 'Not on the waitlist'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
-    def post(self, request, room_id):
-        room = get_object_or_404(Room, id=room_id)
-        
-        try:
-            membership = RoomMembership.objects.get(room=room, user=request.user)
-        except RoomMembership.DoesNotExist:
-             return Response({'error': 'Not a member'}, status=status.HTTP_400_BAD_REQUEST)
+class LeaveRoomView(AsyncAPIView):
 
-        if room.owner == request.user:
-            return Response({'error': 'Owner cannot leave room. Delete room instead.'}, status=status.HTTP_400_BAD_REQUEST)
+    async def post(self, request, room_id):
+        room = await aget_object_or_404(Room, id=room_id)
 
-        try:
-            content = f"{request.user.username} left the room"
-            encrypted_content = EncryptionService.encrypt(content)
-            sys_msg = Message.objects.create(
-                room=room,
-                sender=None,
-                content=encrypted_content,
-                message_type='leave'
-            )
-            
-            channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
-                f'room_{room.id}',
-                {
-                    'type': 'chat_message',
-                    'content': content,
-                    'username': 'System',
-                    'id': str(sys_msg.id),
-                    'sender_id': None,
-                    'message_type': 'leave',
-                    'created_at': sys_msg.created_at.isoformat()
-                }
-            )
-        except Exception as e:
-            print(f"Failed to send leave message: {e}")
+        if room.owner_id == request.user.id:
+            return Response({'error': 'Owner cannot leave room. Delete room instead.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        membership.delete()
+        if not await sync_to_async(self.leave)(room, request.user):
+            return Response({'error': 'Not a member'}, status=status.HTTP_400_BAD_REQUEST)
 
         return Response({'message': 'Left room successfully'})
 
+    def leave(self, room, user):
+        """Delete the membership and announce it in one transaction"""
+        with transaction.atomic():
+            # Announced first so it precedes any waitlisted user taking the seat
+            announce_membership(room.id, user, 'leave')
+            if not remove_member(room.id, user.id):
+                transaction.set_rollback(True)
+                return False
+        return True
+
 class RoomMembersView(generics.ListAPIView):
     serializer_class = RoomMembershipSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -283,159 +341,295 @@ class RoomMembersView(generics.ListAPIView):
         return RoomMembership.objects.filter(room_id=room_id).select_related('user')
 
 
-class RoomFileListCreateView(APIView):
+class RoomFilePagination(CursorPagination):
+    page_size = 30
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = '-created_at'
+
+
+class RoomFileListCreateView(AsyncAPIView):
     """List and upload files for a room"""
-    permission_classes = [permissions.IsAuthenticated]
-    parser_classes = [MultiPartParser, FormParser]
+    permission_classes = [IsRoomMember]
 
-    def get(self, request, room_id):
+    async def get(self, request, room_id):
         """List all files in a room"""
-        room = get_object_or_404(Room, id=room_id)
-        
-        # Check if user is a member
-        if not RoomMembership.objects.filter(room=room, user=request.user).exists() and room.owner != request.user:
-            raise exceptions.PermissionDenied("You must be a room member to view files.")
-        
-        files = RoomFile.objects.filter(room=room)
-        serializer = RoomFileSerializer(files, many=True, context={'request': request})
-        return Response(serializer.data)
-
-    def post(self, request, room_id):
+        # Everyone opening the room asks for the same first page
+        cacheable = is_first_page_request(request.GET)
+        if cacheable:
+            data = await cache.aget(first_page_cache_key(room_id))
+            if data is not None:
+                return Response(data)
+
+        data = await sync_to_async(self.list_page)(request, room_id)
+        if cacheable:
+            await cache.aset(first_page_cache_key(room_id), data, FIRST_PAGE_CACHE_TTL)
+        return Response(data)
+
+    def list_page(self, request, room_id):
+        # DRF pagination is synchronous and expects a DRF request
+        request = Request(request)
+        files = filter_room_files(
+            RoomFile.objects.filter(room_id=room_id).select_related('uploaded_by'),
+            request.query_params
+        )
+        paginator = RoomFilePagination()
+        page = paginator.paginate_queryset(files, request, view=self)
+        serializer = RoomFileSerializer(page, many=True, context={
+            'request': request,
+            'pending_downloads': pending_downloads([f.id for f in page])
+        })
+        return paginator.get_paginated_response(serializer.data).data
+
+    async def post(self, request, room_id):
         """Upload a file to a room"""
+        # Parsing, hashing and storing the upload block, so they share one thread hop
+        return await sync_to_async(self.store_upload)(request, room_id)
+
+    def store_upload(self, request, room_id):
+        # Loaded here for its current storage usage, which the quota check reads
         room = get_object_or_404(Room, id=room_id)
-        
-        # Check if user is a member
-        if not RoomMembership.objects.filter(room=room, user=request.user).exists() and room.owner != request.user:
-            raise exceptions.PermissionDenied("You must be a room member to upload files.")
-        
+
+        # Hash the upload while it streams in so identical content is stored once
+        hasher = SHA256UploadHandler(request)
+        request.upload_handlers.insert(0, hasher)
+
         file = request.FILES.get('file')
         if not file:
             return Response({'error': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Validate file size
-        max_size = getattr(settings, 'MAX_FILE_SIZE_MB', 10) * 1024 * 1024
-        if file.size > max_size:
-            return Response(
-                {'error': f'File too large. Maximum size is {settings.MAX_FILE_SIZE_MB}MB'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        # Validate file extension
-        ext = os.path.splitext(file.name)[1].lower()
-        allowed_extensions = getattr(settings, 'ALLOWED_FILE_EXTENSIONS', [])
-        if allowed_extensions and ext not in allowed_extensions:
-            return Response(
-                {'error': f'File type not allowed. Allowed types: {allowed_extensions}'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        # Get MIME type
-        mime_type, _ = mimetypes.guess_type(file.name)
-        if not mime_type:
-            mime_type = 'application/octet-stream'
-        
-        # Create file record
-        room_file = RoomFile.objects.create(
-            room=room,
-            uploaded_by=request.user,
-            file=file,
-            original_filename=file.name,
-            file_size=file.size,
-            file_type=mime_type,
-            description=request.data.get('description', '')
-        )
-        
-        serializer = RoomFileSerializer(room_file, context={'request': request})
-        
-        ws_data = json.loads(json.dumps(serializer.data, cls=DjangoJSONEncoder))
+        try:
+            validate_upload(file.name, file.size, getattr(settings, 'MAX_FILE_SIZE_MB', 10))
+            check_room_quota(room, file.size)
+            with transaction.atomic():
+                # Create file record
+                room_file = create_room_file(
+                    room, request.user, file, hasher.digests['file'],
+                    filename=file.name,
+                    file_size=file.size,
+                    file_type=guess_mime_type(file.name),
+                    description=request.POST.get('description', '')
+                )
+                data = announce_room_file(request, room, room_file)
+        except UploadError as e:
+            return Response({'error': e.message}, status=e.status_code)
         
-        # Broadcast file upload to room members (for Files tab)
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"room_{room_id}",
-            {
-                "type": "file_uploaded",
-                "data": ws_data
-            }
+        return Response(data, status=status.HTTP_201_CREATED)
+
+
+def render_off_shared_thread(room_file, kind):
+    """
+    ensure_derivative for an executor thread, so a slow render doesn't hold
+    up the shared sync thread. Nothing closes connections opened on those
+    threads, so close any left behind here.
+    """
+    try:
+        return ensure_derivative(room_file, kind)
+    finally:
+        close_old_connections()
+
+
+class RoomFileDerivativeView(AsyncAPIView):
+    """Serve an image's thumbnail or web-sized preview"""
+    permission_classes = [IsRoomMember]
+
+    async def get(self, request, room_id, file_id, kind):
+        room_file = await aget_object_or_404(RoomFile, id=file_id, room_id=room_id)
+
+        if kind not in DERIVATIVES or not supports_derivatives(room_file):
+            raise Http404("No preview available for this file.")
+
+        # Normally rendered right after upload; render now if that hasn't happened
+        path = await sync_to_async(render_off_shared_thread, thread_sensitive=False)(room_file, kind)
+        if path is None:
+            raise Http404("No preview available for this file.")
+        storage = room_file.file.storage
+        name = derivative_name(room_file.file.name, kind)
+        return serve_stored_file(
+            request, storage, name,
+            size=os.path.getsize(path),
+            content_type='image/webp',
+            etag=file_etag(room_file)[:-1] + f'-{kind}"',
+            last_modified=int(room_file.created_at.timestamp()),
+            filename=f"{os.path.splitext(room_file.original_filename)[0]}.{kind}.webp",
+            as_attachment=False
         )
 
-        # Create and broadcast chat message (for Chat tab)
-        content_text = "Shared a file"
-        encrypted_content = EncryptionService.encrypt(content_text)
-        
-        message = Message.objects.create(
-             room=room,
-             sender=request.user,
-             content=encrypted_content,
-             file=room_file,
-             message_type='file'
-        )
-        
-        # We need full message serialization for consistency
-        message_serializer = MessageSerializer(message, context={'request': request})
-        message_ws_data = json.loads(json.dumps(message_serializer.data, cls=DjangoJSONEncoder))
-
-        async_to_sync(channel_layer.group_send)(
-            f"room_{room_id}",
-            {
-                "type": "chat_message",
-                "content": content_text, # Broadcast plaintext for immediate display
-                "username": request.user.username,
-                "id": str(message.id),
-                "sender_id": str(request.user.id),
-                "message_type": "file",
-                "created_at": message.created_at.isoformat(),
-                "file": ws_data # Use the already serialized file data
-            }
-        )
-        
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
+class RoomFileArchiveView(AsyncAPIView):
+    """Download all of a room's files, or a selection via ?ids=, as one zip"""
+    permission_classes = [IsRoomMember]
 
+    async def get(self, request, room_id):
+        files = RoomFile.objects.filter(room_id=room_id).only(
+            'id', 'file', 'original_filename', 'file_size', 'created_at'
+        ).order_by('created_at')
 
-class RoomFileDetailView(APIView):
-    """Download or delete a specific file"""
-    permission_classes = [permissions.IsAuthenticated]
+        ids = request.GET.get('ids')
+        if ids:
+            try:
+                selected = [uuid.UUID(value.strip()) for value in ids.split(',') if value.strip()]
+            except ValueError:
+                return Response({'error': 'ids must be a comma-separated list of file ids'}, status=status.HTTP_400_BAD_REQUEST)
+            files = files.filter(id__in=selected)
+
+        # Rows are small; only the file bodies need streaming
+        files = [room_file async for room_file in files]
+        if not files:
+            raise Http404("No files to download.")
+
+        response = StreamingHttpResponse(aiter_sync(iter_zip_archive(files)), content_type='application/zip')
+        timestamp = timezone.now().strftime('%Y%m%d-%H%M%S')
+        response['Content-Disposition'] = f'attachment; filename="room-files-{room_id}-{timestamp}.zip"'
+        return response
 
-    def get_file(self, room_id, file_id):
+class UploadSessionCreateView(APIView):
+    """Start a resumable upload; chunks are then PUT to the session"""
+    permission_classes = [permissions.IsAuthenticated, IsRoomMember]
+
+    def post(self, request, room_id):
         room = get_object_or_404(Room, id=room_id)
-        return get_object_or_404(RoomFile, id=file_id, room=room)
 
-    def check_member_permission(self, room, user):
-        if not RoomMembership.objects.filter(room=room, user=user).exists() and room.owner != user:
-            raise exceptions.PermissionDenied("You must be a room member to access files.")
+        filename = request.data.get('filename')
+        try:
+            file_size = int(request.data.get('file_size'))
+        except (TypeError, ValueError):
+            file_size = -1
+        if not filename or file_size < 0:
+            return Response({'error': 'filename and file_size are required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            validate_upload(filename, file_size, settings.MAX_CHUNKED_FILE_SIZE_MB)
+            check_room_quota(room, file_size)
+        except UploadError as e:
+            return Response({'error': e.message}, status=e.status_code)
+
+        # Only an integrity check at finalize: deduplication goes by the digest
+        # of the bytes actually received, never by what the client claims
+        checksum = request.data.get('sha256', '').lower()
 
-    def check_delete_permission(self, room, user, file):
+        session = UploadSession.objects.create(
+            room=room,
+            user=request.user,
+            original_filename=filename,
+            file_size=file_size,
+            file_type=guess_mime_type(filename),
+            description=request.data.get('description', ''),
+            checksum=checksum
+        )
+        start_session_file(session)
+
+        return Response({
+            'upload_id': str(session.id),
+            'offset': 0,
+            'file_size': session.file_size,
+            'chunk_size': settings.UPLOAD_CHUNK_SIZE
+        }, status=status.HTTP_201_CREATED)
+
+
+class UploadSessionDetailView(APIView):
+    """Query progress (GET), append a chunk (PUT) or abort (DELETE) an upload"""
+    permission_classes = [permissions.IsAuthenticated, IsRoomMember]
+
+    def get_session(self, room_id, upload_id, user, for_update=False):
+        sessions = UploadSession.objects.select_for_update() if for_update else UploadSession.objects
+        return get_object_or_404(sessions, id=upload_id, room_id=room_id, user=user)
+
+    def get(self, request, room_id, upload_id):
+        session = self.get_session(room_id, upload_id, request.user)
+        return Response({
+            'upload_id': str(session.id),
+            'offset': session.received_bytes,
+            'file_size': session.file_size,
+            'is_complete': session.is_complete
+        })
+
+    def put(self, request, room_id, upload_id):
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+        except ValueError:
+            return Response({'error': 'Upload-Offset header is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            # Row lock serializes concurrent PUTs for the same session
+            session = self.get_session(room_id, upload_id, request.user, for_update=True)
+            try:
+                written = write_chunk(session, offset, request.stream or io.BytesIO(),
+                                      expected_sha256=request.headers.get('Upload-Chunk-SHA256'))
+            except UploadError as e:
+                return Response({'error': e.message, 'offset': session.received_bytes}, status=e.status_code)
+
+            session.received_bytes = offset + written
+            session.save(update_fields=['received_bytes', 'updated_at'])
+
+        return Response({
+            'upload_id': str(session.id),
+            'offset': session.received_bytes,
+            'file_size': session.file_size,
+            'is_complete': session.is_complete
+        })
+
+    def delete(self, request, room_id, upload_id):
+        session = self.get_session(room_id, upload_id, request.user)
+        discard_session_file(session)
+        session.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class UploadSessionCompleteView(APIView):
+    """Assemble a fully uploaded session into a RoomFile and announce it"""
+    permission_classes = [permissions.IsAuthenticated, IsRoomMember]
+
+    def post(self, request, room_id, upload_id):
+        with transaction.atomic():
+            session = get_object_or_404(
+                UploadSession.objects.select_for_update().select_related('room'),
+                id=upload_id, room_id=room_id, user=request.user
+            )
+            try:
+                room_file = finalize_session(session)
+            except UploadError as e:
+                if not os.path.exists(session.temp_path):
+                    session.delete()
+                return Response({'error': e.message}, status=e.status_code)
+            session.delete()
+            data = announce_room_file(request, session.room, room_file)
+
+        return Response(data, status=status.HTTP_201_CREATED)
+
+
+class RoomFileDetailView(AsyncAPIView):
+    """Download or delete a specific file"""
+    permission_classes = [IsRoomMember]
+
+    async def get_file(self, room_id, file_id):
+        return await aget_object_or_404(RoomFile, id=file_id, room_id=room_id)
+
+    async def check_delete_permission(self, request, file):
         """Only file uploader, room owner, or admins can delete"""
-        if room.owner == user:
+        if file.uploaded_by_id == request.user.id:
             return
-        if file.uploaded_by == user:
-            return
-        if RoomMembership.objects.filter(room=room, user=user, role__in=['admin', 'moderator']).exists():
+        if (await aresolve_access(request, file.room_id)).is_moderator:
             return
         raise exceptions.PermissionDenied("You don't have permission to delete this file.")
 
-    def get(self, request, room_id, file_id):
-        """Download a file"""
-        room_file = self.get_file(room_id, file_id)
-        self.check_member_permission(room_file.room, request.user)
-        
-        # Increment download count
-        room_file.download_count += 1
-        room_file.save(update_fields=['download_count'])
+    async def get(self, request, room_id, file_id):
+        """Download a file (or a byte range of it)"""
+        room_file = await self.get_file(room_id, file_id)
         
-        # Stream file response
-        response = FileResponse(
-            room_file.file.open('rb'),
-            content_type=room_file.file_type
-        )
-        response['Content-Disposition'] = f'attachment; filename="{room_file.original_filename}"'
+        # Supports Range, ETag and If-None-Match / If-Modified-Since.
+        # Counts are buffered in Redis and flushed in batches.
+        started = []
+        response = serve_room_file(request, room_file, on_download=lambda: started.append(True))
+        if started:
+            # Falls back to the database when Redis is down, so it stays on the
+            # shared thread whose connection Django manages
+            await sync_to_async(record_download)(room_file.id)
         return response
 
-    def delete(self, request, room_id, file_id):
+    async def delete(self, request, room_id, file_id):
         """Delete a file"""
-        room_file = self.get_file(room_id, file_id)
-        self.check_member_permission(room_file.room, request.user)
-        self.check_delete_permission(room_file.room, request.user, room_file)
+        room_file = await self.get_file(room_id, file_id)
+        await self.check_delete_permission(request, room_file)
         
         file_data = {
             'id': str(room_file.id),
@@ -443,21 +637,17 @@ class RoomFileDetailView(APIView):
             'deleted_by': request.user.username
         }
         
-        # Delete the actual file
-        if room_file.file:
-            room_file.file.delete(save=False)
-        
-        room_file.delete()
-        
-        # Broadcast file deletion to room members
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"room_{room_id}",
-            {
-                "type": "file_deleted",
-                "data": file_data
-            }
-        )
+        # Delete the record; shared content is only removed with its last reference
+        await sync_to_async(self.remove_file)(room_file, file_data)
         
         return Response({'message': 'File deleted successfully'}, status=status.HTTP_204_NO_CONTENT)
 
+    def remove_file(self, room_file, file_data):
+        with transaction.atomic():
+            release_room_file(room_file)
+            # Broadcast file deletion to room members
+            enqueue_broadcast(room_file.room_id, {
+                "type": "file_deleted",
+                "data": file_data
+            })
+        invalidate_file_list(room_file.room_id)
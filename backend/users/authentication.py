@@ -1,17 +1,52 @@
 from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+from rest_framework.exceptions import AuthenticationFailed
 from django.conf import settings
 
 class CustomJWTAuthentication(JWTAuthentication):
     def authenticate(self, request):
-        # Try to retrieve the token from the cookie
-        header = self.get_header(request)
-        if header is None:
-            raw_token = request.COOKIES.get(settings.SIMPLE_JWT['AUTH_COOKIE']) or None
-        else:
-            raw_token = self.get_raw_token(header)
-
+        raw_token = self.get_request_token(request)
         if raw_token is None:
             return None
 
         validated_token = self.get_validated_token(raw_token)
         return self.get_user(validated_token), validated_token
+
+    async def aauthenticate(self, request):
+        """Async counterpart of authenticate() for the async API views"""
+        raw_token = self.get_request_token(request)
+        if raw_token is None:
+            return None
+
+        # Access tokens are verified from their signature alone, no queries
+        validated_token = self.get_validated_token(raw_token)
+        return await self.aget_user(validated_token), validated_token
+
+    def get_request_token(self, request):
+        # Try to retrieve the token from the cookie
+        header = self.get_header(request)
+        if header is None:
+            return request.COOKIES.get(settings.SIMPLE_JWT['AUTH_COOKIE']) or None
+        return self.get_raw_token(header)
+
+    async def aget_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken("Token contained no recognizable user identification")
+
+        try:
+            user = await self.user_model.objects.aget(**{api_settings.USER_ID_FIELD: user_id})
+        except self.user_model.DoesNotExist:
+            raise AuthenticationFailed("User not found", code="user_not_found")
+
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN and validated_token.get(
+            api_settings.REVOKE_TOKEN_CLAIM
+        ) != get_md5_hash_password(user.password):
+            raise AuthenticationFailed("The user's password has been changed.", code="password_changed")
+        return user
@@ -1,5 +1,6 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 # We inherit from AbstractUser to get all standard fields (username, email, password)
@@ -15,12 +16,23 @@ class CustomUser(AbstractUser):
         default=False,
         help_text=_("Designates whether this user can create and manage rooms."),
     )
-    # The 'focus_streak' field will be used for your Analytics Dashboard 
+    # Consecutive days with a completed focus phase, up to last_focus_date;
+    # kept by analytics.pipeline as phases complete
     focus_streak = models.IntegerField(default=0)
+    last_focus_date = models.DateField(null=True, blank=True)
 
     # Set the field used for logging in
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username'] # Must include 'username' for the superuser command
 
+    @property
+    def current_focus_streak(self):
+        """focus_streak, or 0 once a whole day has gone by without focusing"""
+        if self.last_focus_date is None:
+            return 0
+        if (timezone.localdate() - self.last_focus_date).days > 1:
+            return 0
+        return self.focus_streak
+
     def __str__(self):
         return self.email
\ No newline at end of file
@@ -31,6 +31,8 @@ class RegisterSerializer(serializers.ModelSerializer):
 
 # 2. User Serializer (for returning user details)
 class UserSerializer(serializers.ModelSerializer):
+    focus_streak = serializers.IntegerField(source='current_focus_streak', read_only=True)
+
     class Meta:
         model = CustomUser
         fields = ('id', 'email', 'username', 'is_room_owner', 'focus_streak')
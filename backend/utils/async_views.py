@@ -0,0 +1,114 @@
+"""
+An async counterpart of DRF's APIView.
+
+DRF views are synchronous, so under daphne each request holds a thread for
+its whole lifetime, including time spent waiting on Redis for channel layer
+sends that have to hop back onto an event loop via async_to_sync.
+AsyncAPIView keeps the parts of APIView our endpoints rely on: JWT
+authentication, the IsAuthenticated requirement, permission classes, JSON
+request bodies, DRF Response rendering and APIException handling. It runs them on a plain async
+Django View, so handlers can await the async ORM and the channel layer
+directly.
+
+Work that is transactional or only available synchronously (DRF pagination,
+multipart parsing, file storage) should be grouped into a single
+sync_to_async call per request.
+"""
+import json
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import PermissionDenied as DjangoPermissionDenied
+from django.http import Http404
+from django.utils.decorators import classonlymethod
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions, status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from users.authentication import CustomJWTAuthentication
+
+
+class AsyncAPIView(View):
+    authentication = CustomJWTAuthentication()
+    require_authentication = True
+    # DRF permissions; an `ahas_permission` coroutine is used when present
+    permission_classes = ()
+
+    @classonlymethod
+    def as_view(cls, **initkwargs):
+        # As with APIView: requests authenticate with a JWT, not the session
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            await self.authenticate(request)
+            await self.check_permissions(request)
+            request.data = self.parse_body(request)
+            method = request.method.lower()
+            handler = getattr(self, method, None) if method in self.http_method_names else None
+            if handler is None:
+                raise exceptions.MethodNotAllowed(request.method)
+            response = await handler(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        return self.finalize_response(request, response)
+
+    async def authenticate(self, request):
+        result = await self.authentication.aauthenticate(request)
+        if result is not None:
+            request.user, request.auth = result
+            return
+        # Replace the session-backed lazy user, which can't load in async code
+        request.user, request.auth = AnonymousUser(), None
+        if self.require_authentication:
+            raise exceptions.NotAuthenticated()
+
+    async def check_permissions(self, request):
+        for permission in (permission_class() for permission_class in self.permission_classes):
+            if hasattr(permission, 'ahas_permission'):
+                allowed = await permission.ahas_permission(request, self)
+            else:
+                allowed = permission.has_permission(request, self)
+            if not allowed:
+                raise exceptions.PermissionDenied(getattr(permission, 'message', None))
+
+    def parse_body(self, request):
+        """JSON and urlencoded bodies; multipart is left for the handler to parse"""
+        if request.content_type == 'application/json':
+            if not request.body:
+                return {}
+            try:
+                return json.loads(request.body)
+            except ValueError as exc:
+                raise exceptions.ParseError(f'JSON parse error - {exc}')
+        if request.content_type == 'application/x-www-form-urlencoded':
+            return request.POST
+        return {}
+
+    def handle_exception(self, exc):
+        if isinstance(exc, Http404):
+            exc = exceptions.NotFound(*exc.args)
+        elif isinstance(exc, DjangoPermissionDenied):
+            exc = exceptions.PermissionDenied(*exc.args)
+        if not isinstance(exc, exceptions.APIException):
+            raise exc
+
+        if isinstance(exc.detail, (list, dict)):
+            data = exc.detail
+        else:
+            data = {'detail': exc.detail}
+        response = Response(data, status=exc.status_code)
+        if isinstance(exc, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)):
+            response.status_code = status.HTTP_401_UNAUTHORIZED
+            response['WWW-Authenticate'] = self.authentication.authenticate_header(None)
+        return response
+
+    def finalize_response(self, request, response):
+        if isinstance(response, Response):
+            # Render here; Django would otherwise do it in a sync thread
+            response.accepted_renderer = JSONRenderer()
+            response.accepted_media_type = 'application/json'
+            response.renderer_context = {'view': self, 'request': request, 'response': response}
+            response.render()
+        return response
@@ -1,26 +1,160 @@
+"""
+Message encryption.
+
+Messages are stored as raw bytes in Message.ciphertext:
+
+    version (1 byte) | flags (1 byte) | key id (8 bytes) | nonce (12 bytes) | AES-256-GCM ciphertext and tag
+
+The key id is the RoomKey holding the room's data key (see rooms/keyring.py),
+so a message can be decrypted without knowing its room. FLAG_COMPRESSED means
+the plaintext was zlib-compressed before encryption, which is only done for
+bodies of COMPRESS_MIN bytes or more, and only when it makes them smaller.
+Everything before the nonce is authenticated along with the ciphertext, so
+none of it can be altered without decryption failing.
+
+Two older formats are still read. Version 1, the same without the key id, was
+encrypted with a single key derived from SECRET_KEY. Messages from before the
+binary format hold a base64 Fernet token in Message.content instead (a str,
+as far as `decrypt` is concerned). migrate_message_ciphertext and
+reencrypt_messages move old rows to the current format.
+"""
+import base64
+import os
+import struct
+import zlib
+from functools import lru_cache
+
+from channels.db import database_sync_to_async
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from django.conf import settings
-import base64
+
+from rooms.keyring import active_keys, active_room_key, data_key, data_keys
+
+VERSION = 2
+SHARED_KEY_VERSION = 1
+FLAG_COMPRESSED = 0x01
+KEY_ID = struct.Struct('>Q')
+NONCE_SIZE = 12
+HEADER_SIZE = 2 + KEY_ID.size
+# Shorter bodies rarely compress enough to be worth it
+COMPRESS_MIN = 256
+
+DECRYPTION_ERROR = "[Decryption Error]"
+
+
+def _key_material():
+    # Use a fixed key for dev derived from SECRET_KEY
+    # In PROD, use os.environ['ENCRYPTION_KEY']
+    return settings.SECRET_KEY[:32].encode().ljust(32, b'X')
+
 
 # Ensure we have an encryption key (in a real app, load from env)
 # For this demo, we can derive one from SECRET_KEY or generate a new one
 # Fernet keys must be 32 url-safe base64-encoded bytes
 def get_cipher_suite():
-    # Use a fixed key for dev derived from SECRET_KEY (hashed then b64 encoded)
-    # In PROD, use os.environ['ENCRYPTION_KEY']
-    key = base64.urlsafe_b64encode(settings.SECRET_KEY[:32].encode().ljust(32, b'X'))
+    """The Fernet cipher of messages stored before the binary format"""
+    key = base64.urlsafe_b64encode(_key_material())
     return Fernet(key)
 
+
+@lru_cache(maxsize=4)
+def _aead(material):
+    key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b'message-content').derive(material)
+    return AESGCM(key)
+
+
+def get_aead():
+    """The shared AES-GCM cipher of version 1 ciphertext"""
+    return _aead(_key_material())
+
+
+def is_legacy(value):
+    """Whether a stored value is a Fernet token rather than binary ciphertext"""
+    return isinstance(value, str)
+
+
+def key_id_of(value):
+    """The RoomKey id a stored value was encrypted with; None for the older formats"""
+    if is_legacy(value) or value[0] != VERSION:
+        return None
+    return KEY_ID.unpack_from(value, 2)[0]
+
+
 class EncryptionService:
     @staticmethod
-    def encrypt(message: str) -> str:
-        f = get_cipher_suite()
-        return f.encrypt(message.encode()).decode()
+    def encrypt(message: str, room_id) -> bytes:
+        return _seal(active_room_key(room_id), message)
+
+    @staticmethod
+    async def aencrypt(message: str, room_id) -> bytes:
+        """encrypt() for async code; only reads the database if the room's key isn't cached"""
+        room_key = active_keys.peek(str(room_id))
+        if room_key is None:
+            room_key = await database_sync_to_async(active_room_key)(room_id)
+        return _seal(room_key, message)
 
     @staticmethod
-    def decrypt(token: str) -> str:
+    def decrypt(value) -> str:
+        """Plaintext of binary ciphertext, or of a Fernet token (a str)"""
         try:
-            f = get_cipher_suite()
-            return f.decrypt(token.encode()).decode()
-        except:
-            return "[Decryption Error]"
+            if is_legacy(value):
+                return get_cipher_suite().decrypt(value.encode()).decode()
+            return _open(value)
+        except Exception:
+            return DECRYPTION_ERROR
+
+    @staticmethod
+    async def adecrypt(value) -> str:
+        """decrypt() for async code; only reads the database if the key isn't cached"""
+        key_id = None if value is None else key_id_of(value)
+        if key_id is not None and data_keys.peek(key_id) is None:
+            return await database_sync_to_async(EncryptionService.decrypt)(value)
+        return EncryptionService.decrypt(value)
+
+    @staticmethod
+    def decrypt_many(values):
+        """Decrypt a batch of stored values, reusing the ciphers across it"""
+        fernet = None
+        results = []
+        for value in values:
+            try:
+                if is_legacy(value):
+                    fernet = fernet or get_cipher_suite()
+                    results.append(fernet.decrypt(value.encode()).decode())
+                else:
+                    results.append(_open(value))
+            except Exception:
+                results.append(DECRYPTION_ERROR)
+        return results
+
+
+def _seal(room_key, message):
+    key_id, cipher = room_key
+    data = message.encode()
+    flags = 0
+    if len(data) >= COMPRESS_MIN:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            data, flags = compressed, FLAG_COMPRESSED
+    header = bytes((VERSION, flags)) + KEY_ID.pack(key_id)
+    nonce = os.urandom(NONCE_SIZE)
+    return header + nonce + cipher.encrypt(nonce, data, header)
+
+
+def _open(value):
+    value = bytes(value)  # memoryview from PostgreSQL
+    version, flags = value[0], value[1]
+    if version == VERSION:
+        header_size, cipher = HEADER_SIZE, data_key(KEY_ID.unpack_from(value, 2)[0])
+    elif version == SHARED_KEY_VERSION:
+        header_size, cipher = 2, get_aead()
+    else:
+        raise ValueError(f"Unknown ciphertext version {version}")
+    header, nonce = value[:header_size], value[header_size:header_size + NONCE_SIZE]
+    data = cipher.decrypt(nonce, value[header_size + NONCE_SIZE:], header)
+    if flags & FLAG_COMPRESSED:
+        data = zlib.decompress(data)
+    return data.decode()
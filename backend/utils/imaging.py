@@ -0,0 +1,57 @@
+"""
+Image derivative rendering.
+
+Kept free of Django imports so it can run in freshly spawned worker
+processes without configuring settings or the app registry.
+"""
+import os
+import tempfile
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; derivatives are simply not offered
+    Image = None
+
+# What rendering a corrupt, truncated, unsupported or oversized upload raises
+# (PIL.UnidentifiedImageError is an OSError)
+RENDER_ERRORS = (OSError, ValueError, SyntaxError) + ((Image.DecompressionBombError,) if Image else ())
+
+
+def imaging_available():
+    return Image is not None
+
+
+def render_derivative(src_path, dest_path, max_size, quality=80):
+    """
+    Write a WebP no larger than `max_size` for the image at `src_path`.
+
+    The output is written to a temporary file of its own and renamed into
+    place, so readers never observe a partially written file, and two
+    renders of the same image racing each other both succeed. Returns
+    `dest_path`; raises one of RENDER_ERRORS if the image can't be rendered.
+    """
+    if os.path.exists(dest_path):
+        return dest_path
+
+    with Image.open(src_path) as img:
+        # Let JPEG decode at reduced scale instead of full resolution
+        img.draft('RGB', max_size)
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail(max_size, Image.Resampling.LANCZOS)
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'transparency' in img.info or img.mode in ('LA', 'P') else 'RGB')
+
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(dest_path), prefix=f"{os.path.basename(dest_path)}.", suffix='.tmp'
+        )
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                img.save(tmp, 'WEBP', quality=quality, method=4)
+            os.replace(tmp_path, dest_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+    return dest_path
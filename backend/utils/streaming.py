@@ -0,0 +1,27 @@
+from asgiref.sync import sync_to_async
+
+_EXHAUSTED = object()
+
+
+async def aiter_sync(iterable):
+    """
+    Drive a blocking iterator from the event loop, one item per thread hop.
+
+    Django buffers synchronous iterators completely before sending them
+    over ASGI, so streaming responses served by daphne should wrap their
+    generators with this to keep memory bounded. The iterator runs in the
+    request's thread-sensitive executor, so it can safely hold a database
+    cursor open between steps.
+    """
+    iterator = iter(iterable)
+    step = sync_to_async(next, thread_sensitive=True)
+    try:
+        while True:
+            item = await step(iterator, _EXHAUSTED)
+            if item is _EXHAUSTED:
+                return
+            yield item
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            await sync_to_async(close, thread_sensitive=True)()
@@ -14,6 +14,8 @@ export interface Room {
     owner_username: string;
     created_at: string;
     active_members_count: number;
+    storage_used: number; // bytes of shared files
+    storage_limit: number; // bytes
 }
 
 export interface RoomListResponse {
@@ -148,6 +150,10 @@ export interface PomodoroSession {
     work_duration: number;
     short_break_duration: number;
     long_break_duration: number;
+    long_break_interval: number; // focus phases per long break
+    completed_cycles: number;
+    version: number; // goes up with every change to the timer
+    ends_at: string | null; // when the running phase is over
     current_time: string; // server time
 }
 
@@ -173,16 +179,27 @@ export interface RoomFile {
     file_type: string;
     file_extension: string;
     is_image: boolean;
+    thumbnail_url: string | null; // small WebP, images only
+    preview_url: string | null; // web-sized WebP, images only
     description: string;
     download_count: number;
     created_at: string;
 }
 
+export interface CursorPage<T> {
+    next: string | null;
+    previous: string | null;
+    results: T[];
+}
+
 /**
- * Get all files in a room
+ * Get a page of files in a room, newest first.
+ * Pass the `next` link of the previous page to continue.
  */
-export async function getRoomFiles(roomId: string): Promise<RoomFile[]> {
-    return apiClient<RoomFile[]>(`/rooms/${roomId}/files/`);
+export async function getRoomFiles(roomId: string, next?: string | null): Promise<CursorPage<RoomFile>> {
+    const cursor = next ? new URL(next).searchParams.get("cursor") : null;
+    const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : "";
+    return apiClient<CursorPage<RoomFile>>(`/rooms/${roomId}/files/${query}`);
 }
 
 /**
@@ -73,6 +73,9 @@ interface ChatSidebarProps {
     hasMore?: boolean;
     isLoadingMore?: boolean;
     isLoading?: boolean;
+    onLoadMoreFiles?: () => void;
+    hasMoreFiles?: boolean;
+    isLoadingMoreFiles?: boolean;
 }
 
 // Helper functions
@@ -128,7 +131,10 @@ export default function ChatSidebar({
     onLoadMore,
     hasMore,
     isLoadingMore,
-    isLoading
+    isLoading,
+    onLoadMoreFiles,
+    hasMoreFiles,
+    isLoadingMoreFiles
 }: ChatSidebarProps) {
     const displayUsers = useMemo(() => {
         // Temporary fix: Show all members as online since WebSocket presence is unreliable
@@ -532,6 +538,9 @@ export default function ChatSidebar({
                         files={files}
                         canUpload={canUploadFile}
                         canDelete={canDeleteFile}
+                        onLoadMore={onLoadMoreFiles}
+                        hasMore={hasMoreFiles}
+                        isLoadingMore={isLoadingMoreFiles}
                     />
                 )}
             </Box>
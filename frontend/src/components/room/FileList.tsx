@@ -1,10 +1,10 @@
 import {
     Box, Typography, List, ListItem, ListItemText, ListItemIcon,
-    IconButton, Tooltip, ListItemSecondaryAction
+    IconButton, Tooltip, ListItemSecondaryAction, Button
 } from '@mui/material';
 import {
     FileText, Image, Music, FileCode, Archive, File as FileIcon,
-    Download, Trash2
+    Download, Trash2, FolderDown
 } from 'lucide-react';
 import { type RoomFile, deleteRoomFile } from '../../api/rooms';
 import { getCookie } from '../../api/client';
@@ -14,9 +14,12 @@ interface FileListProps {
     files: RoomFile[];
     canUpload: boolean;
     canDelete: (file: RoomFile) => boolean;
+    onLoadMore?: () => void;
+    hasMore?: boolean;
+    isLoadingMore?: boolean;
 }
 
-export default function FileList({ roomId, files, canDelete }: FileListProps) {
+export default function FileList({ roomId, files, canDelete, onLoadMore, hasMore, isLoadingMore }: FileListProps) {
     // Header Removed - Upload moved to Chat
 
     const handleDelete = async (fileId: string) => {
@@ -41,8 +44,21 @@ export default function FileList({ roomId, files, canDelete }: FileListProps) {
     };
 
     const handleDownload = (file: RoomFile) => {
-        const token = getCookie("access_token");
         const url = `${import.meta.env.VITE_API_URL || 'http://localhost:8000'}/api/rooms/${roomId}/files/${file.id}/`;
+        saveFromUrl(url, file.original_filename);
+    };
+
+    const handleDownloadAll = () => {
+        // Zipped server-side as it streams. A plain navigation (authenticated by
+        // the access_token cookie) lets the browser write it straight to disk
+        // instead of holding the whole archive in memory as a blob; the
+        // response is an attachment, so the page stays where it is.
+        const url = `${import.meta.env.VITE_API_URL || 'http://localhost:8000'}/api/rooms/${roomId}/files/archive/`;
+        window.location.assign(url);
+    };
+
+    const saveFromUrl = (url: string, filename: string) => {
+        const token = getCookie("access_token");
 
         fetch(url, {
             headers: { 'Authorization': `Bearer ${token}` }
@@ -52,7 +68,7 @@ export default function FileList({ roomId, files, canDelete }: FileListProps) {
                 const url = window.URL.createObjectURL(blob);
                 const a = document.createElement('a');
                 a.href = url;
-                a.download = file.original_filename;
+                a.download = filename;
                 document.body.appendChild(a);
                 a.click();
                 window.URL.revokeObjectURL(url);
@@ -64,6 +80,13 @@ export default function FileList({ roomId, files, canDelete }: FileListProps) {
     return (
         <Box display="flex" flexDirection="column" height="100%">
             {/* Header Removed - Upload moved to Chat */}
+            {files.length > 0 && (
+                <Box px={2} pt={1} display="flex" justifyContent="flex-end">
+                    <Button size="small" startIcon={<FolderDown size={16} />} onClick={handleDownloadAll}>
+                        Download all
+                    </Button>
+                </Box>
+            )}
 
             {/* File List */}
             <Box flexGrow={1} overflow="auto">
@@ -124,6 +147,13 @@ export default function FileList({ roomId, files, canDelete }: FileListProps) {
                         ))}
                     </List>
                 )}
+                {hasMore && onLoadMore && (
+                    <Box p={1} textAlign="center">
+                        <Button size="small" onClick={onLoadMore} disabled={isLoadingMore}>
+                            {isLoadingMore ? 'Loading...' : 'Load older files'}
+                        </Button>
+                    </Box>
+                )}
             </Box>
         </Box>
     );
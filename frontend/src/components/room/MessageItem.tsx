@@ -298,7 +298,7 @@ export default function MessageItem({
                                     message.file.is_image ? (
                                         <Box sx={{ mt: 0.5, mb: 1 }}>
                                             <img
-                                                src={message.file.file_url}
+                                                src={message.file.preview_url ?? message.file.file_url}
                                                 alt={message.file.original_filename}
                                                 style={{
                                                     maxWidth: '100%',
@@ -7,31 +7,33 @@ interface PomodoroTimerProps {
     roomId: string;
     session: PomodoroSession | null;
     canControl?: boolean; // true if user is owner/admin/moderator
+    clockOffset?: number; // server clock minus ours, in ms, from the socket's clock sync
 }
 
-export default function PomodoroTimer({ roomId, session, canControl = false }: PomodoroTimerProps) {
+export default function PomodoroTimer({ roomId, session, canControl = false, clockOffset = 0 }: PomodoroTimerProps) {
     const [displayTime, setDisplayTime] = useState(0);
 
     useEffect(() => {
         if (!session) return;
 
-        // Capture time when we received this session state
-        const receivedAt = Date.now();
+        // Count down to the phase's end on the server's clock, so time spent
+        // in transit and our own clock being off don't show
+        const endsAt = session.ends_at ? Date.parse(session.ends_at) : null;
         const baseRemaining = session.remaining;
 
         const updateTimer = () => {
-            if (session.is_running) {
-                const elapsed = (Date.now() - receivedAt) / 1000;
-                setDisplayTime(Math.max(0, baseRemaining - elapsed));
+            if (session.is_running && endsAt !== null) {
+                setDisplayTime(Math.max(0, (endsAt - (Date.now() + clockOffset)) / 1000));
             } else {
                 setDisplayTime(baseRemaining);
             }
         };
 
         updateTimer();
-        const interval = setInterval(updateTimer, 1000);
+        // Finer than a second so the display never lags a whole second behind
+        const interval = setInterval(updateTimer, 250);
         return () => clearInterval(interval);
-    }, [session]);
+    }, [session, clockOffset]);
 
     const formatTime = (seconds: number) => {
         const m = Math.floor(seconds / 60);
@@ -113,6 +115,11 @@ export default function PomodoroTimer({ roomId, session, canControl = false }: P
                 {formatTime(displayTime)}
             </Typography>
 
+            {/* Cycle progress - the server advances phases when the timer runs out */}
+            <Typography variant="caption" color="text.secondary" component="div" sx={{ mb: 2 }}>
+                Focus sessions completed: {session.completed_cycles}
+            </Typography>
+
             {/* Control buttons - Only for admins */}
             {canControl ? (
                 <>
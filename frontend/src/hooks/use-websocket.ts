@@ -16,6 +16,16 @@ export const useWebSocket = (roomId: string) => {
     const [unreadCount, setUnreadCount] = useState<number>(0);
     const [isConnected, setIsConnected] = useState(false);
     const wsRef = useRef<WebSocket | null>(null);
+    // Latest messages, for the send callbacks below without re-creating them
+    const messagesRef = useRef<ChatMessage[]>([]);
+    useEffect(() => {
+        messagesRef.current = messages;
+    }, [messages]);
+    // Sent with a message id so the server only searches that month's partition
+    const createdAtOf = useCallback(
+        (messageId: string) => messagesRef.current.find(m => m.id === messageId)?.created_at,
+        []
+    );
 
     const [page, setPage] = useState(1);
     const [hasMore, setHasMore] = useState(true);
@@ -23,6 +33,11 @@ export const useWebSocket = (roomId: string) => {
     const [isLoading, setIsLoading] = useState(true); // Initial load state
     const [pomodoro, setPomodoro] = useState<PomodoroSession | null>(null);
     const [files, setFiles] = useState<RoomFile[]>([]);
+    const [filesNext, setFilesNext] = useState<string | null>(null);
+    const [isLoadingMoreFiles, setIsLoadingMoreFiles] = useState(false);
+    // Server clock minus ours, and the socket round trip, in ms (see clock sync below)
+    const [clockOffset, setClockOffset] = useState(0);
+    const [latency, setLatency] = useState<number | null>(null);
 
     useEffect(() => {
         if (!roomId) return;
@@ -48,11 +63,14 @@ export const useWebSocket = (roomId: string) => {
                 setHasMore(!!msgData.next);
                 setPage(1);
 
-                if (pomodoroData) setPomodoro(pomodoroData);
+                if (pomodoroData) setPomodoro(prev => (prev && prev.version > pomodoroData.version ? prev : pomodoroData));
 
                 // Fetch files separately to not block main load if it fails
                 getRoomFiles(roomId)
-                    .then(fileData => setFiles(fileData))
+                    .then(fileData => {
+                        setFiles(fileData.results);
+                        setFilesNext(fileData.next);
+                    })
                     .catch(err => console.error("Failed to load files:", err));
 
             } catch (error) {
@@ -62,18 +80,58 @@ export const useWebSocket = (roomId: string) => {
             }
         };
 
+        // Clock sync: NTP-style ping/pong over the socket. Each pong gives a
+        // round trip and an offset estimate; the sample with the shortest
+        // round trip among the last few is the least skewed by queueing.
+        const clockSamples: { rtt: number; offset: number }[] = [];
+        let lastSample: { rtt: number; offset: number } | null = null;
+        const clockTimers: ReturnType<typeof setTimeout>[] = [];
+        let clockInterval: ReturnType<typeof setInterval> | undefined;
+
+        const sendClockPing = () => {
+            if (ws.readyState !== WebSocket.OPEN) return;
+            ws.send(JSON.stringify({
+                type: 'clock_ping',
+                t0: Date.now(),
+                // Reported back as latency telemetry
+                rtt: lastSample?.rtt,
+                offset: lastSample?.offset
+            }));
+        };
+
+        const handleClockPong = (data: { t0: number; t1: number; t2: number }) => {
+            const t3 = Date.now();
+            const sample = {
+                rtt: (t3 - data.t0) - (data.t2 - data.t1),
+                offset: ((data.t1 - data.t0) + (data.t2 - t3)) / 2
+            };
+            lastSample = sample;
+            clockSamples.push(sample);
+            if (clockSamples.length > 8) clockSamples.shift();
+            const best = clockSamples.reduce((a, b) => (b.rtt < a.rtt ? b : a));
+            setClockOffset(best.offset);
+            setLatency(sample.rtt);
+        };
+
         ws.onopen = () => {
             console.log("WebSocket Connected");
             setIsConnected(true);
             // Load message history after connecting
             fetchMessageHistory();
+            // A quick burst for a first estimate, then keep it fresh
+            for (let i = 0; i < 4; i++) {
+                clockTimers.push(setTimeout(sendClockPing, i * 500));
+            }
+            clockInterval = setInterval(sendClockPing, 15000);
         };
 
         ws.onmessage = (event) => {
             const data = JSON.parse(event.data);
 
             // Handle different message types
-            if (data.type === 'presence_update') {
+            if (data.type === 'clock_pong') {
+                handleClockPong(data);
+            } else if (data.type === 'presence_update') {
                 setUsers(data.users);
             } else if (data.type === 'message_update') {
                 // Update existing message
@@ -118,6 +176,10 @@ export const useWebSocket = (roomId: string) => {
                 // User was kicked from room
                 alert(`You were kicked from the room by ${data.kicked_by}`);
                 window.location.href = '/';
+            } else if (data.type === 'room_deleted') {
+                // The room was deleted while we were in it
+                alert('This room has been deleted');
+                window.location.href = '/';
             } else if (data.type === 'user_removed') {
                 // Someone was removed from room
                 console.log(`${data.user_id} was removed by ${data.removed_by}`);
@@ -195,7 +257,8 @@ export const useWebSocket = (roomId: string) => {
                     })
                 );
             } else if (data.type === 'pomodoro_update') {
-                setPomodoro(data.data);
+                // Updates can arrive out of order; keep the newest
+                setPomodoro(prev => (prev && prev.version > data.data.version ? prev : data.data));
             } else if (data.type === 'file_uploaded') {
                 setFiles(prev => [data.data, ...prev]);
             } else if (data.type === 'file_deleted') {
@@ -214,6 +277,8 @@ export const useWebSocket = (roomId: string) => {
         };
 
         return () => {
+            clockTimers.forEach(clearTimeout);
+            clearInterval(clockInterval);
             ws.close();
         };
     }, [roomId]);
@@ -242,36 +307,58 @@ export const useWebSocket = (roomId: string) => {
         }
     }, [roomId, page, hasMore, isLoadingMore]);
 
+    const loadMoreFiles = useCallback(async () => {
+        if (!filesNext || isLoadingMoreFiles) return;
+
+        setIsLoadingMoreFiles(true);
+        try {
+            const data = await getRoomFiles(roomId, filesNext);
+            // Skip anything already added live by a file_uploaded event
+            setFiles(prev => {
+                const seen = new Set(prev.map(f => f.id));
+                return [...prev, ...data.results.filter(f => !seen.has(f.id))];
+            });
+            setFilesNext(data.next);
+        } catch (error) {
+            console.error('Failed to load more files:', error);
+        } finally {
+            setIsLoadingMoreFiles(false);
+        }
+    }, [roomId, filesNext, isLoadingMoreFiles]);
+
     const sendMessage = useCallback((message: string, repliedToId?: string) => {
         if (wsRef.current && wsRef.current.readyState === WebSocket.OPEN) {
             const payload: any = { message };
             if (repliedToId) {
                 payload.replied_to_id = repliedToId;
+                payload.replied_to_created_at = createdAtOf(repliedToId);
             }
             wsRef.current.send(JSON.stringify(payload));
         } else {
             console.warn("WebSocket is not connected");
         }
-    }, []);
+    }, [createdAtOf]);
 
     const editMessage = useCallback((messageId: string, content: string) => {
         if (wsRef.current && wsRef.current.readyState === WebSocket.OPEN) {
             wsRef.current.send(JSON.stringify({
                 type: 'edit_message',
                 message_id: messageId,
+                created_at: createdAtOf(messageId),
                 content
             }));
         }
-    }, []);
+    }, [createdAtOf]);
 
     const deleteMessage = useCallback((messageId: string) => {
         if (wsRef.current && wsRef.current.readyState === WebSocket.OPEN) {
             wsRef.current.send(JSON.stringify({
                 type: 'delete_message',
-                message_id: messageId
+                message_id: messageId,
+                created_at: createdAtOf(messageId)
             }));
         }
-    }, []);
+    }, [createdAtOf]);
 
     const sendTyping = useCallback((isTyping: boolean) => {
         if (wsRef.current && wsRef.current.readyState === WebSocket.OPEN) {
@@ -372,7 +459,12 @@ export const useWebSocket = (roomId: string) => {
         isLoadingMore,
         isLoading,
         pomodoro,
-        files
+        clockOffset,
+        latency,
+        files,
+        loadMoreFiles,
+        hasMoreFiles: !!filesNext,
+        isLoadingMoreFiles
     };
 };
 
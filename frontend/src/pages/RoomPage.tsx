@@ -112,6 +112,9 @@ export default function RoomPage() {
             hasMore={ws.hasMore}
             isLoadingMore={ws.isLoadingMore}
             isLoading={ws.isLoading}
+            onLoadMoreFiles={ws.loadMoreFiles}
+            hasMoreFiles={ws.hasMoreFiles}
+            isLoadingMoreFiles={ws.isLoadingMoreFiles}
         />
     );
 
@@ -148,6 +151,7 @@ export default function RoomPage() {
                             roomId={id}
                             session={ws.pomodoro}
                             canControl={canControlTimer}
+                            clockOffset={ws.clockOffset}
                         />
                     </Box>
 